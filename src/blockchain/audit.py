@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+RESULT_DIR = ROOT_DIR / "result"
+AUDIT_DB = os.path.join(RESULT_DIR, "audit.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.key_store import load_public_keys
+from src.blockchain.signers import decode_signature, get_signer
+from src.blockchain.signing import verify_message
+from src.blockchain.merkle import root_from_proof
+from src.blockchain.encoding import hash_block
+from src.blockchain.chain_db import stage_db
+
+# اندازه هر بازه rowid که به یک پروسه کارگر داده می‌شود
+AUDIT_CHUNK_SIZE = int(os.getenv("AUDIT_CHUNK_SIZE", "50000"))
+
+def _sha(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def _congestion_layer(level, score, impact):
+    return {"is_congested": 1 if level in ["Medium", "High"] else 0, "score": score, "impact": impact, "level": level}
+
+# بازمحاسبه هش هر جدول از روی ستون‌های ذخیره‌شده (همان فیلدهای calculate_hash هر مرحله)
+def _hash_blocks(r):
+    if len(r) < 9 or r[8] is None:
+        return None  # ردیف‌های قدیمی بدون nonce قابل بازمحاسبه نیستند
+    return _sha({"timestamp": r[0], "node_id": r[1], "traffic_type": r[2], "traffic_volume": r[3],
+                 "network_health": r[4], "latency": r[5], "previous_hash": r[6], "nonce": r[8]})
+
+def _hash_managed(r):
+    return _sha({"timestamp": r[0], "node_id": r[1], "traffic_layer": {"volume": r[3], "type": r[2]},
+                 "health_layer": {"status": r[4], "latency": r[5]}, "previous_hash": r[6],
+                 "congestion_layer": {"level": r[8], "score": r[9], "impact": r[10]}, "traffic_suggestion": r[11]})
+
+def _hash_orders(r):
+    return _sha({"timestamp": r[0], "node_id": r[1], "traffic_layer": {"volume": r[3], "type": r[2]},
+                 "health_layer": {"status": r[4], "latency": r[5]}, "previous_hash": r[6],
+                 "congestion_layer": _congestion_layer(r[8], r[9], r[10]), "traffic_suggestion": r[11], "order_type": r[12]})
+
+# بلاک‌های حلقه ریل‌تایم init__.py در همان جدول real_time_orders
+def _hash_real_time(r):
+    return _sha({"timestamp": r[0], "node_id": r[1],
+                 "traffic_layer": {"type": r[2], "volume": r[3], "health": r[4], "latency": r[5]},
+                 "health_layer": {"status": r[4], "latency": r[5]}, "previous_hash": r[6],
+                 "congestion_level": r[8], "congestion_score": r[9], "congestion_impact": r[10],
+                 "traffic_suggestion": r[11], "order_type": r[12]})
+
+def _hash_smart(r):
+    return _sha({"timestamp": r[0], "node_id": r[1], "traffic_layer": {"volume": r[3], "type": r[2]},
+                 "health_layer": {"status": r[4], "latency": r[5]}, "previous_hash": r[6],
+                 "congestion_level": r[8], "traffic_redistribution": r[9], "event_type": r[10], "predicted_congestion": r[11]})
+
+def _hash_healing(r):
+    return _sha({"timestamp": r[0], "node_id": r[1], "traffic_layer": {"volume": r[3], "type": r[2]},
+                 "health_layer": {"status": r[4], "latency": r[5]}, "previous_hash": r[6],
+                 "congestion_level": r[8], "traffic_redistribution": r[9], "event_type": r[10],
+                 "healing_action": r[11], "predicted_congestion": r[12]})
+
+def _hash_optimized(r):
+    return _sha({"timestamp": r[0], "node_id": r[1], "traffic_layer": {"volume": r[3], "type": r[2]},
+                 "health_layer": {"status": r[4], "latency": r[5]}, "previous_hash": r[6],
+                 "congestion_level": r[8], "traffic_redistribution": r[9], "event_type": r[10],
+                 "healing_action": r[11], "predicted_congestion": r[12], "resource_allocation": r[13]})
+
+# کدگذاری باینری: ستون‌های جدول به همان ترتیب (بدون block_hash) فیلدهای بلاک هستند
+def _binary(layout, end):
+    def recompute(r):
+        return hash_block(layout, tuple(r[:7]) + tuple(r[8:end]))
+    return recompute
+
+def _binary_blocks(r):
+    if len(r) < 9 or r[8] is None:
+        return None
+    return hash_block("initial", tuple(r[:7]) + (r[8],))
+
+# ستون‌هایی که nonce و timestamp_us آن‌ها با ALTER اضافه شده و ترتیبشان در جدول‌های قدیمی ثابت نیست با نام خوانده می‌شوند
+AUDIT_COLUMNS = {
+    "blocks": ("timestamp", "node_id", "traffic_type", "traffic_volume", "network_health", "latency",
+               "previous_hash", "block_hash", "nonce"),
+}
+
+# جدول‌های قابل ممیزی: (دیتابیس، جدول، توابع هش، ستون امضا، زنجیره previous_hash روی هش همین جدول)
+# congestion_blocks هش ورودی را کپی می‌کند و فقط امضا و پیوستگی آن بررسی می‌شود؛
+# در مراحل بعدی هش دوباره ساخته می‌شود ولی previous_hash به زنجیره اولیه اشاره دارد
+AUDIT_SPECS = {
+    "blocks": ("traffic_data.db", "blocks", [_binary_blocks, _hash_blocks], None, True),
+    "congestion_blocks": ("congestion_data.db", "congestion_blocks", [], 11, True),
+    "managed_blocks": ("managed_traffic.db", "managed_blocks", [_binary("managed", 12), _hash_managed], None, False),
+    "new_orders": ("new_orders.db", "new_orders", [_binary("order", 13), _hash_orders], 13, False),
+    "real_time_orders": ("real_time_orders.db", "real_time_orders",
+                         [_binary("order", 13), _hash_orders, _hash_real_time], 13, False),
+    "smart_traffic": ("smart_traffic.db", "smart_traffic", [_binary("smart", 12), _hash_smart], None, False),
+    "healing_network": ("self_healing.db", "healing_network", [_binary("healing", 13), _hash_healing], 13, False),
+    "optimized_resources": ("optimized_resources.db", "optimized_resources",
+                            [_binary("optimized", 14), _hash_optimized], 14, False),
+}
+
+def _ensure_checkpoint_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS audit_checkpoints
+                    (table_name TEXT PRIMARY KEY, last_rowid INTEGER, last_hash TEXT,
+                     verified_blocks INTEGER, audited_at TEXT)''')
+
+def get_checkpoint(table_name, audit_db=AUDIT_DB):
+    conn = sqlite3.connect(audit_db)
+    try:
+        _ensure_checkpoint_table(conn)
+        row = conn.execute("SELECT last_rowid, last_hash, verified_blocks FROM audit_checkpoints WHERE table_name = ?",
+                           (table_name,)).fetchone()
+        return row if row else (0, None, 0)
+    finally:
+        conn.close()
+
+def set_checkpoint(table_name, last_rowid, last_hash, verified_blocks, audit_db=AUDIT_DB):
+    conn = sqlite3.connect(audit_db)
+    try:
+        with conn:
+            _ensure_checkpoint_table(conn)
+            conn.execute("INSERT OR REPLACE INTO audit_checkpoints VALUES (?, ?, ?, ?, ?)",
+                         (table_name, last_rowid, last_hash, verified_blocks, time.strftime("%Y-%m-%d %H:%M:%S")))
+    finally:
+        conn.close()
+
+# ممیزی یک بازه rowid در پروسه کارگر
+def _audit_range(table_name, db_path, start, end):
+    _, table, hash_functions, signature_index, linked = AUDIT_SPECS[table_name]
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        columns = "*"
+        if table_name in AUDIT_COLUMNS:
+            # جدول‌های پایه بدون nonce قابل بازمحاسبه نیستند و nonce آن‌ها NULL خوانده می‌شود
+            present = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            columns = ", ".join(name if name in present else f"NULL AS {name}" for name in AUDIT_COLUMNS[table_name])
+        rows = conn.execute(f"SELECT rowid, {columns} FROM {table} WHERE rowid > ? AND rowid <= ? ORDER BY rowid", (start, end)).fetchall()
+    finally:
+        conn.close()
+    public_keys = {}
+    verified_roots = {}
+    errors = []
+    unverifiable = 0
+    previous = None
+    for rowid, *row in rows:
+        node_id, previous_hash, block_hash = row[1], row[6], row[7]
+        if hash_functions:
+            recomputed = [fn(row) for fn in hash_functions]
+            if all(h is None for h in recomputed):
+                unverifiable += 1
+            elif block_hash not in recomputed:
+                errors.append((rowid, "hash mismatch"))
+        if linked and previous is not None and previous_hash not in (previous, "0"):
+            errors.append((rowid, "broken previous_hash link"))
+        previous = block_hash
+        if signature_index is None:
+            continue
+        text = row[signature_index] if len(row) > signature_index else None
+        if not text:
+            errors.append((rowid, "missing signature"))
+            continue
+        try:
+            signature, scheme, proof = decode_signature(text)
+            if (node_id, scheme) not in public_keys:
+                public_keys[(node_id, scheme)] = load_public_keys([node_id], scheme)[node_id]
+            public_key = public_keys[(node_id, scheme)]
+            if proof:
+                # امضای ریشه هر دسته مرکل فقط یک بار تأیید می‌شود
+                root, path = proof
+                if root_from_proof(block_hash, path) != root:
+                    errors.append((rowid, "Merkle proof does not match the sealed root"))
+                    continue
+                root_key = (node_id, scheme, root, signature)
+                if root_key not in verified_roots:
+                    try:
+                        get_signer(scheme).verify(public_key, signature, root.encode())
+                        verified_roots[root_key] = True
+                    except Exception:
+                        verified_roots[root_key] = False
+                if not verified_roots[root_key]:
+                    errors.append((rowid, "invalid root signature"))
+            else:
+                verify_message(public_key, node_id, signature, block_hash.encode(), scheme)
+        except Exception as e:
+            errors.append((rowid, f"invalid signature: {e}"))
+    return {
+        "start": start, "end": end, "count": len(rows), "errors": errors, "unverifiable": unverifiable,
+        "first_previous_hash": rows[0][7] if rows else None, "last_hash": rows[-1][8] if rows else None
+    }
+
+# ممیزی یک جدول از آخرین checkpoint؛ بازه‌ها بین پروسه‌ها پخش و مرز بازه‌ها در پروسه اصلی به هم وصل می‌شوند
+def audit_table(table_name, workers=None, full=False, chunk_size=AUDIT_CHUNK_SIZE):
+    db_name, table, _, _, linked = AUDIT_SPECS[table_name]
+    db_path = stage_db(db_name)
+    if not os.path.exists(db_path):
+        return {"table": table_name, "status": "skipped", "summary": f"{db_name} does not exist"}
+    last_rowid, last_hash, verified_blocks = (0, None, 0) if full else get_checkpoint(table_name)
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        if not conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (table,)).fetchone():
+            return {"table": table_name, "status": "skipped", "summary": f"Table {table} does not exist in {db_name}"}
+        max_rowid = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+    finally:
+        conn.close()
+    ranges = [(start, min(start + chunk_size, max_rowid)) for start in range(last_rowid, max_rowid, chunk_size)]
+    started = time.time()
+    if len(ranges) > 1 and (workers or os.cpu_count() or 1) > 1:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context) as executor:
+            results = list(executor.map(_audit_range, [table_name] * len(ranges), [db_path] * len(ranges),
+                                        [r[0] for r in ranges], [r[1] for r in ranges]))
+    else:
+        results = [_audit_range(table_name, db_path, start, end) for start, end in ranges]
+
+    # اتصال مرز بازه‌ها و جلو بردن checkpoint تا قبل از اولین بازه خراب
+    errors = []
+    unverifiable = 0
+    audited = 0
+    checkpoint_rowid, checkpoint_hash, clean = last_rowid, last_hash, True
+    previous = last_hash
+    for result in results:
+        if not result["count"]:
+            continue
+        range_errors = list(result["errors"])
+        first_previous = result["first_previous_hash"]
+        if linked and previous is not None and first_previous not in (previous, "0"):
+            range_errors.insert(0, (result["start"] + 1, "broken previous_hash link at partition boundary"))
+        previous = result["last_hash"]
+        errors.extend(range_errors)
+        unverifiable += result["unverifiable"]
+        audited += result["count"]
+        if clean and not range_errors:
+            checkpoint_rowid, checkpoint_hash = result["end"], result["last_hash"]
+            verified_blocks += result["count"]
+        else:
+            clean = False
+    if checkpoint_rowid != last_rowid or full:
+        set_checkpoint(table_name, checkpoint_rowid, checkpoint_hash, verified_blocks)
+    for rowid, reason in errors[:20]:
+        logging.error(f"Audit {table_name} rowid {rowid}: {reason}")
+    return {
+        "table": table_name,
+        "status": "success" if not errors else "failed",
+        "audited_blocks": audited,
+        "errors": len(errors),
+        "unverifiable_blocks": unverifiable,
+        "checkpoint_rowid": checkpoint_rowid,
+        "elapsed": round(time.time() - started, 2),
+        "summary": f"Audited {audited} new blocks of {table_name}, {len(errors)} errors, checkpoint at rowid {checkpoint_rowid}"
+    }
+
+def audit_all(workers=None, full=False):
+    return {name: audit_table(name, workers, full) for name in AUDIT_SPECS}
+
+# تابع اصلی
+def main():
+    full = "--full" in sys.argv
+    tables = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    results = {name: audit_table(name, full=full) for name in tables} if tables else audit_all(full=full)
+    failed = [name for name, result in results.items() if result["status"] == "failed"]
+    return {
+        "status": "error" if failed else "success",
+        "block_count": sum(result.get("audited_blocks", 0) for result in results.values()),
+        "summary": f"Audit failed for {', '.join(failed)}" if failed else "All audited tables verified",
+        "details": results
+    }
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    result = main()
+    for name, details in result["details"].items():
+        print(details["summary"])
+    print(result["summary"])
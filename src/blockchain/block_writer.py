@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+import atexit
+
+from src.blockchain.compact_schema import insert_rows, table_codec
+
+# تنظیمات پیش‌فرض نوشتن گروهی
+DEFAULT_BATCH_SIZE = int(os.getenv("BLOCK_WRITER_BATCH_SIZE", "500"))
+DEFAULT_FLUSH_INTERVAL = float(os.getenv("BLOCK_WRITER_FLUSH_INTERVAL", "2.0"))
+
+# تنظیمات سراسری برای حالت اجرای درون‌حافظه‌ای پایپ‌لاین
+_settings = {
+    "persist": os.getenv("PIPELINE_PERSIST", "True") != "False",
+    "async_flush": False,
+    "capture": False
+}
+
+# ردیف‌های ضبط‌شده هر جدول برای تحویل مستقیم به مرحله بعد
+_captured = {}
+_captured_lock = threading.Lock()
+
+# نویسنده گروهی بلاک‌ها: یک اتصال باز برای هر دیتابیس و commit گروهی با executemany
+class BlockWriter:
+    def __init__(self, db_path, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, retries=5, delay=1,
+                 persist=None, async_flush=None, capture=None):
+        self.db_path = str(db_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.delay = delay
+        self.persist = _settings["persist"] if persist is None else persist
+        self.async_flush = _settings["async_flush"] if async_flush is None else async_flush
+        self.capture = _settings["capture"] if capture is None else capture
+        self.buffers = {}
+        # کدگذار جدول‌های با طرح فشرده (None برای جدول‌های متنی)
+        self.codecs = {}
+        # نام ستون‌های ردیف‌های هر جدول وقتی نویسنده آن را داده باشد (درج بر اساس نام به جای ترتیب ستون‌ها)
+        self.columns = {}
+        self.pending_rows = 0
+        self.last_flush = time.time()
+        self.lock = threading.RLock()
+        self.conn = None
+        if self.persist:
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.flusher = None
+        self.wake = threading.Event()
+        self.stopped = False
+        if self.persist and self.async_flush:
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def write(self, table, row, columns=None):
+        row = tuple(row)
+        if columns:
+            self.columns[table] = tuple(columns)
+        if self.capture and (self.capture is True or (self.db_path, table) in self.capture):
+            with _captured_lock:
+                _captured.setdefault((self.db_path, table), []).append(row)
+        if not self.persist:
+            return
+        with self.lock:
+            if table not in self.buffers:
+                self.buffers[table] = []
+            self.buffers[table].append(row)
+            self.pending_rows += 1
+            due = self.pending_rows >= self.batch_size or time.time() - self.last_flush >= self.flush_interval
+        if due:
+            if self.flusher:
+                self.wake.set()
+            else:
+                self.flush()
+
+    def _flush_loop(self):
+        while not self.stopped:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Background flush failed for {self.db_path}: {e}")
+
+    def flush(self):
+        if not self.persist:
+            return
+        with self.lock:
+            if not self.pending_rows:
+                self.last_flush = time.time()
+                return
+            for attempt in range(self.retries):
+                try:
+                    with self.conn:
+                        for table, rows in self.buffers.items():
+                            if rows:
+                                if table not in self.codecs:
+                                    self.codecs[table] = table_codec(self.conn, table)
+                                insert_rows(self.conn, table, rows, self.codecs[table], self.columns.get(table))
+                    break
+                except sqlite3.OperationalError as e:
+                    if 'database is locked' in str(e) and attempt < self.retries - 1:
+                        logging.warning(f"Database is locked, retrying in {self.delay} seconds...")
+                        time.sleep(self.delay)
+                    else:
+                        logging.error(f"Database error while flushing {self.pending_rows} rows to {self.db_path}: {e}")
+                        raise
+            self.buffers = {}
+            self.pending_rows = 0
+            self.last_flush = time.time()
+
+    def close(self):
+        if self.flusher:
+            self.stopped = True
+            self.wake.set()
+            self.flusher.join()
+        if not self.persist:
+            return
+        with self.lock:
+            try:
+                self.flush()
+            finally:
+                self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+# یک نویسنده برای هر دیتابیس در کل پروسه
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(db_path, **kwargs):
+    key = str(db_path)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = BlockWriter(key, **kwargs)
+        return _writers[key]
+
+def flush_writers(db_path=None):
+    with _writers_lock:
+        if db_path is None:
+            writers = list(_writers.values())
+        else:
+            writers = [_writers[str(db_path)]] if str(db_path) in _writers else []
+    for writer in writers:
+        writer.flush()
+
+def close_writers(db_path=None):
+    with _writers_lock:
+        if db_path is None:
+            writers = list(_writers.values())
+            _writers.clear()
+        else:
+            writer = _writers.pop(str(db_path), None)
+            writers = [writer] if writer else []
+    for writer in writers:
+        try:
+            writer.close()
+        except sqlite3.Error as e:
+            logging.error(f"Error closing block writer for {writer.db_path}: {e}")
+
+# پیکربندی نویسنده‌های جدید (ذخیره اختیاری، flush پس‌زمینه، ضبط ردیف‌ها)
+# capture می‌تواند True یا مجموعه‌ای از (db_path, table) باشد تا فقط جدول‌هایی که مرحله‌ای می‌خواند در حافظه بمانند
+def configure_writers(persist=None, async_flush=None, capture=None):
+    if persist is not None:
+        _settings["persist"] = persist
+    if async_flush is not None:
+        _settings["async_flush"] = async_flush
+    if capture is not None:
+        _settings["capture"] = capture
+
+def writers_persist():
+    return _settings["persist"]
+
+# پیمایش ردیف‌های ضبط‌شده یک جدول به ترتیب نوشتن بدون کپی
+# با release=True (آخرین مصرف‌کننده جدول) ردیف‌ها از حافظه برداشته و هر ردیف پس از تحویل آزاد می‌شود
+def captured_rows(db_path, table, release=False):
+    key = (str(db_path), table)
+    with _captured_lock:
+        rows = _captured.pop(key, []) if release else _captured.get(key, [])
+    return _drain(rows) if release else iter(rows)
+
+def _drain(rows):
+    rows.reverse()
+    while rows:
+        yield rows.pop()
+
+def clear_captured():
+    with _captured_lock:
+        _captured.clear()
+
+# تخلیه بافرها هنگام خروج پروسه
+atexit.register(close_writers)
@@ -0,0 +1,234 @@
+import os
+import sys
+import sqlite3
+import logging
+from pathlib import Path
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+RESULT_DIR = ROOT_DIR / "result"
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.compact_schema import ENUM_COLUMNS, data_table, is_compact, storage_table
+
+# نگهداری خروجی همه مراحل به صورت جدول در یک دیتابیس مشترک به جای یک فایل برای هر مرحله
+CONSOLIDATED_DB = "--consolidated-db" in sys.argv or os.getenv("CONSOLIDATED_DB") == "True"
+CHAIN_DB_NAME = "chain.db"
+
+# فایل خروجی هر مرحله و جدول‌های آن؛ جدول اول جدول اصلی مرحله است
+STAGE_DATABASES = {
+    "traffic_data.db": ("blocks",),
+    "congestion_data.db": ("congestion_blocks",),
+    "managed_traffic.db": ("managed_blocks",),
+    "new_orders.db": ("new_orders",),
+    "real_time_orders.db": ("real_time_orders",),
+    "traffic_report.db": ("traffic_report",),
+    "smart_traffic.db": ("smart_traffic", "optimization_log"),
+    "self_healing.db": ("healing_network",),
+    "optimized_resources.db": ("optimized_resources",),
+    "predictive_analysis.db": ("predictive_analysis",),
+}
+
+# مسیر فیزیکی دیتابیس یک مرحله؛ در حالت یکپارچه همه مراحل در chain.db هستند
+def stage_db(name, result_dir=RESULT_DIR):
+    return os.path.join(result_dir, CHAIN_DB_NAME if CONSOLIDATED_DB and name in STAGE_DATABASES else name)
+
+# view ردگیری یک بلاک در همه مراحل: هر مرحله هش را دوباره می‌سازد ولی (node_id, timestamp_us) بلاک را حفظ می‌کند
+LINEAGE_VIEW = "block_lineage"
+LINEAGE_STAGES = (
+    ("blocks", (("origin_hash", "block_hash"), ("traffic_type", "traffic_type"), ("traffic_volume", "traffic_volume"),
+                ("network_health", "network_health"), ("latency", "latency"))),
+    ("congestion_blocks", (("congestion_hash", "block_hash"), ("congestion_level", "congestion_level"),
+                           ("congestion_score", "congestion_score"))),
+    ("managed_blocks", (("managed_hash", "block_hash"), ("traffic_suggestion", "traffic_suggestion"))),
+    ("new_orders", (("order_hash", "block_hash"), ("order_type", "order_type"))),
+    ("real_time_orders", (("real_time_hash", "block_hash"), ("real_time_order_type", "order_type"))),
+    ("smart_traffic", (("smart_hash", "block_hash"), ("predicted_congestion", "predicted_congestion"),
+                       ("traffic_redistribution", "traffic_redistribution"), ("event_type", "event_type"))),
+    ("healing_network", (("healing_hash", "block_hash"), ("healing_action", "healing_action"))),
+    ("optimized_resources", (("optimized_hash", "block_hash"), ("resource_allocation", "resource_allocation"))),
+    ("predictive_analysis", (("model_prediction", "predicted_congestion"), ("anomaly_detected", "anomaly_detected"),
+                             ("anomaly_score", "congestion_score"))),
+)
+_LINEAGE_KEYS = ("node_id", "timestamp_us")
+# Step 12 پنجره یک ساعت اخیر را در هر اجرا دوباره امتیاز می‌دهد؛ از این مراحل فقط آخرین ردیف هر کلید به view می‌آید
+_RESCORED_STAGES = ("predictive_analysis",)
+
+# کلید ردگیری در ریشه یکتاست: ایندکس یکتا روی blocks، به جز ردیف‌های جنسیس (previous_hash برابر "0") که هر اجرای
+# Step 1 با همان زمان ثابت تکرار می‌کند و از view کنار گذاشته می‌شوند؛ در ریشه بلادرنگ هر تیک برای هر نود یک بلاک دارد
+def ensure_lineage_key(conn):
+    target = storage_table(conn, "blocks")
+    try:
+        with conn:
+            conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{target}_lineage_key ON {target} "
+                         f"({', '.join(_LINEAGE_KEYS)}) WHERE previous_hash <> '0'")
+        return True
+    except sqlite3.IntegrityError as e:
+        logging.warning(f"blocks already has duplicate (node_id, timestamp_us) keys, lineage key not enforced: {e}")
+        return False
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+# مراحل موجود در این دیتابیس که ستون‌های کلید ردگیری را دارند
+def _lineage_stages(conn):
+    stages = []
+    for table, columns in LINEAGE_STAGES:
+        present = _columns(conn, table)
+        if all(key in present for key in _LINEAGE_KEYS):
+            stages.append((table, tuple((name, column) for name, column in columns if column in present)))
+    return stages
+
+# حلقه بلادرنگ init__ بلاک‌های جدید را مستقیم در real_time_orders می‌نویسد؛ این بلاک‌ها ریشه شاخه دوم view هستند
+_REAL_TIME_ROOT = "real_time_orders"
+
+# یک شاخه view با ریشه stages[root]؛ مراحل پیش از ریشه NULL و مراحل پس از آن با LEFT JOIN می‌آیند
+def _lineage_branch(stages, root):
+    table = stages[root][0]
+    alias = "b" if root == 0 else "r"
+    select = [f"{alias}.node_id AS node_id", f"{alias}.timestamp AS timestamp", f"{alias}.timestamp_us AS timestamp_us"]
+    joins = []
+    for i, (stage, columns) in enumerate(stages):
+        if i < root:
+            select.extend(f"NULL AS {name}" for name, _ in columns)
+            continue
+        stage_alias = alias if i == root else f"s{i}"
+        select.extend(f"{stage_alias}.{column} AS {name}" for name, column in columns)
+        if i > root:
+            # اتصال از طریق ایندکس timestamp_us هر جدول (node_id در طرح فشرده از view کدگشایی می‌شود)
+            joins.append(f"LEFT JOIN {stage} AS {stage_alias} ON {stage_alias}.timestamp_us = {alias}.timestamp_us "
+                         f"AND {stage_alias}.node_id = {alias}.node_id")
+            if stage in _RESCORED_STAGES:
+                joins[-1] += (f" AND {stage_alias}.rowid = (SELECT MAX(l.rowid) FROM {stage} AS l "
+                              f"WHERE l.timestamp_us = {alias}.timestamp_us AND l.node_id = {alias}.node_id)")
+    where = " WHERE b.previous_hash <> '0'" if root == 0 else ""
+    return f"SELECT {', '.join(select)} FROM {table} AS {alias} {' '.join(joins)}{where}"
+
+def lineage_sql(conn):
+    stages = _lineage_stages(conn)
+    # دیتابیس‌های جداگانه هر مرحله فقط یک جدول مرحله دارند و view نمی‌گیرند
+    if len(stages) < 2 or stages[0][0] != "blocks":
+        return None
+    branches = [_lineage_branch(stages, 0)]
+    tables = [table for table, _ in stages]
+    if _REAL_TIME_ROOT in tables:
+        # بلاک‌های بلادرنگ ردیفی در blocks ندارند؛ ردیف‌هایی که از blocks آمده‌اند در شاخه اول هستند
+        branches.append(f"{_lineage_branch(stages, tables.index(_REAL_TIME_ROOT))} WHERE NOT EXISTS "
+                        f"(SELECT 1 FROM blocks AS o WHERE o.timestamp_us = r.timestamp_us AND o.node_id = r.node_id)")
+    return f"CREATE VIEW {LINEAGE_VIEW} AS {' UNION ALL '.join(branches)}"
+
+def _view_sql(conn):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?", (LINEAGE_VIEW,)).fetchone()
+    return row[0] if row else None
+
+# ساخت یا به‌روزرسانی view ردگیری وقتی جدول مرحله‌ای اضافه یا فشرده شده باشد
+def ensure_lineage_view(conn):
+    sql = lineage_sql(conn)
+    if sql is None:
+        return False
+    if _view_sql(conn) == sql:
+        return True
+    if conn.in_transaction:
+        conn.commit()
+    with conn:
+        # مراحل هم‌زمان روی یک فایل؛ بررسی دوباره داخل تراکنش نوشتن
+        conn.execute("BEGIN IMMEDIATE")
+        sql = lineage_sql(conn)
+        if _view_sql(conn) != sql:
+            conn.execute(f"DROP VIEW IF EXISTS {LINEAGE_VIEW}")
+            conn.execute(sql)
+            logging.info(f"Updated {LINEAGE_VIEW} view")
+    return True
+
+# همه ردیف‌های ردگیری بلاکی که هش آن در هر یک از مراحل آمده است (کوئری‌ها روی ایندکس‌های block_hash و node_time)
+def trace_block(conn, block_hash):
+    if _view_sql(conn) is None:
+        return []
+    sources = [table for table, _ in _lineage_stages(conn) if "block_hash" in _columns(conn, table)]
+    keys = conn.execute(" UNION ".join(f"SELECT node_id, timestamp_us FROM {table} WHERE block_hash = :block_hash"
+                                       for table in sources), {"block_hash": block_hash}).fetchall()
+    # view ترکیبی (UNION ALL) در join باز نمی‌شود؛ شرط کلید ثابت به هر دو شاخه می‌رسد و هر شاخه با ایندکس node_time خوانده می‌شود
+    rows = []
+    for node_id, timestamp_us in keys:
+        cursor = conn.execute(f"SELECT * FROM {LINEAGE_VIEW} WHERE node_id = ? AND timestamp_us = ?", (node_id, timestamp_us))
+        columns = [description[0] for description in cursor.description]
+        rows.extend(dict(zip(columns, row)) for row in cursor.fetchall())
+    return sorted(rows, key=lambda row: row["timestamp_us"])
+
+# ستون‌های منطقی جدول و نوع آن‌ها؛ جدول فشرده به ستون‌های متنی قبلی برمی‌گردد
+def _logical_columns(conn, table):
+    if not is_compact(conn, table):
+        return [(row[1], row[2]) for row in conn.execute(f"PRAGMA table_info({table})")]
+    types = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({data_table(table)})")}
+    columns = []
+    for name in _columns(conn, table):
+        if name == "rowid":
+            continue
+        kind = "TEXT" if name in ENUM_COLUMNS or name == "signature" else types.get(name, "")
+        columns.append((name, "" if kind == "ANY" else kind))
+    return columns
+
+def _copy_table(source, target, table, batch_size=10000):
+    columns = _logical_columns(source, table)
+    names = ", ".join(name for name, _ in columns)
+    target.execute(f"CREATE TABLE {table} ({', '.join(f'{name} {kind}'.strip() for name, kind in columns)})")
+    # rowid قبلی حفظ می‌شود تا watermark مراحل و checkpoint ممیزی معتبر بمانند
+    insert = f"INSERT INTO {table} (rowid, {names}) VALUES ({', '.join('?' * (len(columns) + 1))})"
+    cursor = source.execute(f"SELECT rowid, {names} FROM {table} ORDER BY rowid")
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        target.executemany(insert, rows)
+        copied += len(rows)
+    return copied
+
+# انتقال دیتابیس‌های جداگانه یک پوشه نتایج به chain.db؛ فایل‌های قبلی دست نمی‌خورند
+def migrate(result_dir=RESULT_DIR):
+    from src.blockchain.timestamps import STAGE_TABLES, ensure_stage_indexes
+    from src.blockchain.watermark import WATERMARK_TABLE, ensure_watermark_table, watermark_key
+    target_path = os.path.join(result_dir, CHAIN_DB_NAME)
+    target = sqlite3.connect(target_path, timeout=30)
+    target.execute("PRAGMA journal_mode=WAL")
+    report = {}
+    try:
+        for db_file, tables in STAGE_DATABASES.items():
+            db_path = os.path.join(result_dir, db_file)
+            if not os.path.exists(db_path):
+                continue
+            source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                for table in tables:
+                    if not _columns(source, table):
+                        continue
+                    if _columns(target, table):
+                        logging.warning(f"{table} already exists in {CHAIN_DB_NAME}, skipping")
+                        continue
+                    with target:
+                        report[table] = _copy_table(source, target, table)
+                    if table in STAGE_TABLES:
+                        ensure_stage_indexes(target, table)
+                    logging.info(f"Copied {report[table]} rows of {table} from {db_file}")
+                # watermark هر مرحله با کلید همان مرحله در دیتابیس مشترک
+                if _columns(source, WATERMARK_TABLE):
+                    key = watermark_key(target_path, target_path, tables[0])
+                    with target:
+                        ensure_watermark_table(target)
+                        for input_table, last_rowid in source.execute(f"SELECT input_table, last_rowid FROM {WATERMARK_TABLE}"):
+                            target.execute(f"INSERT OR REPLACE INTO {WATERMARK_TABLE} VALUES (?, ?, ?)",
+                                           (key, input_table, last_rowid))
+            finally:
+                source.close()
+        ensure_lineage_view(target)
+    finally:
+        target.close()
+    return report
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    copied = migrate()
+    for table, rows in copied.items():
+        print(f"{table:<22} {rows:>10} rows")
+    print(f"Migrated {len(copied)} tables into {CHAIN_DB_NAME}; run with CONSOLIDATED_DB=True to use it")
@@ -1,12 +1,10 @@
 import hashlib
 import json
 import os
-import time
+import logging
 from datetime import datetime, timedelta
 import numpy as np
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 import sqlite3
 import random
 from tqdm import tqdm
@@ -19,13 +17,33 @@ sys.stdout.reconfigure(line_buffering=True)
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-db_file = os.path.join(RESULT_DIR, "traffic_data.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, flush_writers, close_writers, writers_persist
+from src.blockchain.key_store import load_node_keys, load_public_keys
+from src.blockchain.signing import PendingSeals, sign_message, verify_message
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.leader_schedule import LeaderSchedule, EPOCH_SLOTS
+from src.blockchain.traffic_simulator import simulate_traffic_matrix, traffic_rows, traffic_rng
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.compact_schema import add_column
+from src.blockchain.chain_db import ensure_lineage_key, stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+db_file = stage_db("traffic_data.db")
 
 # تنظیمات اولیه
 np.random.seed(42)
-num_nodes = 10
+topology = load_topology()
+num_nodes = topology.num_nodes
 start_time = datetime(2025, 2, 27, 7, 0, 0)
 congestion_prob = 0.15
+traffic_types = ["Data", "Stream", "Game"]
+# تعداد گام‌های زمانی (TIME_STEPS برای ساخت زنجیره‌های بزرگ در تست ظرفیت) و اندازه هر تکه شبیه‌سازی
+TIME_STEPS = int(os.getenv("TIME_STEPS", "0"))
+SIM_CHUNK_STEPS = int(os.getenv("SIM_CHUNK_STEPS", "10000"))
 
 # تعریف کلاس نود
 class Node:
@@ -37,17 +55,12 @@ class Node:
     def update_history(self):
         self.history += 1
 
-# گراف نودها
-nodes = [Node(f"Node_{i}", random.uniform(100, 1000)) for i in range(1, num_nodes + 1)]
-graph = {}
-for node in nodes:
-    neighbors = random.sample([n.node_id for n in nodes], random.randint(1, 3))
-    weights = [random.uniform(1, 5) for _ in neighbors]
-    graph[node.node_id] = {"neighbors": neighbors, "weights": weights}
+# نودهای توپولوژی مشترک
+nodes = [Node(node_id, random.uniform(100, 1000)) for node_id in topology.node_ids()]
 
-# تولید کلیدهای ECDSA
-node_keys = {node.node_id: ec.generate_private_key(ec.SECP256R1(), default_backend()) for node in nodes}
-node_public_keys = {node_id: key.public_key() for node_id, key in node_keys.items()}
+# کلیدهای ECDSA از مخزن مشترک کلیدها
+node_keys = load_node_keys([node.node_id for node in nodes])
+node_public_keys = load_public_keys([node.node_id for node in nodes])
 
 # دیتابیس SQLite
 def init_db():
@@ -57,19 +70,26 @@ def init_db():
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS blocks
                  (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL,
-                  network_health TEXT, latency REAL, previous_hash TEXT, block_hash TEXT)''')
+                  network_health TEXT, latency REAL, previous_hash TEXT, block_hash TEXT, nonce INTEGER, timestamp_us INTEGER)''')
+    # nonce برای بازمحاسبه هش در ممیزی زنجیره ذخیره می‌شود
+    c.execute("PRAGMA table_info(blocks)")
+    if "nonce" not in [column[1] for column in c.fetchall()]:
+        add_column(conn, "blocks", "nonce", "INTEGER")
     conn.commit()
+    ensure_stage_indexes(conn, "blocks")
+    ensure_lineage_key(conn)
     conn.close()
     print(f"Database initialized at {db_file}")
 
+# nonce و timestamp_us با ALTER به جدول‌های قدیمی اضافه شده‌اند و ترتیبشان به ترتیب مهاجرت بستگی دارد؛ درج بر اساس نام ستون
+BLOCK_COLUMNS = ("timestamp", "node_id", "traffic_type", "traffic_volume", "network_health", "latency",
+                 "previous_hash", "block_hash", "nonce", "timestamp_us")
+
 def save_to_db(block):
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+    get_writer(db_file).write("blocks",
               (block.get_timestamp_str(), block.node_id, block.traffic_type, block.traffic_volume,
-               block.network_health, block.latency, block.previous_hash, block.hash))
-    conn.commit()
-    conn.close()
+               block.network_health, block.latency, block.previous_hash, block.hash, block.nonce, epoch_us(block.timestamp)),
+              BLOCK_COLUMNS)
 
 # کلاس بلاک
 class Block:
@@ -84,11 +104,16 @@ class Block:
         self.nonce = nonce
         self.hash = self.calculate_hash()
         self.signature = None
+        self.signature_scheme = None
+        self.merkle_proof = None
 
     def get_timestamp_str(self):
         return self.timestamp.isoformat()
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("initial", (self.get_timestamp_str(), self.node_id, self.traffic_type, self.traffic_volume,
+                                          self.network_health, self.latency, self.previous_hash, self.nonce))
         block_string = json.dumps({
             "timestamp": self.get_timestamp_str(),
             "node_id": self.node_id,
@@ -103,112 +128,152 @@ class Block:
 
     def sign_block(self, private_key):
         try:
-            message = self.hash.encode()
-            self.signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+            self.signature, self.signature_scheme = sign_message(private_key, self.hash.encode())
+            self.merkle_proof = None
             return True
         except Exception as e:
             print(f"Signing failed for {self.node_id}: {e}")
             return False
 
+    def verify_signature(self, public_key):
+        try:
+            if not self.signature:
+                logging.error(f"No signature found for block {self.node_id}")
+                return False
+            verify_message(public_key, self.node_id, self.signature, self.hash.encode(), self.signature_scheme, self.merkle_proof)
+            return True
+        except Exception as e:
+            logging.error(f"Signature verification failed for {self.node_id}: {e}")
+            return False
+
 # کلاس بلاک‌چین
+# فقط آخرین بلاک و شمارنده‌های خلاصه در حافظه می‌مانند؛ بلاک‌ها بعد از امضا به دیتابیس می‌روند
 class Blockchain:
     def __init__(self):
-        self.chain = []
+        self.latest_block = None
+        self.block_count = 0
+        self.congested_count = 0
+        self.total_traffic = 0.0
         self.cache = {"latest_hash": "0"}
         self.nodes = nodes
+        self.node_index = {node.node_id: node for node in nodes}
+        self.schedule = None
+        self.pending = PendingSeals(self.save_block, rollback=self.rollback)
+        self.sealed_block = None
         self.create_genesis_block()
 
     def create_genesis_block(self):
-        genesis = Block(datetime(2025, 2, 27, 7, 0, 0), "Genesis", "Data", 0, "Normal", 0, "0")
+        genesis = Block(datetime(2025, 2, 27, 7, 0, 0), "Genesis", "Data", 0.0, "Normal", 0.0, "0")
         if genesis.sign_block(node_keys["Node_1"]):
-            self.chain.append(genesis)
-            save_to_db(genesis)
-            self.cache["latest_hash"] = genesis.hash
+            self.append_block(genesis)
+            self.save_block(genesis)
             print("Genesis block created")
 
+    def append_block(self, block):
+        self.latest_block = block
+        self.block_count += 1
+        if block.traffic_volume > 70:
+            self.congested_count += 1
+        self.total_traffic += block.traffic_volume
+        self.cache["latest_hash"] = block.hash
+
+    def save_block(self, block):
+        save_to_db(block)
+        self.sealed_block = block
+
+    # بلاک‌هایی که امضا نشده‌اند یا به بلاک امضانشده پیوند دارند کنار گذاشته می‌شوند و زنجیره از آخرین بلاک ذخیره‌شده ادامه می‌یابد
+    def rollback(self, dropped):
+        for block in dropped:
+            self.block_count -= 1
+            if block.traffic_volume > 70:
+                self.congested_count -= 1
+            self.total_traffic -= block.traffic_volume
+        self.latest_block = self.sealed_block
+        self.cache["latest_hash"] = self.sealed_block.hash if self.sealed_block else "0"
+        logging.error(f"Discarded {len(dropped)} blocks after an unsigned block, chain continues from {self.cache['latest_hash']}")
+
+    # زمان بلاک‌ها اکیداً صعودی است تا کلید ردگیری (node_id, timestamp_us) حتی با دقت کم ساعت سیستم یکتا بماند
+    def next_timestamp(self):
+        timestamp = datetime.now()
+        if self.latest_block is not None and timestamp <= self.latest_block.timestamp:
+            timestamp = self.latest_block.timestamp + timedelta(microseconds=1)
+        return timestamp
+
     def get_latest_block(self):
-        return self.chain[-1]
+        return self.latest_block
 
-    def proof_of_stake(self, node_id):
-        weights = [node.capacity + node.history * 10 for node in self.nodes]
-        total_weight = sum(weights)
-        if total_weight == 0:
-            return False
-        selected_node = random.choices(self.nodes, weights=weights, k=1)[0]
-        if selected_node.node_id == node_id:
-            selected_node.update_history()
-            return True
-        return False
+    # رهبر هر اسلات از برنامه دوره (proof of stake بدون نمونه‌برداری ردشونده)
+    def leader_for_slot(self, slot):
+        if self.schedule is None or slot not in self.schedule:
+            epoch = slot // EPOCH_SLOTS
+            self.schedule = LeaderSchedule(self.nodes, epoch, self.cache["latest_hash"])
+        return self.schedule.leader(slot)
 
+    # nonce بلاک شماره اسلات آن است
     def add_block(self, block, node_id):
-        start_time = time.time()
-        nonce = 0
-        while not self.proof_of_stake(node_id):
-            nonce += 1
-            block.nonce = nonce
-            block.hash = block.calculate_hash()
-            if time.time() - start_time > 5:
-                print(f"Timeout for block at {block.timestamp} for {node_id}")
-                return False
-        if block.sign_block(node_keys[node_id]):
-            if block.previous_hash == self.cache["latest_hash"]:
-                self.chain.append(block)
-                save_to_db(block)
-                self.cache["latest_hash"] = block.hash
-                return True
-        return False
-
-# توابع شبیه‌سازی و تولید بلاک
-def simulate_traffic(node_id, timestamp):
-    hour = timestamp.hour + timestamp.minute / 60
-    peak_prob = 0.3 if 8 <= hour < 18 else 0.05
-    traffic_types = ["Data", "Stream", "Game"]
-    traffic_type = random.choice(traffic_types)
-    if np.random.random() < (congestion_prob * peak_prob):
-        traffic = np.random.uniform(80, 150)
-        health = "Delayed" if np.random.random() < 0.5 else "Down"
-    else:
-        traffic = np.random.uniform(1, 60)
-        health = "Normal"
-    latency = np.random.uniform(0.1, 10)
-    return {"type": traffic_type, "volume": traffic, "health": health, "latency": latency}
-
-def create_block(traffic_data, previous_hash, node_id):
+        if self.leader_for_slot(block.nonce) != node_id:
+            print(f"{node_id} is not the leader of slot {block.nonce}")
+            return False
+        if block.previous_hash != self.cache["latest_hash"]:
+            return False
+        self.node_index[node_id].update_history()
+        self.append_block(block)
+        self.pending.add(block)
+        return True
+
+# تولید بلاک
+def create_block(traffic_data, previous_hash, node_id, slot, timestamp):
     return Block(
-        datetime.now(), node_id, traffic_data["type"], traffic_data["volume"],
-        traffic_data["health"], traffic_data["latency"], previous_hash
+        timestamp, node_id, traffic_data["type"], traffic_data["volume"],
+        traffic_data["health"], traffic_data["latency"], previous_hash, slot
     )
 
 # تابع اصلی
 def main():
     try:
-        time_steps = 10 if os.getenv("DEMO_MODE") == "True" else 40
+        time_steps = TIME_STEPS or (10 if os.getenv("DEMO_MODE") == "True" else 40)
         init_db()
         blockchain = Blockchain()
-        tasks = [(t, node.node_id) for t in range(time_steps) for node in nodes]
-        random.shuffle(tasks)
-        total_tasks = len(tasks)
+        # هر گام زمانی num_nodes اسلات دارد و بلاک هر اسلات را رهبر همان اسلات می‌سازد
+        # ترافیک هر تکه از گام‌ها یک جا و برداری شبیه‌سازی و بلاک‌های تکه دسته‌ای امضا می‌شوند
+        total_tasks = time_steps * num_nodes
         processed_blocks = 0
-        for idx, (t, node_id) in enumerate(tqdm(tasks, desc="Processing blocks", file=sys.stdout)):
-            timestamp = start_time + timedelta(seconds=t * 5)
-            traffic_data = simulate_traffic(node_id, timestamp)
-            previous_hash = blockchain.cache["latest_hash"]
-            block = create_block(traffic_data, previous_hash, node_id)
-            if blockchain.add_block(block, node_id):
-                processed_blocks += 1
-                tqdm.write(f"Processed {idx + 1}/{total_tasks} blocks - Node: {node_id}, Traffic: {traffic_data['volume']:.2f} MB/s")
+        rng = traffic_rng()
+        progress = tqdm(total=total_tasks, desc="Processing blocks", file=sys.stdout)
+        for chunk_start in range(0, time_steps, SIM_CHUNK_STEPS):
+            steps = range(chunk_start, min(chunk_start + SIM_CHUNK_STEPS, time_steps))
+            timestamps = [start_time + timedelta(seconds=t * 5) for t in steps]
+            rows = traffic_rows(simulate_traffic_matrix(timestamps, num_nodes, traffic_types, rng, congestion_prob))
+            for t, step_rows in zip(steps, rows):
+                for i, traffic_data in enumerate(step_rows):
+                    slot = t * num_nodes + i
+                    node_id = blockchain.leader_for_slot(slot)
+                    previous_hash = blockchain.cache["latest_hash"]
+                    block = create_block(traffic_data, previous_hash, node_id, slot, blockchain.next_timestamp())
+                    if blockchain.add_block(block, node_id):
+                        processed_blocks += 1
+                        if total_tasks <= 1000:
+                            tqdm.write(f"Processed {slot + 1}/{total_tasks} blocks - Node: {node_id}, Traffic: {traffic_data['volume']:.2f} MB/s")
+                    progress.update(1)
+            processed_blocks -= blockchain.pending.seal()
+        progress.close()
         
         # گزارش خلاصه
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM blocks WHERE traffic_volume > 70")
-        congested = c.fetchone()[0]
-        c.execute("SELECT AVG(traffic_volume) FROM blocks")
-        avg_traffic = c.fetchone()[0] or 0.0
-        conn.close()
+        if writers_persist():
+            flush_writers(db_file)
+            conn = sqlite3.connect(db_file)
+            c = conn.cursor()
+            c.execute("SELECT COUNT(*) FROM blocks WHERE traffic_volume > 70")
+            congested = c.fetchone()[0]
+            c.execute("SELECT AVG(traffic_volume) FROM blocks")
+            avg_traffic = c.fetchone()[0] or 0.0
+            conn.close()
+        else:
+            congested = blockchain.congested_count
+            avg_traffic = blockchain.total_traffic / blockchain.block_count if blockchain.block_count else 0.0
         
         summary = {
-            "total_blocks": len(blockchain.chain),
+            "total_blocks": blockchain.block_count,
             "congested_points": congested,
             "average_traffic": round(avg_traffic, 2)
         }
@@ -227,6 +292,8 @@ def main():
             "summary": "Failed to process blocks",
             "error": str(e)
         }
+    finally:
+        close_writers(db_file)
 
 if __name__ == "__main__":
     result = main()
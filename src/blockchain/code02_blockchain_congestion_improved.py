@@ -8,11 +8,8 @@ import sqlite3
 import json
 from concurrent.futures import ThreadPoolExecutor
 import time
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 import sys
-import random
 from pathlib import Path
 
 # غیرفعال کردن بافرینگ خروجی
@@ -21,21 +18,28 @@ sys.stdout.reconfigure(line_buffering=True)
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "traffic_data.db")
-output_db = os.path.join(RESULT_DIR, "congestion_data.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, flush_writers, close_writers, writers_persist
+from src.blockchain.watermark import prepare_incremental, commit_watermark, fused_watermarks, seed_rows
+from src.blockchain.signing import PendingSeals, sign_message, verify_message
+from src.blockchain.signers import encode_signature
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+input_db = stage_db("traffic_data.db")
+output_db = stage_db("congestion_data.db")
 
 # تنظیمات لاگینگ
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # گراف نودها
-nodes = [f"Node_{i}" for i in range(1, 11)] + ["Genesis"]
-graph = {node: {"neighbors": random.sample(nodes, random.randint(1, 3)), 
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]} 
-         for node in nodes}
-
-# تولید کلیدهای ECDSA
-node_keys = {node: ec.generate_private_key(ec.SECP256R1(), default_backend()) for node in nodes}
-node_public_keys = {node: key.public_key() for node, key in node_keys.items()}
+topology = load_topology()
+nodes = topology.node_ids() + ["Genesis"]
 
 # مقداردهی دیتابیس خروجی
 def init_db():
@@ -46,31 +50,19 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS congestion_blocks
                  (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL, network_health TEXT,
                   latency REAL, previous_hash TEXT, block_hash TEXT, congestion_level TEXT,
-                  congestion_score REAL, latency_impact REAL, signature TEXT)''')
+                  congestion_score REAL, latency_impact REAL, signature TEXT, timestamp_us INTEGER)''')
     conn.commit()
+    ensure_stage_indexes(conn, "congestion_blocks")
     conn.close()
     print(f"Output database initialized at {output_db}")
 
-def save_to_db(block, retries=5, delay=1):
-    for attempt in range(retries):
-        try:
-            conn = sqlite3.connect(output_db)
-            c = conn.cursor()
-            c.execute("INSERT INTO congestion_blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                      (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
-                       block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
-                       block.congestion_layer["level"], block.congestion_layer["score"], block.congestion_layer["impact"],
-                       block.signature.hex() if block.signature else None))
-            conn.commit()
-            conn.close()
-            break
-        except sqlite3.OperationalError as e:
-            if 'database is locked' in str(e):
-                logging.warning(f"Database is locked, retrying in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                logging.error(f"Database error: {e}")
-                break
+def save_to_db(block):
+    get_writer(output_db).write("congestion_blocks",
+              (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
+               block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
+               block.congestion_layer["level"], block.congestion_layer["score"], block.congestion_layer["impact"],
+               encode_signature(block.signature, block.signature_scheme, block.merkle_proof) if block.signature else None,
+               epoch_us(block.timestamp)))
 
 # کلاس بلاک با لایه‌ها
 class Block:
@@ -83,8 +75,14 @@ class Block:
         self.congestion_layer = congestion_layer or {"is_congested": 0, "score": 0.0, "impact": 0.0, "level": "Low"}
         self.hash = self.calculate_hash()
         self.signature = signature
+        self.signature_scheme = None
+        self.merkle_proof = None
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("congestion", (self.timestamp, self.node_id, self.traffic_layer["type"], self.traffic_layer["volume"],
+                                             self.health_layer["status"], self.health_layer["latency"], self.previous_hash,
+                                             self.congestion_layer["level"], self.congestion_layer["score"], self.congestion_layer["impact"]))
         block_string = json.dumps({
             "timestamp": self.timestamp,
             "node_id": self.node_id,
@@ -97,8 +95,8 @@ class Block:
 
     def sign_block(self, private_key):
         try:
-            message = self.hash.encode()
-            self.signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+            self.signature, self.signature_scheme = sign_message(private_key, self.hash.encode())
+            self.merkle_proof = None
             return True
         except Exception as e:
             logging.error(f"Signing failed for {self.node_id}: {e}")
@@ -109,7 +107,7 @@ class Block:
             if not self.signature:
                 logging.error(f"No signature found for block {self.node_id}")
                 return False
-            public_key.verify(self.signature, self.hash.encode(), ec.ECDSA(hashes.SHA256()))
+            verify_message(public_key, self.node_id, self.signature, self.hash.encode(), self.signature_scheme, self.merkle_proof)
             return True
         except Exception as e:
             logging.error(f"Signature verification failed for {self.node_id}: {e}")
@@ -117,22 +115,34 @@ class Block:
 
 # کلاس بلاک‌چین
 class Blockchain:
-    def __init__(self):
+    def __init__(self, rows=None):
         self.chain = []
         self.cache = {}
-        self.load_from_db()
+        self.pending = PendingSeals(save_to_db)
+        self.seed_from_output()
+        self.load_from_db(rows)
 
-    def load_from_db(self):
-        conn = sqlite3.connect(input_db)
-        c = conn.cursor()
-        c.execute("SELECT * FROM blocks")
-        rows = c.fetchall()
+    # پنجره تراکم هر نود در اجرای افزایشی از آخرین بلاک‌های خروجی قبلی ادامه پیدا می‌کند نه از پنجره خالی
+    def seed_from_output(self):
+        for row in seed_rows(output_db, "congestion_blocks", ("timestamp", "node_id", "traffic_type", "traffic_volume",
+                                                              "network_health", "latency", "previous_hash"), 4):
+            block = Block(row[0], row[1], {"volume": row[3], "type": row[2]}, {"status": row[4], "latency": row[5]}, row[6])
+            self.cache.setdefault(row[1], []).append(block)
+
+    def load_from_db(self, rows=None):
+        if rows is None:
+            conn = sqlite3.connect(input_db)
+            c = conn.cursor()
+            c.execute("SELECT * FROM blocks")
+            rows = c.fetchall()
+            conn.close()
+        else:
+            rows = list(rows)
         for row in tqdm(rows, desc="Loading blocks from DB", file=sys.stdout):
             traffic_layer = {"volume": row[3], "type": row[2]}
             health_layer = {"status": row[4], "latency": row[5]}
             block = Block(row[0], row[1], traffic_layer, health_layer, row[6])
             block.hash = row[7]
-            block.sign_block(node_keys[row[1]])
             self.chain.append(block)
             if row[1] not in self.cache:
                 self.cache[row[1]] = []
@@ -140,20 +150,15 @@ class Blockchain:
             if len(self.cache[row[1]]) > 4:
                 self.cache[row[1]].pop(0)
             tqdm.write(f"Loaded block for Node {row[1]} at {row[0]}")
-        conn.close()
         print(f"Loaded {len(rows)} blocks from {input_db}")
 
     def add_block(self, block):
-        if not block.verify_signature(node_public_keys[block.node_id]):
-            logging.error(f"Invalid signature for block {block.node_id}, block discarded")
-            return False
         self.chain.append(block)
         if block.node_id not in self.cache:
             self.cache[block.node_id] = []
         self.cache[block.node_id].append(block)
         if len(self.cache[block.node_id]) > 4:
             self.cache[block.node_id].pop(0)
-        save_to_db(block)
         return True
 
     def detect_congestion(self, node_id):
@@ -178,39 +183,59 @@ class Blockchain:
         return {"is_congested": is_congested, "score": round(congestion_score, 2), "impact": round(latency_impact, 2), "level": level}
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         block_limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         init_db()
-        blockchain = Blockchain()
-        total_blocks = len(blockchain.chain[1:]) if not block_limit else min(block_limit, len(blockchain.chain[1:]))
+        after_rowid, last_rowid = 0, None
+        if upstream is None:
+            upstream, after_rowid, last_rowid = prepare_incremental(output_db, input_db, "blocks", ["congestion_blocks"],
+                                                                    block_limit, genesis=True)
+        else:
+            after_rowid, last_rowid = fused_watermarks(output_db, input_db, "blocks", "congestion_blocks")
+        blockchain = Blockchain(upstream)
+        # بلاک جنسیس فقط در اولین اجرا در ورودی است
+        pending_blocks = blockchain.chain[1:] if after_rowid == 0 else blockchain.chain[:]
+        total_blocks = len(pending_blocks) if not block_limit else min(block_limit, len(pending_blocks))
         processed_blocks = 0
         
         def process_block(block):
             congestion_layer = blockchain.detect_congestion(block.node_id)
             new_block = Block(block.timestamp, block.node_id, block.traffic_layer, block.health_layer, block.previous_hash, congestion_layer)
             new_block.hash = block.hash
-            new_block.sign_block(node_keys[block.node_id])
             if blockchain.add_block(new_block):
                 return new_block
             return None
 
         with ThreadPoolExecutor() as executor:
-            blocks_to_process = blockchain.chain[1:total_blocks + 1] if block_limit else blockchain.chain[1:]
-            new_blocks = list(tqdm(executor.map(process_block, blocks_to_process), total=total_blocks, desc="Detecting Congestion", file=sys.stdout))
-            for idx, block in enumerate(new_blocks):
+            blocks_to_process = pending_blocks[:total_blocks]
+            new_blocks = []
+            # نتایج به ترتیب ورودی امضا و ذخیره می‌شوند تا پیوند previous_hash خروجی حفظ شود
+            for idx, block in enumerate(tqdm(executor.map(process_block, blocks_to_process), total=total_blocks, desc="Detecting Congestion", file=sys.stdout)):
+                new_blocks.append(block)
                 if block:
+                    blockchain.pending.add(block)
                     processed_blocks += 1
                     tqdm.write(f"Processed {idx + 1}/{total_blocks} blocks - Node: {block.node_id}, Congestion: {block.congestion_layer['level']}")
+        discarded = blockchain.pending.seal()
+        processed_blocks -= discarded
+
+        commit_watermark(output_db, input_db, "blocks", last_rowid, "congestion_blocks", discarded)
 
         # گزارش خلاصه
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM congestion_blocks WHERE congestion_level = 'High'")
-        high_congestion = c.fetchone()[0]
-        c.execute("SELECT AVG(congestion_score) FROM congestion_blocks")
-        avg_score = c.fetchone()[0] or 0.0
-        conn.close()
+        if writers_persist():
+            flush_writers(output_db)
+            conn = sqlite3.connect(output_db)
+            c = conn.cursor()
+            c.execute("SELECT COUNT(*) FROM congestion_blocks WHERE congestion_level = 'High'")
+            high_congestion = c.fetchone()[0]
+            c.execute("SELECT AVG(congestion_score) FROM congestion_blocks")
+            avg_score = c.fetchone()[0] or 0.0
+            conn.close()
+        else:
+            done_blocks = [b for b in new_blocks if b]
+            high_congestion = sum(1 for b in done_blocks if b.congestion_layer["level"] == "High")
+            avg_score = sum(b.congestion_layer["score"] for b in done_blocks) / len(done_blocks) if done_blocks else 0.0
         
         summary = {
             "total_blocks": len(blockchain.chain),
@@ -232,6 +257,8 @@ def main():
             "summary": "Failed to process blocks",
             "error": str(e)
         }
+    finally:
+        close_writers(output_db)
 
 if __name__ == "__main__":
     result = main()
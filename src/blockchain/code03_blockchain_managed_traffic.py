@@ -1,11 +1,11 @@
 import os
-import random
 import hashlib
 import time
 import sqlite3
 import json
 import logging
 from datetime import datetime
+from itertools import islice
 import sys
 from tqdm import tqdm
 from pathlib import Path
@@ -19,31 +19,38 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "traffic_data.db")
-output_db = os.path.join(RESULT_DIR, "managed_traffic.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, close_writers
+from src.blockchain.watermark import prepare_incremental, commit_watermark, upstream_watermark
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.node_state import NodeStateTable
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+input_db = stage_db("traffic_data.db")
+output_db = stage_db("managed_traffic.db")
 
 # اسم جدول ورودی
 INPUT_TABLE_NAME = "blocks"
 
 # گراف نودها
-nodes = [f"Node_{i}" for i in range(1, 11)] + ["Genesis"]
-graph = {node: {"neighbors": random.sample([n for n in nodes if n != node], random.randint(1, 3)), 
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]} 
-         for node in nodes}
+topology = load_topology()
+nodes = topology.node_ids() + ["Genesis"]
 
 # وضعیت نودها (شامل Genesis)
-node_status = {
-    node: {"max_capacity": 100, "current_traffic": 0, "active": True} if node != "Genesis" 
-    else {"max_capacity": 0, "current_traffic": 0, "active": False} 
-    for node in nodes
-}
+node_status = NodeStateTable(topology, max_capacity=100, current_traffic=0, active=True)
+node_status.set_node("Genesis", max_capacity=0, active=False)
 
 # بررسی وجود جدول
 def check_table_exists(db_path, table_name):
     try:
         conn = sqlite3.connect(db_path)
         c = conn.cursor()
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+        c.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (table_name,))
         result = c.fetchone()
         conn.close()
         return result is not None
@@ -62,20 +69,17 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS managed_blocks
                  (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL, network_health TEXT,
                   latency REAL, previous_hash TEXT, block_hash TEXT, congestion_level TEXT, 
-                  congestion_score REAL, latency_impact REAL, traffic_suggestion TEXT)''')
+                  congestion_score REAL, latency_impact REAL, traffic_suggestion TEXT, timestamp_us INTEGER)''')
     conn.commit()
+    ensure_stage_indexes(conn, "managed_blocks")
     conn.close()
 
 def save_to_db(block):
-    conn = sqlite3.connect(output_db)
-    c = conn.cursor()
-    c.execute("INSERT INTO managed_blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    get_writer(output_db).write("managed_blocks",
               (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
                block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
                block.congestion_layer["level"], block.congestion_layer["score"], 
-               block.congestion_layer["impact"], block.traffic_suggestion))
-    conn.commit()
-    conn.close()
+               block.congestion_layer["impact"], block.traffic_suggestion, epoch_us(block.timestamp)))
 
 # کلاس بلاک
 class ManagedTrafficBlock:
@@ -90,6 +94,11 @@ class ManagedTrafficBlock:
         self.hash = self.calculate_hash()
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("managed", (self.timestamp, self.node_id, self.traffic_layer["type"], self.traffic_layer["volume"],
+                                          self.health_layer["status"], self.health_layer["latency"], self.previous_hash,
+                                          self.congestion_layer["level"], self.congestion_layer["score"], self.congestion_layer["impact"],
+                                          self.traffic_suggestion))
         block_string = json.dumps({
             "timestamp": self.timestamp, "node_id": self.node_id, "traffic_layer": self.traffic_layer,
             "health_layer": self.health_layer, "previous_hash": self.previous_hash, "congestion_layer": self.congestion_layer,
@@ -100,7 +109,7 @@ class ManagedTrafficBlock:
 # پخش ترافیک
 def redistribute_traffic(node_id, excess_traffic):
     try:
-        neighbors = [n for n in graph[node_id]["neighbors"] if n != "Genesis" and node_status[n]["active"]]
+        neighbors = [n for n in topology.neighbors(node_id) if n != "Genesis" and node_status[n]["active"]]
         available_neighbors = [
             n for n in neighbors 
             if node_status[n]["current_traffic"] + excess_traffic / len(neighbors) <= node_status[n]["max_capacity"]
@@ -166,26 +175,29 @@ def suggest_traffic_management(block):
 
 # کلاس بلاک‌چین
 class TrafficBlockchain:
-    def __init__(self, limit=None):
+    def __init__(self, limit=None, rows=None):
         self.chain = []
         self.processed_blocks = []
         self.cache = {}
-        self.load_from_db(limit)
+        self.load_from_db(limit, rows)
 
-    def load_from_db(self, limit):
+    def load_from_db(self, limit, rows=None):
         try:
-            if not check_table_exists(input_db, INPUT_TABLE_NAME):
+            if rows is not None:
+                rows = list(islice(rows, limit)) if limit else list(rows)
+            elif not check_table_exists(input_db, INPUT_TABLE_NAME):
                 logging.error(f"Table '{INPUT_TABLE_NAME}' does not exist in the database")
                 self.chain = []
                 return
-
-            conn = sqlite3.connect(input_db)
-            c = conn.cursor()
-            query = f"SELECT * FROM {INPUT_TABLE_NAME}"
-            if limit:
-                query += f" LIMIT {limit}"
-            c.execute(query)
-            rows = c.fetchall()
+            else:
+                conn = sqlite3.connect(input_db)
+                c = conn.cursor()
+                query = f"SELECT * FROM {INPUT_TABLE_NAME}"
+                if limit:
+                    query += f" LIMIT {limit}"
+                c.execute(query)
+                rows = c.fetchall()
+                conn.close()
             for row in tqdm(rows, desc="Loading blocks from DB", file=sys.stdout):
                 traffic_layer = {"volume": float(row[3] or 0.0), "type": row[2] or "Data"}
                 health_layer = {"status": row[4] or "Normal", "latency": float(row[5] or 0.0)}
@@ -204,7 +216,6 @@ class TrafficBlockchain:
                 if len(self.cache[row[1]]) > 4:
                     self.cache[row[1]].pop(0)
                 tqdm.write(f"Loaded block for Node {row[1]} at {row[0]}")
-            conn.close()
         except sqlite3.Error as e:
             logging.error(f"Database load error: {e}")
             self.chain = []
@@ -224,11 +235,16 @@ class TrafficBlockchain:
         save_to_db(new_block)
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         init_db()
-        traffic_blockchain = TrafficBlockchain(limit)
+        last_rowid = None
+        if upstream is None:
+            upstream, _, last_rowid = prepare_incremental(output_db, input_db, INPUT_TABLE_NAME, ["managed_blocks"], limit)
+        else:
+            last_rowid = upstream_watermark(input_db, INPUT_TABLE_NAME)
+        traffic_blockchain = TrafficBlockchain(limit, upstream)
         processed_blocks = 0
         high_congestion_count = 0
 
@@ -239,6 +255,8 @@ def main():
                 high_congestion_count += 1
             print(f"Processed block - Node: {block.node_id}, Congestion: {block.congestion_layer['level']}")
 
+        commit_watermark(output_db, input_db, INPUT_TABLE_NAME, last_rowid, "managed_blocks")
+
         summary = {
             "total_blocks": processed_blocks,
             "high_congestion_count": high_congestion_count
@@ -258,6 +276,8 @@ def main():
             "summary": "Failed to process blocks",
             "error": str(e)
         }
+    finally:
+        close_writers(output_db)
 
 if __name__ == "__main__":
     result = main()
@@ -5,9 +5,7 @@ import sqlite3
 import json
 import random
 from tqdm import tqdm
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 import sys
 from pathlib import Path
 
@@ -17,21 +15,28 @@ sys.stdout.reconfigure(line_buffering=True)
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "managed_traffic.db")
-output_db = os.path.join(RESULT_DIR, "new_orders.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, flush_writers, close_writers, writers_persist
+from src.blockchain.watermark import prepare_incremental, commit_watermark, fused_watermarks
+from src.blockchain.signing import PendingSeals, sign_message, verify_message
+from src.blockchain.signers import encode_signature, decode_signature
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+input_db = stage_db("managed_traffic.db")
+output_db = stage_db("new_orders.db")
 
 # تنظیمات لاگینگ
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # گراف نودها
-nodes = [f"Node_{i}" for i in range(1, 11)] + ["Genesis"]
-graph = {node: {"neighbors": random.sample(nodes, random.randint(1, 3)), 
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]} 
-         for node in nodes}
-
-# تولید کلیدهای ECDSA
-node_keys = {node: ec.generate_private_key(ec.SECP256R1(), default_backend()) for node in nodes}
-node_public_keys = {node: key.public_key() for node, key in node_keys.items()}
+topology = load_topology()
+nodes = topology.node_ids() + ["Genesis"]
 
 # دیتابیس خروجی
 def init_db():
@@ -42,21 +47,19 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS new_orders
                  (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL, network_health TEXT,
                   latency REAL, previous_hash TEXT, block_hash TEXT, congestion_level TEXT, congestion_score REAL,
-                  latency_impact REAL, traffic_suggestion TEXT, order_type TEXT, signature TEXT)''')
+                  latency_impact REAL, traffic_suggestion TEXT, order_type TEXT, signature TEXT, timestamp_us INTEGER)''')
     conn.commit()
+    ensure_stage_indexes(conn, "new_orders")
     conn.close()
     print(f"Output database initialized at {output_db}")
 
 def save_to_db(block):
-    conn = sqlite3.connect(output_db)
-    c = conn.cursor()
-    c.execute("INSERT INTO new_orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    get_writer(output_db).write("new_orders",
               (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
                block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
                block.congestion_layer["level"], block.congestion_layer["score"], block.congestion_layer["impact"],
-               block.traffic_suggestion, block.order_type, block.signature.hex() if block.signature else None))
-    conn.commit()
-    conn.close()
+               block.traffic_suggestion, block.order_type, encode_signature(block.signature, block.signature_scheme, block.merkle_proof) if block.signature else None,
+               epoch_us(block.timestamp)))
 
 # کلاس بلاک
 class TrafficBlock:
@@ -71,8 +74,15 @@ class TrafficBlock:
         self.order_type = order_type
         self.hash = self.calculate_hash()
         self.signature = signature
+        self.signature_scheme = None
+        self.merkle_proof = None
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("order", (self.timestamp, self.node_id, self.traffic_layer["type"], self.traffic_layer["volume"],
+                                        self.health_layer["status"], self.health_layer["latency"], self.previous_hash,
+                                        self.congestion_layer["level"], self.congestion_layer["score"], self.congestion_layer["impact"],
+                                        self.traffic_suggestion, self.order_type))
         block_string = json.dumps({
             "timestamp": self.timestamp,
             "node_id": self.node_id,
@@ -87,8 +97,8 @@ class TrafficBlock:
 
     def sign_block(self, private_key):
         try:
-            message = self.hash.encode()
-            self.signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+            self.signature, self.signature_scheme = sign_message(private_key, self.hash.encode())
+            self.merkle_proof = None
             return True
         except Exception as e:
             logging.error(f"Signing failed for {self.node_id}: {e}")
@@ -99,7 +109,7 @@ class TrafficBlock:
             if not self.signature:
                 logging.error(f"No signature found for block {self.node_id}")
                 return False
-            public_key.verify(self.signature, self.hash.encode(), ec.ECDSA(hashes.SHA256()))
+            verify_message(public_key, self.node_id, self.signature, self.hash.encode(), self.signature_scheme, self.merkle_proof)
             return True
         except Exception as e:
             logging.error(f"Signature verification failed for {self.node_id}: {e}")
@@ -110,7 +120,7 @@ class TrafficBlock:
             traffic_type = self.traffic_layer["type"]
             volume = self.traffic_layer["volume"]
             health = self.health_layer["status"]
-            neighbors = graph[self.node_id]["neighbors"]
+            neighbors = topology.neighbors(self.node_id)
             if traffic_type == "Priority":
                 return f"Prioritize {traffic_type} traffic, allocate maximum bandwidth to {self.node_id}"
             elif volume > 70:
@@ -125,31 +135,37 @@ class TrafficBlock:
 
 # کلاس بلاک‌چین
 class TrafficBlockchain:
-    def __init__(self):
+    def __init__(self, rows=None):
         self.chain = []
         self.cache = {}
-        self.load_from_db()
+        self.pending = PendingSeals(save_to_db)
+        self.load_from_db(rows)
 
-    def load_from_db(self):
-        conn = sqlite3.connect(input_db)
-        c = conn.cursor()
-        c.execute("SELECT * FROM managed_blocks")
-        rows = c.fetchall()
+    def load_from_db(self, rows=None):
+        if rows is None:
+            conn = sqlite3.connect(input_db)
+            c = conn.cursor()
+            c.execute("SELECT * FROM managed_blocks")
+            rows = c.fetchall()
+            conn.close()
+        else:
+            rows = list(rows)
         for row in tqdm(rows, desc="Loading blocks from DB", file=sys.stdout):
             traffic_layer = {"volume": row[3], "type": row[2]}
             health_layer = {"status": row[4], "latency": row[5]}
             congestion_layer = {"is_congested": 1 if row[8] in ["Medium", "High"] else 0, 
                                "score": row[9], "impact": row[10], "level": row[8]}
             traffic_suggestion = row[11]
-            signature = bytes.fromhex(row[12]) if len(row) > 12 and row[12] else None
+            # managed_blocks ستون امضا ندارد؛ ستون 12 در جدول‌های جدید timestamp_us است
+            signature, signature_scheme, merkle_proof = decode_signature(row[12]) if len(row) > 12 and isinstance(row[12], str) else (None, None, None)
             order_type = "Priority" if row[8] in ["Medium", "High"] and random.random() < 0.3 else "Standard"
             if order_type == "Priority":
                 traffic_layer["type"] = "Priority"
             block = TrafficBlock(row[0], row[1], traffic_layer, health_layer, row[6], congestion_layer, 
                                 traffic_suggestion, order_type, signature)
             block.hash = row[7]
-            if not block.signature:
-                block.sign_block(node_keys[row[1]])
+            block.signature_scheme = signature_scheme
+            block.merkle_proof = merkle_proof
             self.chain.append(block)
             if row[1] not in self.cache:
                 self.cache[row[1]] = []
@@ -157,7 +173,6 @@ class TrafficBlockchain:
             if len(self.cache[row[1]]) > 4:
                 self.cache[row[1]].pop(0)
             tqdm.write(f"Loaded block for Node {row[1]} at {row[0]}")
-        conn.close()
         print(f"Loaded {len(rows)} blocks from {input_db}")
 
     def add_ordered_block(self, block):
@@ -165,31 +180,34 @@ class TrafficBlockchain:
         order_type = block.order_type
         new_block = TrafficBlock(block.timestamp, block.node_id, block.traffic_layer, block.health_layer,
                                  block.previous_hash, block.congestion_layer, suggestion, order_type)
-        new_block.sign_block(node_keys[block.node_id])
-        if not new_block.verify_signature(node_public_keys[block.node_id]):
-            logging.error(f"Invalid signature for block {new_block.node_id}, block discarded")
-            return False
         self.chain.append(new_block)
         if block.node_id not in self.cache:
             self.cache[block.node_id] = []
         self.cache[block.node_id].append(new_block)
         if len(self.cache[block.node_id]) > 4:
             self.cache[block.node_id].pop(0)
-        save_to_db(new_block)
+        self.pending.add(new_block)
         return True
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         block_limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         init_db()
-        traffic_blockchain = TrafficBlockchain()
-        total_blocks = len(traffic_blockchain.chain[1:]) if not block_limit else min(block_limit, len(traffic_blockchain.chain[1:]))
+        after_rowid, last_rowid = 0, None
+        if upstream is None:
+            upstream, after_rowid, last_rowid = prepare_incremental(output_db, input_db, "managed_blocks", ["new_orders"],
+                                                                    block_limit, genesis=True)
+        else:
+            after_rowid, last_rowid = fused_watermarks(output_db, input_db, "managed_blocks", "new_orders")
+        traffic_blockchain = TrafficBlockchain(upstream)
+        pending_blocks = traffic_blockchain.chain[1:] if after_rowid == 0 else traffic_blockchain.chain[:]
+        total_blocks = len(pending_blocks) if not block_limit else min(block_limit, len(pending_blocks))
         processed_blocks = 0
         priority_orders = 0
         total_congested = 0
         
-        for idx, block in enumerate(tqdm(traffic_blockchain.chain[1:total_blocks + 1] if block_limit else traffic_blockchain.chain[1:], desc="Processing Orders", file=sys.stdout)):
+        for idx, block in enumerate(tqdm(pending_blocks[:total_blocks], desc="Processing Orders", file=sys.stdout)):
             if traffic_blockchain.add_ordered_block(block):
                 processed_blocks += 1
                 if block.order_type == "Priority":
@@ -197,13 +215,24 @@ def main():
                 if block.congestion_layer["level"] in ["Medium", "High"]:
                     total_congested += 1
                 tqdm.write(f"Processed {idx + 1}/{total_blocks} blocks - Node: {block.node_id}, Order Type: {block.order_type}")
+        discarded = traffic_blockchain.pending.seal()
+        processed_blocks -= discarded
+
+        commit_watermark(output_db, input_db, "managed_blocks", last_rowid, "new_orders", discarded)
 
         # گزارش خلاصه
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("SELECT node_id, COUNT(*) FROM new_orders WHERE congestion_level IN ('Medium', 'High') GROUP BY node_id")
-        congested_nodes = dict(c.fetchall())
-        conn.close()
+        if writers_persist():
+            flush_writers(output_db)
+            conn = sqlite3.connect(output_db)
+            c = conn.cursor()
+            c.execute("SELECT node_id, COUNT(*) FROM new_orders WHERE congestion_level IN ('Medium', 'High') GROUP BY node_id")
+            congested_nodes = dict(c.fetchall())
+            conn.close()
+        else:
+            congested_nodes = {}
+            for block in traffic_blockchain.chain[-processed_blocks:] if processed_blocks else []:
+                if block.congestion_layer["level"] in ["Medium", "High"]:
+                    congested_nodes[block.node_id] = congested_nodes.get(block.node_id, 0) + 1
 
         summary = {
             "total_blocks": processed_blocks,
@@ -226,6 +255,8 @@ def main():
             "summary": "Failed to process blocks",
             "error": str(e)
         }
+    finally:
+        close_writers(output_db)
 
 if __name__ == "__main__":
     result = main()
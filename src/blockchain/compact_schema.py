@@ -0,0 +1,254 @@
+import os
+import sys
+import sqlite3
+import logging
+from pathlib import Path
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+RESULT_DIR = ROOT_DIR / "result"
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+# تبدیل جدول‌های مراحل به طرح فشرده هنگام آماده‌سازی دیتابیس هر مرحله
+COMPACT_SCHEMA = "--compact-schema" in sys.argv or os.getenv("COMPACT_SCHEMA") == "True"
+
+# نسخه طرح هر جدول: 1 طرح متنی اولیه، 2 طرح فشرده با کد عددی و امضای باینری
+LEGACY_SCHEMA_VERSION = 1
+COMPACT_SCHEMA_VERSION = 2
+VERSION_TABLE = "schema_versions"
+
+# ستون‌های دسته‌ای و جدول دیکشنری هر کدام؛ predicted_congestion همان مقادیر congestion_level را دارد
+ENUM_COLUMNS = {
+    "node_id": "node_id",
+    "traffic_type": "traffic_type",
+    "network_health": "network_health",
+    "congestion_level": "congestion_level",
+    "predicted_congestion": "congestion_level",
+}
+SIGNATURE_SCHEME_ENUM = "signature_scheme"
+
+# نام جدول داده فشرده پشت view هم‌نام جدول قدیمی
+def data_table(table):
+    return f"{table}_data"
+
+def _enum_table(family):
+    return f"enum_{family}"
+
+def _columns(conn, table):
+    return [(row[1], (row[2] or "").upper()) for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def is_compact(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?", (table,)).fetchone() is not None \
+        and conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (data_table(table),)).fetchone() is not None
+
+# جدولی که ردیف‌ها واقعاً در آن ذخیره می‌شوند (برای ایندکس، حذف و مهاجرت ستون)
+def storage_table(conn, table):
+    return data_table(table) if is_compact(conn, table) else table
+
+def schema_version(conn, table):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (VERSION_TABLE,)).fetchone():
+        row = conn.execute(f"SELECT version FROM {VERSION_TABLE} WHERE table_name = ?", (table,)).fetchone()
+        if row:
+            return row[0]
+    return COMPACT_SCHEMA_VERSION if is_compact(conn, table) else LEGACY_SCHEMA_VERSION
+
+def _strict_type(declared):
+    if declared in ("INTEGER", "REAL", "TEXT", "BLOB"):
+        return declared
+    return "TEXT" if declared in ("DATETIME", "VARCHAR") else "ANY"
+
+def _data_columns(columns):
+    result = []
+    for name, declared in columns:
+        if name in ENUM_COLUMNS:
+            result.append((name, "INTEGER"))
+        elif name == "signature":
+            result.extend([("signature", "BLOB"), ("signature_scheme", "INTEGER"), ("signature_proof", "TEXT")])
+        else:
+            result.append((name, _strict_type(declared)))
+    return result
+
+# کدگذاری ردیف‌های منطقی جدول به ردیف‌های جدول داده فشرده
+class TableCodec:
+    def __init__(self, conn, table, columns=None):
+        self.table = table
+        self.columns = [name for name, _ in (columns or _columns(conn, table)) if name != "rowid"]
+        data_columns = [name for name, _ in _data_columns([(name, "") for name in self.columns])]
+        self.insert_sql = (f"INSERT INTO {data_table(table)} ({', '.join(data_columns)}) "
+                           f"VALUES ({', '.join('?' * len(data_columns))})")
+        self.codes = {}
+
+    def code(self, conn, family, value):
+        if value is None:
+            return None
+        value = str(value)
+        codes = self.codes.setdefault(family, {})
+        if value not in codes:
+            conn.execute(f"INSERT OR IGNORE INTO {_enum_table(family)} (value) VALUES (?)", (value,))
+            codes[value] = conn.execute(f"SELECT code FROM {_enum_table(family)} WHERE value = ?", (value,)).fetchone()[0]
+        return codes[value]
+
+    # امضا به صورت (بایت‌ها، کد الگوریتم، اثبات)؛ متنی که دقیقاً قابل بازسازی نباشد بدون تغییر در ستون اثبات می‌ماند
+    def encode_signature(self, conn, text):
+        if not text:
+            return None, None, text or None
+        parts = str(text).split(":", 2)
+        scheme, hex_part = (None, parts[0]) if len(parts) == 1 else (parts[0], parts[1])
+        try:
+            signature = bytes.fromhex(hex_part)
+        except ValueError:
+            return None, None, text
+        if not signature or signature.hex() != hex_part or (scheme is not None and not scheme):
+            return None, None, text
+        return signature, self.code(conn, SIGNATURE_SCHEME_ENUM, scheme), parts[2] if len(parts) > 2 else None
+
+    def encode(self, conn, row):
+        row = tuple(row) + (None,) * (len(self.columns) - len(row))
+        encoded = []
+        for name, value in zip(self.columns, row):
+            if name in ENUM_COLUMNS:
+                encoded.append(self.code(conn, ENUM_COLUMNS[name], value))
+            elif name == "signature":
+                encoded.extend(self.encode_signature(conn, value))
+            else:
+                encoded.append(value)
+        return encoded
+
+    # با columns ردیف‌ها بر اساس نام ستون به ترتیب ستون‌های جدول چیده می‌شوند
+    def insert(self, conn, rows, columns=None):
+        if columns:
+            index = {name: i for i, name in enumerate(columns)}
+            rows = [tuple(row[index[name]] if name in index else None for name in self.columns) for row in rows]
+        conn.executemany(self.insert_sql, [self.encode(conn, row) for row in rows])
+
+# کدگذار جدول فشرده یا None برای جدول‌های متنی
+def table_codec(conn, table):
+    return TableCodec(conn, table) if is_compact(conn, table) else None
+
+# درج ردیف‌ها در هر دو طرح؛ بدون columns به ترتیب ستون‌های جدول و با columns بر اساس نام ستون‌ها
+def insert_rows(conn, table, rows, codec=None, columns=None):
+    rows = [tuple(row) for row in rows]
+    if not rows:
+        return
+    codec = codec or table_codec(conn, table)
+    if codec is not None:
+        codec.insert(conn, rows, columns)
+    elif columns:
+        conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows)
+    else:
+        conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+
+def _decode_expression(name):
+    if name in ENUM_COLUMNS:
+        return f"(SELECT value FROM {_enum_table(ENUM_COLUMNS[name])} WHERE code = d.{name}) AS {name}"
+    if name == "signature":
+        return (f"CASE WHEN d.signature IS NULL THEN d.signature_proof ELSE "
+                f"COALESCE((SELECT value FROM {_enum_table(SIGNATURE_SCHEME_ENUM)} WHERE code = d.signature_scheme) || ':', '') "
+                f"|| lower(hex(d.signature)) || COALESCE(':' || d.signature_proof, '') END AS signature")
+    return f"d.{name} AS {name}"
+
+def _ensure_support_tables(conn):
+    for family in set(ENUM_COLUMNS.values()) | {SIGNATURE_SCHEME_ENUM}:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {_enum_table(family)} "
+                     f"(code INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE) STRICT")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (table_name TEXT PRIMARY KEY, version INTEGER NOT NULL) STRICT")
+
+# view هم‌نام جدول با ستون‌های منطقی names و تریگرهای درج و حذف روی جدول داده
+def _create_view(conn, table, names):
+    data = data_table(table)
+    data_columns = _data_columns([(name, "") for name in names])
+    conn.execute(f"CREATE VIEW {table} AS SELECT {', '.join(_decode_expression(name) for name in names)}, "
+                 f"d.id AS rowid FROM {data} AS d")
+    # نویسنده‌هایی که با نام ستون مستقیماً در view درج می‌کنند؛ امضا در این مسیر متنی در ستون اثبات می‌ماند
+    values = []
+    for name, _ in data_columns:
+        if name in ENUM_COLUMNS:
+            values.append(f"(SELECT code FROM {_enum_table(ENUM_COLUMNS[name])} WHERE value = NEW.{name})")
+        elif name in ("signature", "signature_scheme"):
+            values.append("NULL")
+        elif name == "signature_proof":
+            values.append("NEW.signature")
+        else:
+            values.append(f"NEW.{name}")
+    enum_inserts = "".join(f"INSERT OR IGNORE INTO {_enum_table(ENUM_COLUMNS[name])} (value) "
+                           f"SELECT NEW.{name} WHERE NEW.{name} IS NOT NULL; "
+                           for name in names if name in ENUM_COLUMNS)
+    conn.execute(f"CREATE TRIGGER {table}_insert INSTEAD OF INSERT ON {table} BEGIN {enum_inserts}"
+                 f"INSERT INTO {data} ({', '.join(name for name, _ in data_columns)}) VALUES ({', '.join(values)}); END")
+    conn.execute(f"CREATE TRIGGER {table}_delete INSTEAD OF DELETE ON {table} "
+                 f"BEGIN DELETE FROM {data} WHERE id = OLD.rowid; END")
+
+# تبدیل جدول متنی به جدول داده STRICT با کد عددی و امضای BLOB؛ view هم‌نام ستون‌های قبلی را به همان ترتیب برمی‌گرداند
+# و ستون rowid آخر view همان rowid قبلی است تا watermark و checkpoint ممیزی معتبر بمانند
+def compact_table(conn, table, batch_size=10000):
+    if is_compact(conn, table):
+        return False
+    columns = _columns(conn, table)
+    if not columns or any(name in ("rowid", "id") for name, _ in columns):
+        return False
+    data = data_table(table)
+    data_columns = _data_columns(columns)
+    names = [name for name, _ in columns]
+    if conn.in_transaction:
+        conn.commit()
+    with conn:
+        # کل تبدیل در یک تراکنش تا در صورت خطا جدول قبلی دست‌نخورده بماند
+        conn.execute("BEGIN IMMEDIATE")
+        _ensure_support_tables(conn)
+        conn.execute(f"CREATE TABLE {data} (id INTEGER PRIMARY KEY, "
+                     f"{', '.join(f'{name} {kind}' for name, kind in data_columns)}) STRICT")
+        codec = TableCodec(conn, table, columns)
+        copy_sql = (f"INSERT INTO {data} (id, {', '.join(name for name, _ in data_columns)}) "
+                    f"VALUES ({', '.join('?' * (len(data_columns) + 1))})")
+        cursor = conn.execute(f"SELECT rowid, * FROM {table} ORDER BY rowid")
+        copied = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            conn.executemany(copy_sql, [[row[0]] + codec.encode(conn, row[1:]) for row in rows])
+            copied += len(rows)
+        conn.execute(f"DROP TABLE {table}")
+        _create_view(conn, table, names)
+        conn.execute(f"INSERT OR REPLACE INTO {VERSION_TABLE} VALUES (?, ?)", (table, COMPACT_SCHEMA_VERSION))
+    logging.info(f"Converted {table} to the compact schema ({copied} rows)")
+    return True
+
+# اضافه کردن ستون به جدول در هر دو طرح؛ در طرح فشرده ستون به جدول داده اضافه و view و تریگرها دوباره ساخته می‌شوند
+def add_column(conn, table, name, kind):
+    if not is_compact(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {kind}")
+        return
+    names = [column for column, _ in _columns(conn, table) if column != "rowid"]
+    conn.execute(f"ALTER TABLE {data_table(table)} ADD COLUMN {name} {_strict_type(kind)}")
+    conn.execute(f"DROP TRIGGER IF EXISTS {table}_insert")
+    conn.execute(f"DROP TRIGGER IF EXISTS {table}_delete")
+    conn.execute(f"DROP VIEW {table}")
+    _create_view(conn, table, names + [name])
+
+# مهاجرت همه جدول‌های مراحل یک پوشه نتایج به طرح فشرده و گزارش حجم فایل‌ها
+def migrate(result_dir=RESULT_DIR, vacuum=True):
+    from src.blockchain.chain_db import stage_db
+    from src.blockchain.timestamps import STAGE_TABLES, ensure_stage_indexes
+    report = {}
+    for table, db_file in STAGE_TABLES.items():
+        db_path = stage_db(db_file, result_dir)
+        if not os.path.exists(db_path):
+            continue
+        before = os.path.getsize(db_path)
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            ensure_stage_indexes(conn, table, compact=True)
+            if vacuum:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                conn.execute("VACUUM")
+            report[table] = (before, os.path.getsize(db_path), schema_version(conn, table))
+        finally:
+            conn.close()
+    return report
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for table, (before, after, version) in migrate(vacuum="--no-vacuum" not in sys.argv).items():
+        print(f"{table:<22} v{version}  {before / 1024:10.1f} KB -> {after / 1024:10.1f} KB")
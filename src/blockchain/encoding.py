@@ -0,0 +1,47 @@
+import os
+import struct
+import hashlib
+
+# کدگذاری باینری ثابت برای هش بلاک‌ها؛ HASH_ENCODING=json رفتار قدیمی json.dumps را نگه می‌دارد
+HASH_ENCODING = os.getenv("HASH_ENCODING", "binary")
+ENCODING_VERSION = 1
+
+# شناسه چیدمان هر نوع بلاک؛ فیلدها به ترتیب ستون‌های جدول همان مرحله کدگذاری می‌شوند
+# (timestamp, node_id, traffic_type, traffic_volume, network_health, latency, previous_hash, ...)
+LAYOUTS = {
+    "initial": 1,     # code01: ... nonce
+    "congestion": 2,  # code02: ... congestion_level, congestion_score, latency_impact
+    "managed": 3,     # code03: ... congestion_level, congestion_score, latency_impact, traffic_suggestion
+    "order": 4,       # code04/05 و حلقه ریل‌تایم: ... traffic_suggestion, order_type
+    "smart": 5,       # code09: ... congestion_level, traffic_redistribution, event_type, predicted_congestion
+    "healing": 6,     # code10: ... healing_action, predicted_congestion
+    "optimized": 7,   # code11: ... predicted_congestion, resource_allocation
+}
+
+_HEADER = struct.Struct("<BBH")
+_STRING = struct.Struct("<BI")
+_NUMBER = struct.Struct("<Bd")
+_NULL = b"\x00"
+
+def legacy_hashing():
+    return HASH_ENCODING == "json"
+
+# رشته‌ها با طول، اعداد به صورت double (تا 0 و 0.0 یکسان باشند) و None با برچسب جدا
+def _encode_field(value, parts):
+    if value is None:
+        parts.append(_NULL)
+    elif isinstance(value, str):
+        data = value.encode()
+        parts.append(_STRING.pack(1, len(data)))
+        parts.append(data)
+    else:
+        parts.append(_NUMBER.pack(2, float(value)))
+
+def encode_block(layout, fields):
+    parts = [_HEADER.pack(ENCODING_VERSION, LAYOUTS[layout], len(fields))]
+    for value in fields:
+        _encode_field(value, parts)
+    return b"".join(parts)
+
+def hash_block(layout, fields):
+    return hashlib.sha256(encode_block(layout, fields)).hexdigest()
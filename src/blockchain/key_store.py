@@ -0,0 +1,75 @@
+import os
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+
+from src.blockchain.signers import get_signer, EcdsaP256Signer
+from src.blockchain.topology import load_topology
+
+# مسیر ذخیره کلیدهای نودها (یک فایل PEM برای هر نود)
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+KEY_DIR = Path(os.getenv("NODE_KEY_DIR", ROOT_DIR / "result" / "keys"))
+
+# نودهای پیش‌فرض: نودهای توپولوژی مشترک (TOPOLOGY_NODES) به همراه Genesis
+def default_node_ids():
+    return load_topology().node_ids() + ["Genesis"]
+
+# کش کلیدها در پروسه تا هر کلید فقط یک بار از دیسک خوانده شود
+_private_keys = {}
+_keys_lock = threading.Lock()
+
+# کلیدهای ECDSA نام قبلی خود را نگه می‌دارند
+def _key_file(node_id, scheme):
+    if scheme == EcdsaP256Signer.name:
+        return KEY_DIR / f"{node_id}.pem"
+    return KEY_DIR / f"{node_id}.{scheme}.pem"
+
+# ساخت کلید جدید و نوشتن اتمیک روی دیسک تا مراحل موازی کلید یکدیگر را خراب نکنند
+def _create_key(node_id, scheme):
+    key = get_signer(scheme).generate_key()
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption())
+    KEY_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=KEY_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(pem)
+    try:
+        # اگر پروسه دیگری زودتر کلید را ساخته باشد همان کلید استفاده می‌شود
+        os.link(tmp_path, _key_file(node_id, scheme))
+        logging.info(f"Generated new {scheme} key for {node_id} in {KEY_DIR}")
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+
+def _load_key(node_id, scheme):
+    path = _key_file(node_id, scheme)
+    if not path.exists():
+        _create_key(node_id, scheme)
+    with open(path, "rb") as f:
+        return serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+
+# کلیدهای خصوصی نودها از مخزن مشترک برای یک الگوریتم امضا
+def load_node_keys(node_ids=None, scheme=None):
+    node_ids = default_node_ids() if node_ids is None else node_ids
+    scheme = get_signer(scheme).name
+    with _keys_lock:
+        for node_id in node_ids:
+            if (scheme, node_id) not in _private_keys:
+                _private_keys[(scheme, node_id)] = _load_key(node_id, scheme)
+        return {node_id: _private_keys[(scheme, node_id)] for node_id in node_ids}
+
+# جدول کلیدهای عمومی نودها برای تأیید امضا در همه مراحل
+def load_public_keys(node_ids=None, scheme=None):
+    return {node_id: key.public_key() for node_id, key in load_node_keys(node_ids, scheme).items()}
+
+# کلیدهای عمومی به صورت PEM برای نمایش و استفاده بیرونی
+def public_key_table(node_ids=None, scheme=None):
+    return {
+        node_id: key.public_bytes(serialization.Encoding.PEM,
+                                  serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+        for node_id, key in load_public_keys(node_ids, scheme).items()
+    }
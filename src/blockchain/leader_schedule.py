@@ -0,0 +1,52 @@
+import os
+import random
+
+# تعداد اسلات هر دوره؛ برنامه رهبران در ابتدای هر دوره از روی سهام نودها ساخته می‌شود
+EPOCH_SLOTS = int(os.getenv("EPOCH_SLOTS", "10"))
+
+# وزن سهام هر نود (همان فرمول قبلی proof_of_stake)
+def stake_weight(node):
+    return node.capacity + node.history * 10
+
+# نمونه‌بردار alias (روش Vose): ساخت O(n) و هر نمونه O(1)
+class AliasSampler:
+    def __init__(self, items, weights):
+        total = float(sum(weights))
+        if not items or total <= 0:
+            raise ValueError("Alias sampler needs at least one positive weight")
+        n = len(items)
+        self.items = list(items)
+        self.prob = [0.0] * n
+        self.alias = list(range(n))
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self, rng):
+        i = rng.randrange(len(self.items))
+        return self.items[i] if rng.random() < self.prob[i] else self.items[self.alias[i]]
+
+# برنامه رهبران یک دوره؛ seed از هش آخرین بلاک پیش از دوره گرفته می‌شود تا قابل بازسازی باشد
+class LeaderSchedule:
+    def __init__(self, nodes, epoch, seed, slots=EPOCH_SLOTS):
+        sampler = AliasSampler([node.node_id for node in nodes], [stake_weight(node) for node in nodes])
+        rng = random.Random(f"{epoch}:{seed}")
+        self.epoch = epoch
+        self.first_slot = epoch * slots
+        self.leaders = [sampler.sample(rng) for _ in range(slots)]
+
+    def __contains__(self, slot):
+        return self.first_slot <= slot < self.first_slot + len(self.leaders)
+
+    def leader(self, slot):
+        if slot not in self:
+            raise ValueError(f"Slot {slot} is outside epoch {self.epoch}")
+        return self.leaders[slot - self.first_slot]
@@ -0,0 +1,60 @@
+import hashlib
+
+# درخت مرکل روی هش بلاک‌ها؛ پیشوند جدا برای برگ و گره داخلی تا برگ جعلی ساخته نشود
+def _leaf(block_hash):
+    return hashlib.sha256(b"\x00" + block_hash.encode()).digest()
+
+def _node(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+# سطوح درخت از برگ تا ریشه؛ گره تنها در هر سطح بدون تکرار به سطح بالا می‌رود
+def _levels(block_hashes):
+    level = [_leaf(h) for h in block_hashes]
+    levels = [level]
+    while len(level) > 1:
+        level = [_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+def merkle_root(block_hashes):
+    if not block_hashes:
+        raise ValueError("Cannot build a Merkle tree without leaves")
+    return _levels(block_hashes)[-1][0].hex()
+
+# ریشه و اثبات عضویت همه برگ‌ها در یک بار ساخت درخت
+def merkle_proofs(block_hashes):
+    if not block_hashes:
+        raise ValueError("Cannot build a Merkle tree without leaves")
+    levels = _levels(block_hashes)
+    proofs = []
+    for index in range(len(block_hashes)):
+        path = []
+        position = index
+        for level in levels[:-1]:
+            sibling = position ^ 1
+            if sibling < len(level):
+                path.append(("L" if sibling < position else "R", level[sibling].hex()))
+            position //= 2
+        proofs.append(path)
+    return levels[-1][0].hex(), proofs
+
+# محاسبه ریشه از روی برگ و مسیر اثبات
+def root_from_proof(block_hash, path):
+    current = _leaf(block_hash)
+    for side, sibling in path:
+        sibling = bytes.fromhex(sibling)
+        current = _node(sibling, current) if side == "L" else _node(current, sibling)
+    return current.hex()
+
+def verify_proof(block_hash, path, root):
+    return root_from_proof(block_hash, path) == root
+
+# اثبات به صورت متن: "root/Lhex.Rhex..."
+def encode_proof(root, path):
+    return root + "/" + ".".join(side + sibling for side, sibling in path)
+
+def decode_proof(text):
+    root, _, path_text = text.partition("/")
+    path = [(item[0], item[1:]) for item in path_text.split(".") if item]
+    return root, path
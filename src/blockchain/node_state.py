@@ -0,0 +1,92 @@
+import numpy as np
+
+from src.blockchain.topology import node_index
+
+# جدول وضعیت نودها به صورت آرایه ساختاریافته NumPy (یک ردیف برای هر اندیس نود)
+NODE_STATE_DTYPE = np.dtype([
+    ("max_capacity", np.float64),
+    ("current_traffic", np.float64),
+    ("active", np.bool_),
+    ("allocated_bandwidth", np.float64),
+])
+
+# نمای سبک یک نود با همان دسترسی قبلی node_status[node]["field"]
+class NodeView:
+    __slots__ = ("_data", "_index")
+
+    def __init__(self, data, index):
+        self._data = data
+        self._index = index
+
+    def __getitem__(self, field):
+        return self._data[field][self._index].item()
+
+    def __setitem__(self, field, value):
+        self._data[field][self._index] = value
+
+    def get(self, field, default=None):
+        return self[field] if field in NODE_STATE_DTYPE.names else default
+
+    def to_dict(self):
+        return {field: self[field] for field in NODE_STATE_DTYPE.names}
+
+# نودهای توپولوژی با اندیس خودشان و نودهای اضافه (مثل Genesis) بعد از آن‌ها ذخیره می‌شوند
+class NodeStateTable:
+    def __init__(self, topology, extra_nodes=("Genesis",), **defaults):
+        self.num_nodes = topology.num_nodes
+        self.extra = {node_id: self.num_nodes + i for i, node_id in enumerate(extra_nodes)}
+        self.defaults = defaults
+        self.data = np.zeros(self.num_nodes + len(self.extra), dtype=NODE_STATE_DTYPE)
+        self.reset()
+
+    def __len__(self):
+        return len(self.data)
+
+    def index(self, node_id):
+        if node_id in self.extra:
+            return self.extra[node_id]
+        index = node_index(node_id)
+        if index is None or not 0 <= index < self.num_nodes:
+            raise KeyError(node_id)
+        return index
+
+    def indices(self, node_ids):
+        return np.fromiter((self.index(node_id) for node_id in node_ids), dtype=np.int64)
+
+    def __contains__(self, node_id):
+        try:
+            self.index(node_id)
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, node_id):
+        return NodeView(self.data, self.index(node_id))
+
+    def get(self, node_id, default=None):
+        return self[node_id] if node_id in self else default
+
+    def set_node(self, node_id, **values):
+        index = self.index(node_id)
+        for field, value in values.items():
+            self.data[field][index] = value
+
+    # بازنشانی فیلدهای داده‌شده برای همه نودها؛ بدون ورودی همه فیلدها به مقدار پیش‌فرض جدول برمی‌گردند
+    def reset(self, **values):
+        if not values:
+            values = {field: self.defaults.get(field, 0) for field in NODE_STATE_DTYPE.names}
+        for field, value in values.items():
+            self.data[field] = value
+
+    # به‌روزرسانی دسته‌ای یک فیلد برای چند نود (نام نود یا آرایه اندیس)
+    def update(self, field, nodes, values):
+        if not isinstance(nodes, np.ndarray):
+            nodes = self.indices(nodes)
+        self.data[field][nodes] = values
+
+    def values(self, field, nodes=None):
+        if nodes is None:
+            return self.data[field]
+        if not isinstance(nodes, np.ndarray):
+            nodes = self.indices(nodes)
+        return self.data[field][nodes]
@@ -0,0 +1,58 @@
+import sys
+import json
+import time
+import random
+import hashlib
+from pathlib import Path
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.signers import SIGNERS
+
+# نمونه پیام‌ها به اندازه بلاک‌های واقعی: هش بلاک (۶۴ بایت) و بدنه JSON بلاک
+def sample_messages(count):
+    messages = []
+    for i in range(count):
+        block = {
+            "timestamp": f"2025-02-27 07:{i % 60:02d}:00",
+            "node_id": f"Node_{random.randint(1, 10)}",
+            "traffic_layer": {"volume": round(random.uniform(10, 100), 2), "type": random.choice(["Data", "Voice", "Video"])},
+            "health_layer": {"status": random.choice(["Up", "Down"]), "latency": round(random.uniform(0, 50), 2)},
+            "previous_hash": hashlib.sha256(str(i).encode()).hexdigest(),
+            "congestion_layer": {"is_congested": 0, "score": 0.0, "impact": 0.0, "level": "Low"}
+        }
+        body = json.dumps(block, sort_keys=True).encode()
+        messages.append((hashlib.sha256(body).hexdigest().encode(), body))
+    return messages
+
+def benchmark(count=2000):
+    messages = sample_messages(count)
+    results = {}
+    for name, signer in SIGNERS.items():
+        key = signer.generate_key()
+        public_key = key.public_key()
+        for label, index in (("hash", 0), ("block", 1)):
+            payloads = [m[index] for m in messages]
+            start = time.perf_counter()
+            signatures = [signer.sign(key, payload) for payload in payloads]
+            sign_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for payload, signature in zip(payloads, signatures):
+                signer.verify(public_key, signature, payload)
+            verify_time = time.perf_counter() - start
+            results[(name, label)] = {
+                "message_bytes": sum(len(p) for p in payloads) // len(payloads),
+                "sign_us": round(sign_time / count * 1e6, 1),
+                "verify_us": round(verify_time / count * 1e6, 1),
+                "signature_bytes": sum(len(s) for s in signatures) // len(signatures)
+            }
+    return results
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'scheme':<12}{'message':<8}{'bytes':>7}{'sign us':>10}{'verify us':>11}{'sig bytes':>11}")
+    for (name, label), r in benchmark(count).items():
+        print(f"{name:<12}{label:<8}{r['message_bytes']:>7}{r['sign_us']:>10}{r['verify_us']:>11}{r['signature_bytes']:>11}")
@@ -0,0 +1,72 @@
+import os
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.hazmat.backends import default_backend
+
+from src.blockchain.merkle import encode_proof, decode_proof
+
+# الگوریتم امضای پیش‌فرض بلاک‌های جدید (ecdsa-p256 یا ed25519)
+SIGNATURE_SCHEME = os.getenv("SIGNATURE_SCHEME", "ecdsa-p256")
+
+# امضای ECDSA روی منحنی SECP256R1 با SHA256
+class EcdsaP256Signer:
+    name = "ecdsa-p256"
+
+    def generate_key(self):
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+    def sign(self, private_key, message):
+        return private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+
+    def verify(self, public_key, signature, message):
+        public_key.verify(signature, message, ec.ECDSA(hashes.SHA256()))
+
+    def matches(self, key):
+        return isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey))
+
+# امضای Ed25519 (امضا و تأیید سریع‌تر)
+class Ed25519Signer:
+    name = "ed25519"
+
+    def generate_key(self):
+        return ed25519.Ed25519PrivateKey.generate()
+
+    def sign(self, private_key, message):
+        return private_key.sign(message)
+
+    def verify(self, public_key, signature, message):
+        public_key.verify(signature, message)
+
+    def matches(self, key):
+        return isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey))
+
+SIGNERS = {signer.name: signer for signer in (EcdsaP256Signer(), Ed25519Signer())}
+
+def get_signer(scheme=None):
+    scheme = scheme or SIGNATURE_SCHEME
+    if scheme not in SIGNERS:
+        raise ValueError(f"Unknown signature scheme: {scheme}")
+    return SIGNERS[scheme]
+
+def signer_for_key(key):
+    for signer in SIGNERS.values():
+        if signer.matches(key):
+            return signer
+    raise ValueError(f"Unsupported key type: {type(key).__name__}")
+
+# ذخیره امضا همراه با نام الگوریتم: "scheme:hex" و برای بلاک‌های مهر دسته‌ای "scheme:hex:proof"
+def encode_signature(signature, scheme=None, proof=None):
+    text = f"{get_signer(scheme).name}:{signature.hex()}"
+    if proof:
+        text += ":" + encode_proof(*proof)
+    return text
+
+# خروجی: (امضا، الگوریتم، اثبات مرکل)؛ امضاهای قدیمی بدون پیشوند ECDSA در نظر گرفته می‌شوند
+def decode_signature(text):
+    if not text:
+        return None, None, None
+    if ":" not in text:
+        return bytes.fromhex(text), EcdsaP256Signer.name, None
+    parts = text.split(":", 2)
+    proof = decode_proof(parts[2]) if len(parts) > 2 else None
+    return bytes.fromhex(parts[1]), parts[0], proof
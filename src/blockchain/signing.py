@@ -0,0 +1,211 @@
+import os
+import sys
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from src.blockchain.key_store import load_node_keys, load_public_keys
+from src.blockchain.signers import get_signer, signer_for_key
+from src.blockchain.merkle import merkle_proofs, root_from_proof
+
+# تعداد پروسه‌های امضا و حداقل اندازه دسته برای استفاده از pool
+SIGN_WORKERS = int(os.getenv("SIGN_WORKERS", str(os.cpu_count() or 1)))
+BATCH_SIGN_MIN = int(os.getenv("BATCH_SIGN_MIN", "64"))
+
+# تأیید امضا بلافاصله بعد از امضا (با --skip-sign-verify یا VERIFY_AFTER_SIGN=False حذف می‌شود)
+VERIFY_AFTER_SIGN = "--skip-sign-verify" not in sys.argv and os.getenv("VERIFY_AFTER_SIGN", "True") != "False"
+
+# مهر دسته‌ای: فقط ریشه مرکل هر N بلاک یک نود امضا می‌شود (۱ یعنی امضای تک‌تک بلاک‌ها)
+MERKLE_BATCH_SIZE = int(os.getenv("MERKLE_BATCH_SIZE", "1"))
+
+# تعداد بلاک‌های هر دسته امضا در مراحل؛ بلاک‌ها دسته به دسته امضا و ذخیره می‌شوند نه یک جا در پایان مرحله
+SEAL_BATCH_SIZE = int(os.getenv("SEAL_BATCH_SIZE", "4096"))
+
+# pool پروسه‌های امضا برای هر تعداد worker یک بار ساخته و در دسته‌های بعدی دوباره استفاده می‌شود
+_pools = {}
+_pools_lock = threading.Lock()
+
+# امضای یک پیام با کلید خصوصی؛ الگوریتم از نوع کلید تشخیص داده می‌شود
+def sign_message(private_key, message):
+    signer = signer_for_key(private_key)
+    return signer.sign(private_key, message), signer.name
+
+# تأیید امضا با الگوریتم ثبت‌شده در بلاک؛ اگر کلید داده‌شده از الگوریتم دیگری باشد کلید درست از مخزن خوانده می‌شود
+# برای بلاک‌های مهر دسته‌ای ابتدا عضویت هش در ریشه بررسی و سپس امضای ریشه تأیید می‌شود
+def verify_message(public_key, node_id, signature, message, scheme=None, proof=None):
+    signer = get_signer(scheme)
+    if not signer.matches(public_key):
+        public_key = load_public_keys([node_id], signer.name)[node_id]
+    if proof:
+        root, path = proof
+        if root_from_proof(message.decode(), path) != root:
+            raise ValueError("Merkle proof does not match the sealed root")
+        message = root.encode()
+    signer.verify(public_key, signature, message)
+
+# امضای یک تکه از (node_id, hash) ها؛ کلیدها در هر پروسه از مخزن مشترک خوانده می‌شوند
+def _sign_chunk(items, scheme=None):
+    signer = get_signer(scheme)
+    keys = load_node_keys(sorted({node_id for node_id, _ in items}), signer.name)
+    return [signer.sign(keys[node_id], block_hash.encode()) for node_id, block_hash in items]
+
+def _pool(workers):
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pools[workers]
+
+def shutdown_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+# امضای دسته‌ای هش‌ها در چند پروسه با حفظ ترتیب ورودی
+def sign_hashes(items, workers=None, scheme=None):
+    items = list(items)
+    workers = workers or SIGN_WORKERS
+    scheme = get_signer(scheme).name
+    if len(items) < BATCH_SIGN_MIN or workers <= 1:
+        return _sign_chunk(items, scheme) if items else []
+    chunk_size = max(1, -(-len(items) // (workers * 4)))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    pool = _pool(workers)
+    try:
+        signatures = []
+        for chunk_signatures in pool.map(_sign_chunk, chunks, [scheme] * len(chunks)):
+            signatures.extend(chunk_signatures)
+    except Exception:
+        # pool خراب (مثلاً پروسه‌ای که از کار افتاده) کنار گذاشته می‌شود تا دسته بعدی pool تازه بسازد
+        with _pools_lock:
+            if _pools.get(workers) is pool:
+                del _pools[workers]
+        pool.shutdown(wait=False)
+        raise
+    return signatures
+
+# امضای تک‌تک در همین پروسه وقتی امضای دسته‌ای شکست خورده است؛ فقط موارد ناموفق (مثلاً نود بدون کلید) None می‌شوند
+def _sign_each(items, scheme):
+    signatures = []
+    for node_id, block_hash in items:
+        try:
+            signatures.extend(_sign_chunk([(node_id, block_hash)], scheme))
+        except Exception as e:
+            logging.error(f"Signing failed for {node_id}: {e}")
+            signatures.append(None)
+    return signatures
+
+# امضای دسته‌ای با برگشت به امضای تک‌تک تا خطای یک مورد همه دسته را حذف نکند
+def _sign_items(items, workers, scheme, what):
+    try:
+        return sign_hashes(items, workers, scheme)
+    except Exception as e:
+        logging.error(f"Batch signing of {len(items)} {what} failed, signing one by one: {e}")
+        return _sign_each(items, scheme)
+
+# گروه‌بندی بلاک‌های هر نود در دسته‌های N تایی برای مهر مرکل
+def _merkle_batches(blocks, batch_size):
+    by_node = {}
+    for block in blocks:
+        by_node.setdefault(block.node_id, []).append(block)
+    return [group[i:i + batch_size] for group in by_node.values() for i in range(0, len(group), batch_size)]
+
+# مهر دسته‌ای: یک امضا روی ریشه هر دسته و اثبات عضویت برای هر بلاک
+def _seal_merkle_batches(blocks, verify, workers, scheme, batch_size):
+    batches = _merkle_batches(blocks, batch_size)
+    trees = [merkle_proofs([block.hash for block in batch]) for batch in batches]
+    signatures = _sign_items([(batch[0].node_id, root) for batch, (root, _) in zip(batches, trees)], workers, scheme, "Merkle roots")
+    signer = get_signer(scheme)
+    public_keys = load_public_keys(sorted({block.node_id for block in blocks}), scheme) if verify else {}
+    sealed = set()
+    for batch, (root, paths), signature in zip(batches, trees, signatures):
+        if signature is None:
+            logging.error(f"Unsigned root for {len(batch)} blocks of {batch[0].node_id}, batch discarded")
+            continue
+        if verify:
+            try:
+                signer.verify(public_keys[batch[0].node_id], signature, root.encode())
+            except Exception:
+                logging.error(f"Invalid root signature for {len(batch)} blocks of {batch[0].node_id}, batch discarded")
+                continue
+        for block, path in zip(batch, paths):
+            block.signature = signature
+            block.signature_scheme = scheme
+            block.merkle_proof = (root, path)
+            sealed.add(id(block))
+    return [block for block in blocks if id(block) in sealed]
+
+# امضای دسته‌ای بلاک‌ها؛ بلاک‌های با امضای نامعتبر کنار گذاشته می‌شوند
+def sign_blocks(blocks, verify=None, workers=None, scheme=None, batch_size=None):
+    blocks = list(blocks)
+    verify = VERIFY_AFTER_SIGN if verify is None else verify
+    scheme = get_signer(scheme).name
+    batch_size = batch_size or MERKLE_BATCH_SIZE
+    if batch_size > 1:
+        return _seal_merkle_batches(blocks, verify, workers, scheme, batch_size)
+    signatures = _sign_items([(block.node_id, block.hash) for block in blocks], workers, scheme, "blocks")
+    for block, signature in zip(blocks, signatures):
+        block.signature = signature
+        block.signature_scheme = scheme
+        block.merkle_proof = None
+    unsigned = sum(1 for signature in signatures if signature is None)
+    if unsigned:
+        logging.error(f"{unsigned} unsigned blocks discarded")
+        blocks = [block for block in blocks if block.signature is not None]
+    if not verify:
+        return blocks
+    public_keys = load_public_keys(sorted({block.node_id for block in blocks}), scheme)
+    signed = []
+    for block in blocks:
+        if block.verify_signature(public_keys[block.node_id]):
+            signed.append(block)
+        else:
+            logging.error(f"Invalid signature for block {block.node_id}, block discarded")
+    return signed
+
+# بلاک‌های در انتظار امضای یک مرحله: هر دسته پر امضا و به همان ترتیب به save داده می‌شود تا نوشتن گروهی جریانی بماند
+# مراحل بلاک‌ها را از چند thread اضافه می‌کنند، پس افزودن و مهر دسته زیر یک قفل است
+# با rollback (زنجیره‌ای که previous_hash را خودش می‌سازد) دسته فقط تا اولین بلاک امضانشده ذخیره می‌شود و بلاک‌های
+# بعد از آن که به بلاک ذخیره‌نشده پیوند دارند به rollback داده می‌شوند تا سر زنجیره به آخرین بلاک ذخیره‌شده برگردد
+class PendingSeals:
+    def __init__(self, save, batch_size=None, rollback=None):
+        self.save = save
+        self.batch_size = batch_size or SEAL_BATCH_SIZE
+        self.rollback = rollback
+        self.blocks = []
+        self.discarded = 0
+        self.lock = threading.Lock()
+
+    def add(self, block):
+        with self.lock:
+            self.blocks.append(block)
+            if len(self.blocks) >= self.batch_size:
+                self._seal_batch()
+
+    def _seal_batch(self):
+        sealed = sign_blocks(self.blocks)
+        dropped = []
+        if self.rollback and len(sealed) < len(self.blocks):
+            signed = {id(block) for block in sealed}
+            first = next(i for i, block in enumerate(self.blocks) if id(block) not in signed)
+            sealed, dropped = self.blocks[:first], self.blocks[first:]
+        for block in sealed:
+            self.save(block)
+        if dropped:
+            self.rollback(dropped)
+        self.discarded += len(self.blocks) - len(sealed)
+        self.blocks = []
+
+    # امضا و ذخیره باقی‌مانده بلاک‌ها؛ تعداد بلاک‌های کنار گذاشته شده از فراخوانی قبلی برگردانده می‌شود
+    def seal(self):
+        with self.lock:
+            if self.blocks:
+                self._seal_batch()
+            discarded, self.discarded = self.discarded, 0
+        return discarded
+
+# بستن pool امضا هنگام خروج پروسه
+atexit.register(shutdown_pools)
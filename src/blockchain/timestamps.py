@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import logging
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from src.blockchain.compact_schema import COMPACT_SCHEMA, add_column, compact_table, storage_table
+from src.blockchain.chain_db import ensure_lineage_view, stage_db
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+RESULT_DIR = ROOT_DIR / "result"
+
+# ستون زمان عددی: میکروثانیه از 1970-01-01 برای زمان ذخیره‌شده (بدون تبدیل منطقه زمانی)
+EPOCH_COLUMN = "timestamp_us"
+
+# جدول‌های خروجی مراحل که ستون زمان عددی و ایندکس‌ها را دارند
+STAGE_TABLES = {
+    "blocks": "traffic_data.db",
+    "congestion_blocks": "congestion_data.db",
+    "managed_blocks": "managed_traffic.db",
+    "new_orders": "new_orders.db",
+    "real_time_orders": "real_time_orders.db",
+    "smart_traffic": "smart_traffic.db",
+    "healing_network": "self_healing.db",
+    "optimized_resources": "optimized_resources.db",
+    "predictive_analysis": "predictive_analysis.db",
+}
+
+# ایندکس‌های هر جدول مرحله (فقط اگر ستون‌های آن در جدول باشند)
+STAGE_INDEXES = {
+    EPOCH_COLUMN: (EPOCH_COLUMN,),
+    "node_time": ("node_id", EPOCH_COLUMN),
+    "block_hash": ("block_hash",),
+}
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+# تبدیل زمان ISO (با T یا فاصله، با یا بدون میکروثانیه) به عدد صحیح؛ مقدار نامعتبر None
+def epoch_us(timestamp):
+    if timestamp is None:
+        return None
+    try:
+        value = timestamp if isinstance(timestamp, datetime) else datetime.fromisoformat(str(timestamp))
+    except ValueError:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // _MICROSECOND
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+# افزودن ستون زمان عددی و ایندکس‌های جدول مرحله و پر کردن ردیف‌های بدون مقدار
+# در طرح فشرده همه این کارها روی جدول داده پشت view انجام می‌شود
+def ensure_stage_indexes(conn, table, compact=None):
+    target = storage_table(conn, table)
+    columns = _columns(conn, target)
+    if not columns:
+        return False
+    with conn:
+        if EPOCH_COLUMN not in columns:
+            add_column(conn, table, EPOCH_COLUMN, "INTEGER")
+            columns.append(EPOCH_COLUMN)
+            logging.info(f"Added {EPOCH_COLUMN} column to {target}")
+        for name, indexed in STAGE_INDEXES.items():
+            if all(column in columns for column in indexed):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{target}_{name} ON {target} ({', '.join(indexed)})")
+        # ردیف‌های NULL از طریق ایندکس timestamp_us پیدا می‌شوند؛ پس از پر شدن اولیه هزینه‌ای ندارد
+        conn.create_function("epoch_us", 1, epoch_us, deterministic=True)
+        updated = conn.execute(f"UPDATE {target} SET {EPOCH_COLUMN} = epoch_us(timestamp) "
+                               f"WHERE {EPOCH_COLUMN} IS NULL AND timestamp IS NOT NULL").rowcount
+    if updated:
+        logging.info(f"Backfilled {EPOCH_COLUMN} for {updated} rows in {target}")
+    if (COMPACT_SCHEMA if compact is None else compact) and target == table and compact_table(conn, table):
+        ensure_stage_indexes(conn, table, compact=False)
+    # در دیتابیس یکپارچه view ردگیری با جدول‌های جدید یا فشرده‌شده به‌روز می‌شود
+    ensure_lineage_view(conn)
+    return True
+
+# ستون مرتب‌سازی زمانی برای خواننده‌ها؛ جدول‌های مهاجرت‌نشده همچنان با timestamp متنی مرتب می‌شوند
+def time_order_column(conn, table):
+    return EPOCH_COLUMN if EPOCH_COLUMN in _columns(conn, table) else "timestamp"
+
+# مهاجرت همه جدول‌های مراحل در پوشه نتایج
+def migrate(result_dir=RESULT_DIR):
+    migrated = []
+    for table, db_file in STAGE_TABLES.items():
+        db_path = stage_db(db_file, result_dir)
+        if not os.path.exists(db_path):
+            continue
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            if ensure_stage_indexes(conn, table):
+                migrated.append(table)
+        finally:
+            conn.close()
+    return migrated
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    tables = migrate()
+    print(f"Migrated {len(tables)} stage tables: {', '.join(tables) if tables else 'none'}")
@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+from pathlib import Path
+import numpy as np
+
+# توپولوژی مشترک شبکه؛ یک بار ساخته و به صورت CSR (offsets, neighbors, weights) روی دیسک ذخیره می‌شود
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+TOPOLOGY_DIR = Path(os.getenv("TOPOLOGY_DIR", ROOT_DIR / "result" / "topology"))
+TOPOLOGY_NODES = int(os.getenv("TOPOLOGY_NODES", "10"))
+TOPOLOGY_DEGREE = int(os.getenv("TOPOLOGY_DEGREE", "3"))
+TOPOLOGY_SEED = int(os.getenv("TOPOLOGY_SEED", "42"))
+
+_ARRAYS = ("offsets", "neighbors", "weights")
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+# نام نودها از روی اندیس ساخته می‌شود و لیستی از نام‌ها روی دیسک نگه داشته نمی‌شود
+def node_name(index):
+    return f"Node_{index + 1}"
+
+def node_index(node_id):
+    prefix, _, number = node_id.partition("_")
+    if prefix != "Node" or not number.isdigit():
+        return None
+    return int(number) - 1
+
+class Topology:
+    def __init__(self, offsets, neighbors, weights):
+        self.offsets = offsets
+        self.neighbor_index = neighbors
+        self.weights = weights
+        self.num_nodes = len(offsets) - 1
+
+    def __contains__(self, node_id):
+        index = node_index(node_id)
+        return index is not None and 0 <= index < self.num_nodes
+
+    def node_ids(self):
+        return [node_name(i) for i in range(self.num_nodes)]
+
+    def _span(self, node_id):
+        if node_id not in self:
+            return 0, 0
+        index = node_index(node_id)
+        return int(self.offsets[index]), int(self.offsets[index + 1])
+
+    # همسایه‌های یک نود (نودهای خارج از توپولوژی مثل Genesis همسایه‌ای ندارند)
+    def neighbors(self, node_id):
+        start, end = self._span(node_id)
+        return [node_name(i) for i in self.neighbor_index[start:end].tolist()]
+
+    def neighbor_weights(self, node_id):
+        start, end = self._span(node_id)
+        return self.weights[start:end].tolist()
+
+    def summary(self):
+        degrees = np.diff(self.offsets)
+        return {"nodes": self.num_nodes, "edges": int(self.offsets[-1]),
+                "min_degree": int(degrees.min()) if self.num_nodes else 0,
+                "max_degree": int(degrees.max()) if self.num_nodes else 0,
+                "mean_degree": round(float(degrees.mean()), 3) if self.num_nodes else 0.0}
+
+# ساخت گراف تصادفی: هر نود بین ۱ و degree همسایه متمایز (غیر از خودش) با وزن 1 تا 5 دارد
+def generate_topology(num_nodes, degree, seed):
+    rng = np.random.default_rng(seed)
+    degree = max(0, min(degree, num_nodes - 1))
+    if degree == 0:
+        return np.zeros(num_nodes + 1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    degrees = rng.integers(1, degree + 1, num_nodes)
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+    owners = np.repeat(np.arange(num_nodes), degrees)
+    # انتخاب از بین num_nodes - 1 نود دیگر و جابجایی برای حذف خود نود
+    neighbors = rng.integers(0, num_nodes - 1, len(owners))
+    neighbors += neighbors >= owners
+    # همسایه‌های تکراری یک نود دوباره انتخاب می‌شوند
+    for index in range(num_nodes):
+        start, end = offsets[index], offsets[index + 1]
+        if len(set(neighbors[start:end].tolist())) == end - start:
+            continue
+        choices = rng.choice(num_nodes - 1, end - start, replace=False)
+        neighbors[start:end] = choices + (choices >= index)
+    weights = rng.uniform(1, 5, len(owners)).astype(np.float32)
+    return offsets, neighbors.astype(np.int32), weights
+
+def topology_path(num_nodes=None, degree=None, seed=None):
+    num_nodes = TOPOLOGY_NODES if num_nodes is None else num_nodes
+    degree = TOPOLOGY_DEGREE if degree is None else degree
+    seed = TOPOLOGY_SEED if seed is None else seed
+    return TOPOLOGY_DIR / f"n{num_nodes}_d{degree}_s{seed}"
+
+# ساخت در پوشه موقت و rename اتمیک تا مراحل موازی توپولوژی یکدیگر را خراب نکنند
+def _build(path, num_nodes, degree, seed):
+    TOPOLOGY_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=TOPOLOGY_DIR, suffix=".tmp"))
+    try:
+        for name, array in zip(_ARRAYS, generate_topology(num_nodes, degree, seed)):
+            np.save(tmp_dir / f"{name}.npy", array)
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump({"nodes": num_nodes, "degree": degree, "seed": seed}, f)
+        os.rename(tmp_dir, path)
+        logging.info(f"Generated topology with {num_nodes} nodes in {path}")
+    except OSError:
+        if not (path / "meta.json").exists():
+            raise
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# بارگذاری توپولوژی به صورت memory-map (زمان شروع مستقل از تعداد نودها)
+def load_topology(num_nodes=None, degree=None, seed=None):
+    num_nodes = TOPOLOGY_NODES if num_nodes is None else num_nodes
+    degree = TOPOLOGY_DEGREE if degree is None else degree
+    seed = TOPOLOGY_SEED if seed is None else seed
+    path = topology_path(num_nodes, degree, seed)
+    with _loaded_lock:
+        if path not in _loaded:
+            if not (path / "meta.json").exists():
+                _build(path, num_nodes, degree, seed)
+            _loaded[path] = Topology(*(np.load(path / f"{name}.npy", mmap_mode="r") for name in _ARRAYS))
+        return _loaded[path]
@@ -0,0 +1,28 @@
+import os
+import numpy as np
+
+# seed مولد تصادفی شبیه‌ساز برداری
+TRAFFIC_SEED = int(os.getenv("TRAFFIC_SEED", "42"))
+CONGESTION_PROB = 0.15
+
+def traffic_rng(seed=TRAFFIC_SEED):
+    return np.random.default_rng(seed)
+
+# شبیه‌سازی ترافیک کل ماتریس (گام زمانی × نود) در یک بار اجرای NumPy
+# همان منطق simulate_traffic: احتمال ازدحام در ساعات اوج 0.3 و در غیر آن 0.05 ضرب در congestion_prob
+def simulate_traffic_matrix(timestamps, num_nodes, traffic_types, rng, congestion_prob=CONGESTION_PROB):
+    shape = (len(timestamps), num_nodes)
+    hours = np.array([ts.hour + ts.minute / 60 for ts in timestamps], dtype=float)
+    peak_prob = np.where((hours >= 8) & (hours < 18), 0.3, 0.05)[:, None]
+    congested = rng.random(shape) < congestion_prob * peak_prob
+    volume = np.where(congested, rng.uniform(80, 150, shape), rng.uniform(1, 60, shape))
+    health = np.where(congested, np.where(rng.random(shape) < 0.5, "Delayed", "Down"), "Normal")
+    latency = rng.uniform(0.1, 10, shape)
+    types = np.asarray(traffic_types)[rng.integers(0, len(traffic_types), shape)]
+    return {"type": types, "volume": volume, "health": health, "latency": latency}
+
+# تبدیل ماتریس به لیست‌های پایتونی (یک بار برای کل تکه) برای ساخت بلاک‌ها
+def traffic_rows(matrix):
+    columns = {key: values.tolist() for key, values in matrix.items()}
+    return [[{key: columns[key][t][i] for key in columns} for i in range(len(columns["type"][t]))]
+            for t in range(len(columns["type"]))]
@@ -0,0 +1,153 @@
+import os
+import sys
+import sqlite3
+import logging
+
+from src.blockchain.block_writer import flush_writers, writers_persist
+from src.blockchain.compact_schema import is_compact, storage_table
+
+# بازسازی کامل به جای پردازش افزایشی
+FULL_REBUILD = "--full-rebuild" in sys.argv or os.getenv("FULL_REBUILD") == "True"
+
+WATERMARK_TABLE = "stage_watermarks"
+
+# بازسازی کامل فقط یک بار در هر پروسه انجام می‌شود
+_rebuilt_stages = set()
+
+def ensure_watermark_table(conn):
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE}
+                     (input_db TEXT, input_table TEXT, last_rowid INTEGER,
+                      PRIMARY KEY (input_db, input_table))''')
+
+# کلید watermark: نام فایل ورودی؛ وقتی ورودی و خروجی یک فایل مشترک باشند (chain.db) نام جدول مرحله مصرف‌کننده هم می‌آید
+def watermark_key(output_db, input_db, consumer=None):
+    name = os.path.basename(input_db)
+    if consumer and os.path.abspath(output_db) == os.path.abspath(input_db):
+        return f"{name}:{consumer}"
+    return name
+
+# خواندن آخرین rowid پردازش‌شده از جدول ورودی
+def get_watermark(output_db, input_db, input_table, consumer=None):
+    conn = sqlite3.connect(output_db)
+    try:
+        ensure_watermark_table(conn)
+        c = conn.cursor()
+        c.execute(f"SELECT last_rowid FROM {WATERMARK_TABLE} WHERE input_db = ? AND input_table = ?",
+                  (watermark_key(output_db, input_db, consumer), input_table))
+        row = c.fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+def set_watermark(output_db, input_db, input_table, last_rowid, consumer=None):
+    conn = sqlite3.connect(output_db)
+    try:
+        with conn:
+            ensure_watermark_table(conn)
+            conn.execute(f"INSERT OR REPLACE INTO {WATERMARK_TABLE} VALUES (?, ?, ?)",
+                         (watermark_key(output_db, input_db, consumer), input_table, last_rowid))
+    finally:
+        conn.close()
+
+# پاک کردن خروجی مرحله و صفر کردن watermark برای بازسازی کامل
+def reset_stage(output_db, output_tables):
+    conn = sqlite3.connect(output_db)
+    try:
+        with conn:
+            ensure_watermark_table(conn)
+            for table in output_tables:
+                conn.execute(f"DELETE FROM {storage_table(conn, table)}")
+            # در دیتابیس مشترک فقط watermark همین مرحله پاک می‌شود
+            conn.execute(f"DELETE FROM {WATERMARK_TABLE} WHERE instr(input_db, ':') = 0 OR input_db GLOB ?",
+                         (f"*:{output_tables[0]}",))
+        logging.info(f"Full rebuild: cleared {', '.join(output_tables)} in {output_db}")
+    finally:
+        conn.close()
+
+# خواندن فقط ردیف‌های اضافه‌شده بعد از watermark
+def load_new_rows(input_db, input_table, after_rowid, limit=None):
+    if not os.path.exists(input_db):
+        logging.error(f"Input database {input_db} does not exist")
+        return [], after_rowid
+    conn = sqlite3.connect(input_db)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (input_table,))
+        if c.fetchone() is None:
+            logging.error(f"Table '{input_table}' does not exist in {input_db}")
+            return [], after_rowid
+        # view طرح فشرده rowid را خودش به عنوان ستون آخر دارد؛ برای جدول معمولی یک بار اضافه می‌شود
+        columns = "*" if is_compact(conn, input_table) else "*, rowid"
+        query = f"SELECT {columns} FROM {input_table} WHERE rowid > ? ORDER BY rowid"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        c.execute(query, (after_rowid,))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    last_rowid = rows[-1][-1] if rows else after_rowid
+    return [row[:-1] for row in rows], last_rowid
+
+# آخرین per_node ردیف خروجی قبلی هر نود (قدیمی به جدید) برای بازسازی وضعیت غلتان مرحله پیش از پردازش ردیف‌های جدید
+# در اجرای اول یا پس از --full-rebuild خروجی خالی است و وضعیت مثل قبل از صفر شروع می‌شود
+def seed_rows(output_db, output_table, columns, per_node):
+    if not os.path.exists(output_db):
+        return []
+    flush_writers(output_db)
+    conn = sqlite3.connect(output_db)
+    try:
+        if conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name=?",
+                        (output_table,)).fetchone() is None:
+            return []
+        select = ", ".join(columns)
+        return conn.execute(f"SELECT {select} FROM (SELECT {select}, rowid AS seq, "
+                            f"ROW_NUMBER() OVER (PARTITION BY node_id ORDER BY rowid DESC) AS recent FROM {output_table}) "
+                            f"WHERE recent <= ? ORDER BY seq", (per_node,)).fetchall()
+    finally:
+        conn.close()
+
+# آماده‌سازی ورودی افزایشی یک مرحله: (ردیف‌های جدید، watermark قبلی، watermark جدید)
+# با genesis=True ردیف جنسیس اجرای اول پردازش نمی‌شود و خارج از limit خوانده می‌شود تا watermark روی آخرین ردیف پردازش‌شده بماند
+def prepare_incremental(output_db, input_db, input_table, output_tables, limit=None, genesis=False):
+    stage = (str(output_db), output_tables[0])
+    if FULL_REBUILD and stage not in _rebuilt_stages:
+        reset_stage(output_db, output_tables)
+        _rebuilt_stages.add(stage)
+    after_rowid = get_watermark(output_db, input_db, input_table, output_tables[0])
+    if limit and genesis and after_rowid == 0:
+        limit += 1
+    rows, last_rowid = load_new_rows(input_db, input_table, after_rowid, limit)
+    logging.info(f"Incremental load from {os.path.basename(input_db)}:{input_table}: {len(rows)} new rows after rowid {after_rowid}")
+    return rows, after_rowid, last_rowid
+
+# watermark مرحله‌ای که ورودی را مستقیم از مرحله قبل گرفته است (اجرای fused): همه ردیف‌های فعلی جدول ورودی
+# تحویل داده شده‌اند، پس اجرای عادی یا --incremental بعدی از آخرین rowid آن ادامه می‌دهد
+def upstream_watermark(input_db, input_table):
+    if not writers_persist() or not os.path.exists(input_db):
+        return None
+    flush_writers(input_db)
+    conn = sqlite3.connect(input_db)
+    try:
+        return conn.execute(f"SELECT MAX(rowid) FROM {input_table}").fetchone()[0] or 0
+    except sqlite3.Error as e:
+        logging.error(f"Could not read the last rowid of {input_table} in {input_db}: {e}")
+        return None
+    finally:
+        conn.close()
+
+# ثبت watermark جدید بعد از ذخیره شدن خروجی مرحله
+# بلاک‌هایی که امضای آن‌ها شکست خورده (discarded) ذخیره نشده‌اند ولی watermark از آن‌ها می‌گذرد؛ برگرداندن watermark
+# ردیف‌های ذخیره‌شده بعدی را تکراری می‌کرد، پس از دست رفتن آن‌ها صریحاً گزارش می‌شود
+def commit_watermark(output_db, input_db, input_table, last_rowid, consumer=None, discarded=0):
+    if last_rowid is None or not writers_persist():
+        return
+    if discarded:
+        logging.warning(f"{discarded} rows of {os.path.basename(input_db)}:{input_table} up to rowid {last_rowid} "
+                        f"were discarded while sealing and will not be retried; rerun with --full-rebuild to reprocess them")
+    flush_writers(output_db)
+    set_watermark(output_db, input_db, input_table, last_rowid, consumer)
+
+# watermark قبلی و جدید مرحله در اجرای fused؛ مثل اجرای افزایشی، جنسیس ورودی فقط تا وقتی کنار گذاشته می‌شود
+# که مرحله ردیفی پردازش نکرده است، وگرنه جنسیس اجرای جدید زنجیره خروجی را از "0" ادامه می‌دهد
+def fused_watermarks(output_db, input_db, input_table, consumer):
+    return get_watermark(output_db, input_db, input_table, consumer), upstream_watermark(input_db, input_table)
@@ -14,9 +14,7 @@ from pathlib import Path
 import asyncio
 import threading
 from tqdm import tqdm
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 import matplotlib.pyplot as plt
 
 # تنظیمات لاگینگ
@@ -45,22 +43,33 @@ from src.smart.code09_smart_traffic_management import main as run_smart_traffic
 from src.smart.code10_self_healing_network import main as run_self_healing
 from src.smart.code11_resource_optimization import main as run_resource_optimization
 from src.smart.code12_predictive_analysis_and_anomaly_detection import main as run_predictive_analysis
+from src.blockchain.block_writer import configure_writers, captured_rows, clear_captured, get_writer
+from src.pipeline_dag import run_dag
+from src.blockchain.key_store import load_node_keys, load_public_keys
+from src.blockchain.signing import sign_message
+from src.blockchain.signers import encode_signature
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.traffic_simulator import simulate_traffic_matrix, traffic_rows, traffic_rng
+from src.smart.congestion_inference import CongestionScorer
+from src.smart.inference_queue import InferenceQueue
+from src.smart.forest_engine import load_forest
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.chain_db import stage_db
+from src.blockchain.node_state import NodeStateTable
+from src.blockchain.block_log import BLOCK_LOG, BLOCK_LOG_DIR, HASH_COLUMN, BlockLog, export_to_sqlite
 
 # تنظیمات اولیه
 np.random.seed(42)
-num_nodes = 10
 start_time = datetime(2025, 2, 27, 7, 0, 0)
 congestion_prob = 0.15
 
 # گراف نودها و کلیدهای ECDSA
-nodes = [f"Node_{i}" for i in range(1, num_nodes + 1)] + ["Genesis"]
-graph = {node: {"neighbors": random.sample(nodes, random.randint(1, 3)),
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]}
-         for node in nodes}
-node_keys = {node: ec.generate_private_key(ec.SECP256R1(), default_backend()) for node in nodes}
-node_public_keys = {node: key.public_key() for node, key in node_keys.items()}
-node_status = {node: {"max_capacity": 100, "current_traffic": 0, "active": True, "allocated_bandwidth": 50}
-               for node in nodes}
+topology = load_topology()
+nodes = topology.node_ids() + ["Genesis"]
+node_keys = load_node_keys(nodes)
+node_public_keys = load_public_keys(nodes)
+node_status = NodeStateTable(topology, max_capacity=100, current_traffic=0, active=True, allocated_bandwidth=50)
 
 # اطمینان از وجود دایرکتوری result
 def ensure_result_dir():
@@ -78,7 +87,7 @@ def check_file_exists(file_path, step_name):
 # تولید نمودار برای دمو
 def plot_summary():
     try:
-        conn = sqlite3.connect(RESULT_DIR / "predictive_analysis.db")
+        conn = sqlite3.connect(stage_db("predictive_analysis.db"))
         df = pd.read_sql_query("SELECT congestion_level, predicted_congestion, anomaly_detected FROM predictive_analysis", conn)
         conn.close()
         if not df.empty:
@@ -103,20 +112,13 @@ def plot_summary():
     except Exception as e:
         logger.warning(f"Failed to generate summary plot: {e}")
 
-# شبیه‌سازی داده‌های ترافیک جدید
-def simulate_traffic(node_id, timestamp):
-    hour = timestamp.hour + timestamp.minute / 60
-    peak_prob = 0.3 if 8 <= hour < 18 else 0.05
-    traffic_types = ["Data", "Stream", "Game", "Priority"]
-    traffic_type = random.choice(traffic_types)
-    if np.random.random() < (congestion_prob * peak_prob):
-        traffic = np.random.uniform(80, 150)
-        health = "Delayed" if np.random.random() < 0.5 else "Down"
-    else:
-        traffic = np.random.uniform(1, 60)
-        health = "Normal"
-    latency = np.random.uniform(0.1, 10)
-    return {"type": traffic_type, "volume": traffic, "health": health, "latency": latency}
+# شبیه‌سازی داده‌های ترافیک جدید؛ ترافیک همه نودها در هر گام یک جا و برداری ساخته می‌شود
+traffic_types = ["Data", "Stream", "Game", "Priority"]
+traffic_generator = traffic_rng()
+
+def simulate_step_traffic(node_ids, timestamp):
+    matrix = simulate_traffic_matrix([timestamp], len(node_ids), traffic_types, traffic_generator, congestion_prob)
+    return dict(zip(node_ids, traffic_rows(matrix)[0]))
 
 # کلاس بلاک برای ریل‌تایم
 class RealTimeBlock:
@@ -132,9 +134,16 @@ class RealTimeBlock:
         self.traffic_suggestion = "None"
         self.order_type = "Standard"
         self.signature = None
+        self.signature_scheme = None
+        self.merkle_proof = None
         self.hash = self.calculate_hash()
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("order", (self.timestamp, self.node_id, self.traffic_layer["type"], self.traffic_layer["volume"],
+                                        self.health_layer["status"], self.health_layer["latency"], self.previous_hash,
+                                        self.congestion_level, self.congestion_score, self.congestion_impact,
+                                        self.traffic_suggestion, self.order_type))
         block_string = json.dumps({
             "timestamp": self.timestamp,
             "node_id": self.node_id,
@@ -151,8 +160,8 @@ class RealTimeBlock:
 
     def sign_block(self, private_key):
         try:
-            message = self.hash.encode()
-            self.signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+            self.signature, self.signature_scheme = sign_message(private_key, self.hash.encode())
+            self.merkle_proof = None
             return True
         except Exception as e:
             logger.error(f"Signing failed for {self.node_id}: {e}")
@@ -169,63 +178,36 @@ def generate_traffic_suggestion(traffic_type, congestion_level):
             return "Reduce Game traffic by 20% or prioritize critical nodes"
     return "NULL"
 
-# ذخیره بلاک ریل‌تایم در دیتابیس
-def save_real_time_block(block, output_db):
+# ردیف جدول real_time_orders برای یک بلاک ریل‌تایم
+def real_time_row(block):
+    return (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
+            block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
+            block.congestion_level, block.congestion_score, block.congestion_impact,
+            block.traffic_suggestion, block.order_type, encode_signature(block.signature, block.signature_scheme, block.merkle_proof) if block.signature else None,
+            epoch_us(block.timestamp))
+
+# ذخیره بلاک‌های یک گام ریل‌تایم با نویسنده گروهی؛ یک commit در پایان هر گام تا داشبورد بلاک‌ها را ببیند
+def save_real_time_rows(rows, output_db):
     try:
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("INSERT INTO real_time_orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                  (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
-                   block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
-                   block.congestion_level, block.congestion_score, block.congestion_impact,
-                   block.traffic_suggestion, block.order_type, block.signature.hex() if block.signature else None))
-        conn.commit()
-        conn.close()
+        writer = get_writer(output_db)
+        for row in rows:
+            writer.write("real_time_orders", row)
+        writer.flush()
     except sqlite3.Error as e:
-        logger.error(f"Error saving real-time block: {e}")
+        logger.error(f"Error saving {len(rows)} real-time blocks: {e}")
 
-# پیش‌بینی تراکم با مدل ML
-async def predict_congestion(block, model, le_node_id, le_traffic_type, le_network_health):
-    try:
-        data = pd.DataFrame([{
-            "node_id": block.node_id,
-            "traffic_volume": block.traffic_layer["volume"],
-            "latency": block.health_layer["latency"],
-            "network_health": block.health_layer["status"],
-            "traffic_type": block.traffic_layer["type"]
-        }])
-        for column in ["node_id", "traffic_type", "network_health"]:
-            known_values = set(eval(f"le_{column}").classes_)
-            if data[column].iloc[0] not in known_values:
-                logger.warning(f"Unknown value for {column}: {data[column].iloc[0]}. Using default value.")
-                data[column] = list(known_values)[0]
-            data[column] = eval(f"le_{column}").transform([data[column].iloc[0]])[0]
-        features = data[["node_id", "traffic_volume", "latency", "network_health", "traffic_type"]]
-        prediction = model.predict(features)[0]
-        score = model.decision_function(features)[0]
-        
-        # تبدیل پیش‌بینی به سطح تراکم
-        if prediction == -1:
-            if score < -0.1:
-                predicted_level = "High"
-            else:
-                predicted_level = "Medium"
-        else:
-            predicted_level = "Low"
-        
-        # تنظیم مقادیر congestion_score و congestion_impact
+# اعمال نتیجه مدل روی بلاک ریل‌تایم (امتیاز None یعنی پیش‌بینی ناموفق بوده است)
+def apply_prediction(block, level, score):
+    if score is not None:
         block.congestion_score = abs(score)
         block.congestion_impact = abs(score) * random.uniform(0.8, 1.2)  # شبیه‌سازی تأثیر
-        return predicted_level
-    except Exception as e:
-        logger.error(f"Prediction failed: {e}")
-        return block.congestion_level
+    return level
 
 # تابع ریل‌تایم برای پردازش بلاک‌های جدید
 async def real_time_processing():
     logger.info("Starting real-time traffic processing...")
     try:
-        model = joblib.load(RESULT_DIR / "congestion_model.pkl")
+        model = load_forest(RESULT_DIR / "congestion_model.pkl")
         encoders = joblib.load(RESULT_DIR / "encoders.pkl")
         le_node_id = encoders["node_id"]
         le_traffic_type = encoders["traffic_type"]
@@ -233,8 +215,10 @@ async def real_time_processing():
     except FileNotFoundError as e:
         logger.error(f"Failed to load model or encoders: {e}")
         return
+    inference = InferenceQueue(CongestionScorer(model, le_node_id, le_traffic_type, le_network_health))
+    ticks = 0
 
-    output_db = RESULT_DIR / "real_time_orders.db"
+    output_db = stage_db("real_time_orders.db")
     
     # اطمینان از وجود جدول
     try:
@@ -244,8 +228,9 @@ async def real_time_processing():
                      (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL, 
                       network_health TEXT, latency REAL, previous_hash TEXT, block_hash TEXT, 
                       congestion_level TEXT, congestion_score REAL, congestion_impact REAL, 
-                      traffic_suggestion TEXT, order_type TEXT, signature TEXT)''')
+                      traffic_suggestion TEXT, order_type TEXT, signature TEXT, timestamp_us INTEGER)''')
         conn.commit()
+        ensure_stage_indexes(conn, "real_time_orders")
     except sqlite3.Error as e:
         logger.error(f"Error initializing real_time_orders table: {e}")
         conn.close()
@@ -257,7 +242,7 @@ async def real_time_processing():
     try:
         conn = sqlite3.connect(output_db)
         c = conn.cursor()
-        c.execute("SELECT block_hash FROM real_time_orders ORDER BY timestamp DESC LIMIT 1")
+        c.execute("SELECT block_hash FROM real_time_orders ORDER BY timestamp_us DESC LIMIT 1")
         result = c.fetchone()
         previous_hash = result[0] if result else "0"
         conn.close()
@@ -266,31 +251,91 @@ async def real_time_processing():
         logger.error(f"Error fetching previous hash: {e}")
         previous_hash = "0"
 
+    # در حالت لاگ بلاک، بلاک‌ها در لاگ باینری ذخیره و به صورت دسته‌ای به SQLite منتقل می‌شوند
+    block_log = BlockLog(os.path.join(BLOCK_LOG_DIR, "real_time_orders")) if BLOCK_LOG else None
+    if block_log is not None and len(block_log):
+        previous_hash = block_log.last()[HASH_COLUMN]
+        logger.info(f"Continuing block log {block_log.path} from previous_hash: {previous_hash}")
+
     while True:
         try:
             timestamp = datetime.now()
-            for node_id in nodes:
-                if node_id == "Genesis":
-                    continue
-                traffic_data = simulate_traffic(node_id, timestamp)
-                block = RealTimeBlock(timestamp, node_id, traffic_data, 
-                                    {"status": traffic_data["health"], "latency": traffic_data["latency"]}, 
+            step_traffic = simulate_step_traffic([node_id for node_id in nodes if node_id != "Genesis"], timestamp)
+            blocks = [RealTimeBlock(timestamp, node_id, traffic_data,
+                                    {"status": traffic_data["health"], "latency": traffic_data["latency"]},
                                     previous_hash)
-                block.sign_block(node_keys[node_id])
-                congestion_level = await predict_congestion(block, model, le_node_id, le_traffic_type, le_network_health)
+                      for node_id, traffic_data in step_traffic.items()]
+            # پیش‌بینی همه نودهای این گام از طریق صف دسته‌ای، سپس زنجیره‌سازی ترتیبی
+            predictions = await asyncio.gather(*(inference.predict(block) for block in blocks))
+            rows = []
+            for block, (level, score) in zip(blocks, predictions):
+                node_id, traffic_data = block.node_id, block.traffic_layer
+                congestion_level = apply_prediction(block, level, score)
+                block.previous_hash = previous_hash
                 block.congestion_level = congestion_level
                 block.order_type = "Priority" if traffic_data["type"] == "Priority" else "Standard"
                 block.traffic_suggestion = generate_traffic_suggestion(traffic_data["type"], congestion_level)
-                save_real_time_block(block, output_db)
+                # هش و امضا بعد از تکمیل فیلدها تا بلاک ذخیره‌شده قابل ممیزی باشد
+                block.hash = block.calculate_hash()
+                block.sign_block(node_keys[node_id])
+                rows.append(real_time_row(block))
                 previous_hash = block.hash
                 logger.info(f"Processed real-time block for {node_id}: {traffic_data['volume']:.2f} MB/s, Congestion: {congestion_level}, Suggestion: {block.traffic_suggestion}")
+            if block_log is not None:
+                block_log.append_many(rows)
+                block_log.flush()
+            else:
+                save_real_time_rows(rows, output_db)
+            ticks += 1
+            if ticks % 60 == 0:
+                logger.info(f"Inference queue stats: {inference.stats()}")
             await asyncio.sleep(1)  # هر ثانیه بلاک جدید
         except Exception as e:
             logger.error(f"Error in real-time processing: {e}")
             await asyncio.sleep(5)
 
+# انتقال بلاک‌های جدید لاگ بلاک به real_time_orders تا داشبورد و مراحل پایین‌دستی آن‌ها را ببینند
+# صادرکننده دوره‌ای و حلقه incremental هم‌زمان اجرا می‌شوند؛ قفل مانع درج دوباره یک بازه از لاگ می‌شود
+_export_lock = threading.Lock()
+
+def export_real_time_log():
+    with _export_lock:
+        exported = export_to_sqlite(os.path.join(BLOCK_LOG_DIR, "real_time_orders"), stage_db("real_time_orders.db"), "real_time_orders")
+    return {"status": "success", "summary": f"Exported {exported} blocks from the block log to real_time_orders"}
+
+# انتقال دوره‌ای لاگ بلاک به SQLite مستقل از --incremental
+async def block_log_export(interval=5):
+    logger.info(f"Exporting the block log to real_time_orders every {interval} seconds...")
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = await loop.run_in_executor(None, export_real_time_log)
+            logger.info(f"Block log export: {result['summary']}")
+        except Exception as e:
+            logger.error(f"Error in block log export: {e}")
+
+# اجرای دوره‌ای مراحل پایین‌دستی فقط روی بلاک‌های جدید حلقه ریل‌تایم
+async def incremental_processing(interval=5):
+    logger.info(f"Starting incremental downstream processing every {interval} seconds...")
+    loop = asyncio.get_running_loop()
+    incremental_steps = [("Block log export", export_real_time_log)] if BLOCK_LOG else []
+    incremental_steps += [
+        ("Step 9 (incremental)", run_smart_traffic),
+        ("Step 10 (incremental)", run_self_healing),
+        ("Step 11 (incremental)", run_resource_optimization),
+    ]
+    while True:
+        await asyncio.sleep(interval)
+        for step_name, step_function in incremental_steps:
+            try:
+                result = await loop.run_in_executor(None, step_function)
+                logger.info(f"{step_name}: {result['summary']}")
+            except Exception as e:
+                logger.error(f"Error in {step_name}: {e}")
+
 # اجرای پایپ‌لاین اولیه
-def run_pipeline(demo=False):
+def run_pipeline(demo=False, fused=False, persist=True, parallel=False):
     logger.info("Starting Network Traffic Congestion Management with AI and Blockchain...")
     start_time = datetime.now()
     ensure_result_dir()
@@ -299,35 +344,71 @@ def run_pipeline(demo=False):
         logger.info("Running in DEMO mode with reduced data")
         os.environ["DEMO_MODE"] = "True"
 
+    # در حالت parallel مراحل مستقل بر اساس گراف وابستگی هم‌زمان در چند پروسه اجرا می‌شوند
+    if parallel and not fused:
+        logger.info("Running stages in parallel by dependency graph")
+        results, timing = run_dag()
+        failed = [name for name, result in results.items() if result.get("status") != "success"]
+        if failed:
+            logger.error(f"Stages not completed: {', '.join(failed)}")
+        logger.info(f"Stage times: {timing['stage_times']}")
+        logger.info(f"Initial pipeline completed in {datetime.now() - start_time}")
+        if demo:
+            logger.info("Generating demo summary plot...")
+            plot_summary()
+        return
+    if parallel:
+        logger.warning("Parallel mode is ignored in fused mode; stages share in-memory rows in one process")
+
+    # (پیام، تابع، فایل موردنیاز، جدول ورودی از مرحله قبل)
     steps = [
-        ("Step 1: Initializing blockchain data...", run_initial_data, None),
-        ("Step 2: Detecting congestion...", run_congestion, None),
-        ("Step 3: Managing traffic...", run_managed_traffic, RESULT_DIR / "traffic_data.db"),
-        ("Step 4: Processing new orders...", run_new_orders, RESULT_DIR / "managed_traffic.db"),
-        ("Step 5: Processing real-time orders...", run_real_time_orders, RESULT_DIR / "new_orders.db"),
-        ("Step 6: Preparing traffic data...", run_data_preparation, RESULT_DIR / "new_orders.db"),
-        ("Step 7: Training machine learning model...", run_model_training, RESULT_DIR / "new_orders.db"),
-        ("Step 8: Generating advanced traffic report...", run_advanced_report, RESULT_DIR / "managed_traffic.db"),
-        ("Step 9: Managing smart traffic...", run_smart_traffic, RESULT_DIR / "congestion_model.pkl"),
-        ("Step 10: Self-healing network...", run_self_healing, RESULT_DIR / "smart_traffic.db"),
-        ("Step 11: Optimizing resources...", run_resource_optimization, RESULT_DIR / "self_healing.db"),
-        ("Step 12: Predictive analysis and anomaly detection...", run_predictive_analysis, RESULT_DIR / "congestion_model.pkl"),
+        ("Step 1: Initializing blockchain data...", run_initial_data, None, None),
+        ("Step 2: Detecting congestion...", run_congestion, None, ("traffic_data.db", "blocks")),
+        ("Step 3: Managing traffic...", run_managed_traffic, Path(stage_db("traffic_data.db")), ("traffic_data.db", "blocks")),
+        ("Step 4: Processing new orders...", run_new_orders, Path(stage_db("managed_traffic.db")), ("managed_traffic.db", "managed_blocks")),
+        ("Step 5: Processing real-time orders...", run_real_time_orders, Path(stage_db("new_orders.db")), ("new_orders.db", "new_orders")),
+        ("Step 6: Preparing traffic data...", run_data_preparation, Path(stage_db("new_orders.db")), ("new_orders.db", "new_orders")),
+        ("Step 7: Training machine learning model...", run_model_training, Path(stage_db("new_orders.db")), ("new_orders.db", "new_orders")),
+        ("Step 8: Generating advanced traffic report...", run_advanced_report, Path(stage_db("managed_traffic.db")), ("managed_traffic.db", "managed_blocks")),
+        ("Step 9: Managing smart traffic...", run_smart_traffic, RESULT_DIR / "congestion_model.pkl", ("real_time_orders.db", "real_time_orders")),
+        ("Step 10: Self-healing network...", run_self_healing, Path(stage_db("smart_traffic.db")), ("smart_traffic.db", "smart_traffic")),
+        ("Step 11: Optimizing resources...", run_resource_optimization, Path(stage_db("self_healing.db")), ("self_healing.db", "healing_network")),
+        ("Step 12: Predictive analysis and anomaly detection...", run_predictive_analysis, RESULT_DIR / "congestion_model.pkl", ("new_orders.db", "new_orders")),
     ]
 
-    for step_message, step_function, required_file in steps:
-        try:
-            if required_file and not check_file_exists(required_file, step_message):
-                continue
-            logger.info(step_message)
-            result = step_function()
-            logger.info(f"Result: {result['summary']}")
-        except Exception as e:
-            logger.error(f"Error in {step_message}: {e}")
-            if demo:
-                logger.info("Continuing in DEMO mode despite error...")
-                continue
-            else:
-                sys.exit(1)
+    # ردیف‌های ضبط‌شده هر جدول پس از آخرین مرحله‌ای که آن را می‌خواند آزاد می‌شوند
+    last_reader = {upstream: index for index, (_, _, _, upstream) in enumerate(steps) if upstream is not None}
+
+    # در حالت fused خروجی هر مرحله مستقیم از حافظه به مرحله بعد داده می‌شود و SQLite فقط خروجی جانبی است
+    if fused:
+        logger.info(f"Running in fused in-memory mode (persist={persist})")
+        configure_writers(persist=persist, async_flush=True,
+                          capture={(stage_db(db_file), table) for db_file, table in last_reader})
+
+    try:
+        for index, (step_message, step_function, required_file, upstream) in enumerate(steps):
+            try:
+                streamed = fused and upstream is not None
+                if required_file and not (streamed and required_file.suffix == ".db") and not check_file_exists(required_file, step_message):
+                    continue
+                logger.info(step_message)
+                if streamed:
+                    result = step_function(upstream=captured_rows(stage_db(upstream[0]), upstream[1],
+                                                                  release=last_reader[upstream] == index))
+                else:
+                    result = step_function()
+                logger.info(f"Result: {result['summary']}")
+            except Exception as e:
+                logger.error(f"Error in {step_message}: {e}")
+                if demo:
+                    logger.info("Continuing in DEMO mode despite error...")
+                    continue
+                else:
+                    sys.exit(1)
+    finally:
+        if fused:
+            clear_captured()
+            configure_writers(persist=True, async_flush=False, capture=False)
 
     end_time = datetime.now()
     logger.info(f"Initial pipeline completed in {end_time - start_time}")
@@ -339,11 +420,20 @@ def run_pipeline(demo=False):
 # تابع اصلی
 def main():
     demo = "--demo" in sys.argv
-    run_pipeline(demo=demo)
+    fused = "--fused" in sys.argv
+    persist = "--no-persist" not in sys.argv
+    parallel = "--parallel" in sys.argv
+    run_pipeline(demo=demo, fused=fused, persist=persist, parallel=parallel)
     
     # شروع پردازش ریل‌تایم
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(real_time_processing())
+    tasks = [real_time_processing()]
+    if BLOCK_LOG:
+        tasks.append(block_log_export(float(os.getenv("BLOCK_LOG_EXPORT_INTERVAL", "5"))))
+    if "--incremental" in sys.argv:
+        interval = float(os.getenv("INCREMENTAL_INTERVAL", "5"))
+        tasks.append(incremental_processing(interval))
+    loop.run_until_complete(asyncio.gather(*tasks))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import logging
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent
+RESULT_DIR = ROOT_DIR / "result"
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.chain_db import stage_db
+
+# گراف وابستگی مراحل بر اساس فایل‌های ورودی و خروجی هر اسکریپت
+STAGES = {
+    "code01": {"module": "src.blockchain.code01_blockchain_initial_data",
+               "inputs": [], "outputs": ["traffic_data.db"]},
+    "code02": {"module": "src.blockchain.code02_blockchain_congestion_improved",
+               "inputs": ["traffic_data.db"], "outputs": ["congestion_data.db"]},
+    "code03": {"module": "src.blockchain.code03_blockchain_managed_traffic",
+               "inputs": ["traffic_data.db"], "outputs": ["managed_traffic.db"]},
+    "code04": {"module": "src.blockchain.code04_blockchain_with_new_orders",
+               "inputs": ["managed_traffic.db"], "outputs": ["new_orders.db"]},
+    "code05": {"module": "src.blockchain.code05_blockchain_with_real_time_orders",
+               "inputs": ["new_orders.db"], "outputs": ["real_time_orders.db"]},
+    "code06": {"module": "src.traffic.code06_traffic_data_preparation",
+               "inputs": ["new_orders.db"], "outputs": ["traffic_data.csv"]},
+    "code07": {"module": "src.traffic.code07_model_training",
+               "inputs": ["new_orders.db"], "outputs": ["congestion_model.pkl", "encoders.pkl"]},
+    "code08": {"module": "src.traffic.code08_advanced_traffic_report",
+               "inputs": ["managed_traffic.db"], "outputs": ["traffic_report.db"]},
+    "code09": {"module": "src.smart.code09_smart_traffic_management",
+               "inputs": ["real_time_orders.db", "congestion_model.pkl", "encoders.pkl"], "outputs": ["smart_traffic.db"]},
+    "code10": {"module": "src.smart.code10_self_healing_network",
+               "inputs": ["smart_traffic.db"], "outputs": ["self_healing.db"]},
+    "code11": {"module": "src.smart.code11_resource_optimization",
+               "inputs": ["self_healing.db"], "outputs": ["optimized_resources.db"]},
+    "code12": {"module": "src.smart.code12_predictive_analysis_and_anomaly_detection",
+               "inputs": ["new_orders.db", "congestion_model.pkl", "encoders.pkl"], "outputs": ["predictive_analysis.db"]},
+}
+
+# محاسبه مراحل پیش‌نیاز هر مرحله از روی فایل‌ها
+def stage_dependencies(stages=STAGES):
+    producers = {}
+    for name, stage in stages.items():
+        for output in stage["outputs"]:
+            producers[output] = name
+    return {
+        name: {producers[f] for f in stage["inputs"] if f in producers and producers[f] != name}
+        for name, stage in stages.items()
+    }
+
+# طولانی‌ترین مسیر زمانی در گراف (مسیر بحرانی)
+def critical_path(dependencies, durations):
+    finish = {}
+    previous = {}
+
+    def visit(name):
+        if name in finish:
+            return finish[name]
+        best, best_dep = 0.0, None
+        for dep in dependencies.get(name, ()):
+            if dep in durations and visit(dep) > best:
+                best, best_dep = finish[dep], dep
+        finish[name] = best + durations.get(name, 0.0)
+        previous[name] = best_dep
+        return finish[name]
+
+    for name in durations:
+        visit(name)
+    if not finish:
+        return [], 0.0
+    end = max(finish, key=finish.get)
+    total = finish[end]
+    path = []
+    while end is not None:
+        path.append(end)
+        end = previous[end]
+    return list(reversed(path)), total
+
+# اجرای یک مرحله در پروسه کارگر
+def _run_stage(name, module_name):
+    if str(ROOT_DIR) not in sys.path:
+        sys.path.append(str(ROOT_DIR))
+    start = time.time()
+    try:
+        module = importlib.import_module(module_name)
+        result = module.main()
+    except Exception as e:
+        result = {"status": "error", "block_count": 0, "summary": f"Stage {name} crashed", "error": str(e)}
+    return name, result, start, time.time()
+
+# زمان‌بند گراف: مراحل آماده به صورت هم‌زمان در pool پروسه‌ها اجرا می‌شوند
+def run_dag(stages=STAGES, max_workers=None, on_event=None):
+    def emit(message):
+        logging.info(message)
+        if on_event:
+            on_event(message)
+
+    dependencies = stage_dependencies(stages)
+    remaining = set(stages)
+    done, failed = set(), set()
+    results, durations = {}, {}
+    running = {}
+    wall_start = time.time()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), mp_context=context) as executor:
+        while remaining or running:
+            for name in sorted(remaining):
+                if dependencies[name] & failed:
+                    remaining.discard(name)
+                    failed.add(name)
+                    results[name] = {"status": "skipped", "block_count": 0,
+                                     "summary": f"Skipped because {', '.join(sorted(dependencies[name] & failed))} failed"}
+                    emit(f"Skipping {name}: upstream stage failed")
+                elif dependencies[name] <= done:
+                    missing = [f for f in stages[name]["inputs"] if not os.path.exists(stage_db(f, RESULT_DIR))]
+                    if missing:
+                        remaining.discard(name)
+                        failed.add(name)
+                        results[name] = {"status": "skipped", "block_count": 0,
+                                         "summary": f"Missing required files: {', '.join(missing)}"}
+                        emit(f"Skipping {name}: missing {', '.join(missing)}")
+                        continue
+                    remaining.discard(name)
+                    running[executor.submit(_run_stage, name, stages[name]["module"])] = name
+                    emit(f"Starting {name}...")
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    _, result, start, end = future.result()
+                except Exception as e:
+                    result, start, end = {"status": "error", "block_count": 0, "summary": f"Stage {name} crashed", "error": str(e)}, wall_start, time.time()
+                results[name] = result
+                durations[name] = end - start
+                if result.get("status") == "success":
+                    done.add(name)
+                else:
+                    failed.add(name)
+                emit(f"Finished {name} in {durations[name]:.2f}s: {result.get('summary')}")
+
+    wall_time = time.time() - wall_start
+    path, path_time = critical_path(dependencies, durations)
+    timing = {
+        "wall_time": round(wall_time, 2),
+        "serial_time": round(sum(durations.values()), 2),
+        "critical_path": path,
+        "critical_path_time": round(path_time, 2),
+        "stage_times": {name: round(t, 2) for name, t in sorted(durations.items())}
+    }
+    emit(f"Pipeline finished in {timing['wall_time']}s (serial {timing['serial_time']}s), "
+         f"critical path {' -> '.join(path)} = {timing['critical_path_time']}s")
+    return results, timing
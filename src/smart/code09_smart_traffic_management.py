@@ -1,13 +1,12 @@
 import os
-import random
 import hashlib
 import time
 from datetime import datetime
 import sqlite3
+from itertools import islice
 import json
 import logging
 import sys
-import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import joblib
@@ -22,23 +21,33 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "real_time_orders.db")
-output_db = os.path.join(RESULT_DIR, "smart_traffic.db")
 model_file = os.path.join(RESULT_DIR, "congestion_model.pkl")
 encoders_file = os.path.join(RESULT_DIR, "encoders.pkl")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, close_writers
+from src.blockchain.watermark import prepare_incremental, commit_watermark, fused_watermarks
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.node_state import NodeStateTable
+from src.smart.congestion_inference import CongestionScorer
+from src.smart.forest_engine import load_forest
+from src.smart.prediction_cache import model_version
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+input_db = stage_db("real_time_orders.db")
+output_db = stage_db("smart_traffic.db")
 
 # گراف نودها
-nodes = [f"Node_{i}" for i in range(1, 11)] + ["Genesis"]
-graph = {node: {"neighbors": random.sample(nodes, random.randint(1, 3)), 
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]} 
-         for node in nodes}
+topology = load_topology()
+nodes = topology.node_ids() + ["Genesis"]
 
 # وضعیت نودها
-node_status = {
-    node: {"max_capacity": 100, "current_traffic": 0, "active": True} if node != "Genesis" 
-    else {"max_capacity": 0, "current_traffic": 0, "active": False} 
-    for node in nodes
-}
+node_status = NodeStateTable(topology, max_capacity=100, current_traffic=0, active=True)
+node_status.set_node("Genesis", max_capacity=0, active=False)
 
 # آستانه‌های پویا
 thresholds = {"medium": 40, "high": 70}
@@ -57,34 +66,26 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS smart_traffic
                  (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL, network_health TEXT,
                   latency REAL, previous_hash TEXT, block_hash TEXT, congestion_level TEXT, 
-                  traffic_redistribution TEXT, event_type TEXT, predicted_congestion TEXT)''')
+                  traffic_redistribution TEXT, event_type TEXT, predicted_congestion TEXT, timestamp_us INTEGER)''')
     c.execute('''CREATE TABLE IF NOT EXISTS optimization_log
                  (timestamp TEXT, medium_threshold REAL, high_threshold REAL, high_blocks INTEGER)''')
     conn.commit()
+    ensure_stage_indexes(conn, "smart_traffic")
     conn.close()
     logging.info(f"Initialized output database at {output_db}")
 
 def save_to_db(block):
     try:
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("INSERT INTO smart_traffic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        get_writer(output_db).write("smart_traffic",
                   (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
                    block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
-                   block.congestion_level, block.traffic_redistribution, block.event_type, block.predicted_congestion))
-        conn.commit()
-        conn.close()
+                   block.congestion_level, block.traffic_redistribution, block.event_type, block.predicted_congestion, epoch_us(block.timestamp)))
     except sqlite3.Error as e:
         logging.error(f"Error saving block to database: {e}")
 
 def save_optimization_log(timestamp, medium_threshold, high_threshold, high_blocks):
     try:
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("INSERT INTO optimization_log VALUES (?, ?, ?, ?)",
-                  (timestamp, medium_threshold, high_threshold, high_blocks))
-        conn.commit()
-        conn.close()
+        get_writer(output_db).write("optimization_log", (timestamp, medium_threshold, high_threshold, high_blocks))
     except sqlite3.Error as e:
         logging.error(f"Error saving optimization log: {e}")
 
@@ -104,6 +105,10 @@ class SmartTrafficBlock:
         self.hash = self.calculate_hash()
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("smart", (self.timestamp, self.node_id, self.traffic_layer["type"], self.traffic_layer["volume"],
+                                        self.health_layer["status"], self.health_layer["latency"], self.previous_hash,
+                                        self.congestion_level, self.traffic_redistribution, self.event_type, self.predicted_congestion))
         block_string = json.dumps({
             "timestamp": self.timestamp, "node_id": self.node_id, "traffic_layer": self.traffic_layer,
             "health_layer": self.health_layer, "previous_hash": self.previous_hash,
@@ -115,7 +120,7 @@ class SmartTrafficBlock:
 # بارگذاری مدل و انکودرها
 def load_model_and_encoders():
     try:
-        model = joblib.load(model_file)
+        model = load_forest(model_file)
         encoders = joblib.load(encoders_file)
         le_node_id = encoders["node_id"]
         le_traffic_type = encoders["traffic_type"]
@@ -126,48 +131,10 @@ def load_model_and_encoders():
         logging.error(f"Failed to load model or encoders: {e}")
         raise
 
-# پیش‌بینی با مدل ML
-def predict_congestion(block, model, le_node_id, le_traffic_type, le_network_health):
-    try:
-        data = pd.DataFrame([{
-            "node_id": block.node_id,
-            "traffic_volume": block.traffic_layer["volume"],
-            "latency": block.health_layer["latency"],
-            "network_health": block.health_layer["status"],
-            "traffic_type": block.traffic_layer["type"]
-        }])
-
-        # تبدیل مقادیر متنی به عددی
-        for column in ["node_id", "traffic_type", "network_health"]:
-            if column in ["node_id", "traffic_type", "network_health"]:
-                known_values = set(eval(f"le_{column}").classes_)
-                if data[column].iloc[0] not in known_values:
-                    logging.warning(f"Unknown value in {column}: {data[column].iloc[0]}. Using default value.")
-                    data[column] = known_values.pop()  # استفاده از اولین مقدار شناخته‌شده
-                data[column] = eval(f"le_{column}").transform([data[column].iloc[0]])[0]
-
-        features = data[["node_id", "traffic_volume", "latency", "network_health", "traffic_type"]]
-        prediction = model.predict(features)[0]
-        score = model.decision_function(features)[0]
-
-        # تبدیل پیش‌بینی IsolationForest به سطح تراکم
-        if prediction == -1:
-            if score < -0.1:
-                predicted_level = "High"
-            else:
-                predicted_level = "Medium"
-        else:
-            predicted_level = "Low"
-
-        return predicted_level
-    except Exception as e:
-        logging.error(f"Prediction failed for block {block.node_id}: {e}")
-        return block.congestion_level
-
 # پخش ترافیک هوشمند
 def redistribute_traffic(node_id, excess_traffic):
     try:
-        neighbors = [n for n in graph[node_id]["neighbors"] if n != "Genesis" and node_status[n]["active"]]
+        neighbors = [n for n in topology.neighbors(node_id) if n != "Genesis" and node_status[n]["active"]]
         available_neighbors = [
             n for n in neighbors 
             if node_status[n]["current_traffic"] + excess_traffic / len(neighbors) <= node_status[n]["max_capacity"]
@@ -189,15 +156,18 @@ def redistribute_traffic(node_id, excess_traffic):
 
 # کلاس بلاک‌چین
 class TrafficBlockchain:
-    def __init__(self, limit=None):
+    def __init__(self, limit=None, rows=None):
         self.chain = []
         self.cache = {}
         self.block_history = []
-        self.load_from_db(limit)
+        self.load_from_db(limit, rows)
 
-    def load_from_db(self, limit):
+    def load_from_db(self, limit, rows=None):
         global db_cache
-        if input_db in db_cache:
+        if rows is not None:
+            rows = list(islice(rows, limit)) if limit else list(rows)
+            logging.info(f"Received {len(rows)} blocks from the previous stage")
+        elif input_db in db_cache:
             rows = db_cache[input_db]
             logging.info(f"Loaded {len(rows)} blocks from cache for {input_db}")
         else:
@@ -230,10 +200,9 @@ class TrafficBlockchain:
             tqdm.write(f"Loaded block for Node {row[1]} at {row[0]}")
         print(f"Processed {len(rows)} blocks")
 
-    def add_block(self, block, model, le_node_id, le_traffic_type, le_network_health):
+    def add_block(self, block, predicted_congestion):
         traffic_volume = block.traffic_layer["volume"]
         node_id = block.node_id
-        predicted_congestion = predict_congestion(block, model, le_node_id, le_traffic_type, le_network_health)
         
         if node_status[node_id]["active"]:
             node_status[node_id]["current_traffic"] = traffic_volume
@@ -302,21 +271,31 @@ class TrafficBlockchain:
         return report
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         init_db()
         model, le_node_id, le_traffic_type, le_network_health = load_model_and_encoders()
-        traffic_blockchain = TrafficBlockchain(limit)
+        after_rowid, last_rowid = 0, None
+        if upstream is None:
+            upstream, after_rowid, last_rowid = prepare_incremental(output_db, input_db, "real_time_orders", ["smart_traffic", "optimization_log"], limit)
+        else:
+            after_rowid, last_rowid = fused_watermarks(output_db, input_db, "real_time_orders", "smart_traffic")
+        traffic_blockchain = TrafficBlockchain(limit, upstream)
+        pending_blocks = traffic_blockchain.chain[1:] if after_rowid == 0 else traffic_blockchain.chain[:]
         last_time = time.time()
 
-        for node in nodes:
-            node_status[node]["current_traffic"] = 0
-            node_status[node]["active"] = node != "Genesis"
+        node_status.reset(current_traffic=0, active=True)
+        node_status.set_node("Genesis", active=False)
 
-        total_blocks = len(traffic_blockchain.chain[1:])
-        for idx, block in enumerate(tqdm(traffic_blockchain.chain[1:], desc="Processing Smart Traffic Blocks", file=sys.stdout)):
-            traffic_blockchain.add_block(block, model, le_node_id, le_traffic_type, le_network_health)
+        # پیش‌بینی تراکم همه بلاک‌ها در یک فراخوانی مدل پیش از منطق ترتیبی پخش ترافیک
+        scorer = CongestionScorer(model, le_node_id, le_traffic_type, le_network_health)
+        predictions = scorer.predict_blocks(pending_blocks, model_version(model_file, encoders_file, "smart"))
+
+        total_blocks = len(pending_blocks)
+        for idx, (block, predicted_congestion) in enumerate(tqdm(zip(pending_blocks, predictions), total=total_blocks,
+                                                                 desc="Processing Smart Traffic Blocks", file=sys.stdout)):
+            traffic_blockchain.add_block(block, predicted_congestion)
             print(f"\nProcessed block {idx + 1}/{total_blocks} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:")
             print(f"Node: {block.node_id}, Traffic: {block.traffic_layer['volume']:.2f} MB/s, "
                   f"Health: {block.health_layer['status']}, Congestion: {block.congestion_level}, "
@@ -329,6 +308,8 @@ def main():
             
             last_time = time.time()
 
+        commit_watermark(output_db, input_db, "real_time_orders", last_rowid, "smart_traffic")
+
         report = traffic_blockchain.generate_report()
         logging.info(f"Smart Traffic Management Report: {report}")
 
@@ -346,6 +327,8 @@ def main():
             "summary": "Failed to process smart traffic blocks",
             "error": str(e)
         }
+    finally:
+        close_writers(output_db)
 
 if __name__ == "__main__":
     result = main()
@@ -4,13 +4,13 @@ import hashlib
 import time
 from datetime import datetime
 import sqlite3
+from itertools import islice
+from collections import deque
 import json
 import logging
 import sys
 from tqdm import tqdm
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 from pathlib import Path
 
 # غیرفعال کردن بافرینگ خروجی
@@ -22,21 +22,29 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "smart_traffic.db")
-output_db = os.path.join(RESULT_DIR, "self_healing.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, close_writers
+from src.blockchain.watermark import prepare_incremental, commit_watermark, fused_watermarks, seed_rows
+from src.blockchain.signing import PendingSeals, sign_message, verify_message
+from src.blockchain.signers import encode_signature
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.node_state import NodeStateTable
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+input_db = stage_db("smart_traffic.db")
+output_db = stage_db("self_healing.db")
 
 # گراف نودها
-nodes = [f"Node_{i}" for i in range(1, 11)] + ["Genesis"]
-graph = {node: {"neighbors": random.sample(nodes, random.randint(1, 3)), 
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]} 
-         for node in nodes}
+topology = load_topology()
+nodes = topology.node_ids() + ["Genesis"]
 
 # وضعیت نودها
-node_status = {node: {"max_capacity": 100, "current_traffic": 0, "active": True} for node in nodes}
-
-# تولید کلیدهای ECDSA
-node_keys = {node: ec.generate_private_key(ec.SECP256R1(), default_backend()) for node in nodes}
-node_public_keys = {node: key.public_key() for node, key in node_keys.items()}
+node_status = NodeStateTable(topology, max_capacity=100, current_traffic=0, active=True)
 
 # دیتابیس SQLite
 def init_db():
@@ -50,22 +58,20 @@ def init_db():
                  (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL, network_health TEXT,
                   latency REAL, previous_hash TEXT, block_hash TEXT, congestion_level TEXT, 
                   traffic_redistribution TEXT, event_type TEXT, healing_action TEXT, predicted_congestion TEXT,
-                  signature TEXT)''')
+                  signature TEXT, timestamp_us INTEGER)''')
     conn.commit()
+    ensure_stage_indexes(conn, "healing_network")
     conn.close()
     logging.info(f"Initialized output database at {output_db}")
 
 def save_to_db(block):
     try:
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("INSERT INTO healing_network VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        get_writer(output_db).write("healing_network",
                   (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
                    block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
                    block.congestion_level, block.traffic_redistribution, block.event_type, block.healing_action,
-                   block.predicted_congestion, block.signature.hex() if block.signature else None))
-        conn.commit()
-        conn.close()
+                   block.predicted_congestion, encode_signature(block.signature, block.signature_scheme, block.merkle_proof) if block.signature else None,
+                   epoch_us(block.timestamp)))
     except sqlite3.Error as e:
         logging.error(f"Error saving block to database: {e}")
 
@@ -84,9 +90,16 @@ class HealingBlock:
         self.healing_action = healing_action
         self.predicted_congestion = predicted_congestion
         self.signature = signature
+        self.signature_scheme = None
+        self.merkle_proof = None
         self.hash = self.calculate_hash()
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("healing", (self.timestamp, self.node_id, self.traffic_layer["type"], self.traffic_layer["volume"],
+                                          self.health_layer["status"], self.health_layer["latency"], self.previous_hash,
+                                          self.congestion_level, self.traffic_redistribution, self.event_type, self.healing_action,
+                                          self.predicted_congestion))
         block_string = json.dumps({
             "timestamp": self.timestamp, "node_id": self.node_id, "traffic_layer": self.traffic_layer,
             "health_layer": self.health_layer, "previous_hash": self.previous_hash,
@@ -98,8 +111,8 @@ class HealingBlock:
 
     def sign_block(self, private_key):
         try:
-            message = self.hash.encode()
-            self.signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+            self.signature, self.signature_scheme = sign_message(private_key, self.hash.encode())
+            self.merkle_proof = None
             return True
         except Exception as e:
             logging.error(f"Signing failed for {self.node_id}: {e}")
@@ -110,7 +123,7 @@ class HealingBlock:
             if not self.signature:
                 logging.error(f"No signature found for block {self.node_id}")
                 return False
-            public_key.verify(self.signature, self.hash.encode(), ec.ECDSA(hashes.SHA256()))
+            verify_message(public_key, self.node_id, self.signature, self.hash.encode(), self.signature_scheme, self.merkle_proof)
             return True
         except Exception as e:
             logging.error(f"Signature verification failed for {self.node_id}: {e}")
@@ -118,7 +131,7 @@ class HealingBlock:
 
 # پخش ترافیک هوشمند
 def redistribute_traffic(node_id, excess_traffic):
-    neighbors = graph[node_id]["neighbors"]
+    neighbors = topology.neighbors(node_id)
     available_neighbors = [n for n in neighbors if node_status[n]["active"] and 
                            node_status[n]["current_traffic"] + excess_traffic / len(neighbors) <= node_status[n]["max_capacity"]]
     
@@ -133,41 +146,42 @@ def redistribute_traffic(node_id, excess_traffic):
     
     return ", ".join(redistribution)
 
-# محاسبه احتمال فعال‌سازی مجدد نود
-def calculate_reactivation_probability(node_id, chain):
-    node_blocks = [b for b in chain if b.node_id == node_id][-10:]
+# محاسبه احتمال فعال‌سازی مجدد نود (از ایندکس‌های زنجیره، بدون پیمایش کل زنجیره)
+def calculate_reactivation_probability(node_id, blockchain):
+    node_blocks = blockchain.recent_blocks.get(node_id)
     if not node_blocks:
         return 0.1
     
     up_blocks = sum(1 for b in node_blocks if b.health_layer["status"] == "Up")
     up_ratio = up_blocks / len(node_blocks)
     
-    neighbors = graph[node_id]["neighbors"]
-    healthy_neighbors = sum(1 for n in neighbors if any(b.health_layer["status"] == "Up" for b in chain if b.node_id == n))
+    neighbors = topology.neighbors(node_id)
+    healthy_neighbors = sum(1 for n in neighbors if n in blockchain.ever_up)
     neighbor_health_ratio = healthy_neighbors / len(neighbors) if neighbors else 0
     
     probability = 0.1 + (up_ratio * 0.4) + (neighbor_health_ratio * 0.3)
     return min(probability, 0.8)
 
 # مکانیزم خود-ترمیمی
-def self_heal(block, chain):
+def self_heal(block, blockchain):
     health = block.health_layer["status"]
     congestion = block.predicted_congestion
     node_id = block.node_id
-    neighbors = graph[node_id]["neighbors"]
+    neighbors = topology.neighbors(node_id)
     
     healthy_neighbors = []
     for neighbor in neighbors:
-        neighbor_blocks = [b for b in chain if b.node_id == neighbor]
-        if neighbor_blocks and neighbor_blocks[-1].health_layer["status"] == "Up":
+        latest = blockchain.latest_block.get(neighbor)
+        if latest is not None and latest.health_layer["status"] == "Up":
             healthy_neighbors.append(neighbor)
     
     healing_action = "None"
     if not node_status[node_id]["active"]:
-        reactivation_prob = calculate_reactivation_probability(node_id, chain)
+        reactivation_prob = calculate_reactivation_probability(node_id, blockchain)
         if random.random() < reactivation_prob:
             node_status[node_id]["active"] = True
             block.health_layer["status"] = "Up"
+            blockchain.ever_up.add(node_id)
             block.health_layer["latency"] = random.uniform(0, 5)
             healing_action = f"Node reactivated with probability {reactivation_prob:.2f}"
     
@@ -181,20 +195,58 @@ def self_heal(block, chain):
 
 # کلاس بلاک‌چین
 class TrafficBlockchain:
-    def __init__(self, limit=None):
+    def __init__(self, limit=None, rows=None):
         self.chain = []
         self.cache = {}
-        self.load_from_db(limit)
+        self.pending = PendingSeals(save_to_db)
+        # ایندکس‌های افزایشی برای خود-ترمیمی: آخرین بلاک، ۱۰ بلاک اخیر و نودهایی که تا کنون Up بوده‌اند
+        self.latest_block = {}
+        self.recent_blocks = {}
+        self.ever_up = set()
+        self.seed_from_output()
+        self.load_from_db(limit, rows)
+
+    # ایندکس‌های خود-ترمیمی و پنجره هر نود در اجرای افزایشی از آخرین بلاک‌های خروجی قبلی ادامه پیدا می‌کنند
+    def seed_from_output(self):
+        rows = seed_rows(output_db, "healing_network", ("timestamp", "node_id", "traffic_type", "traffic_volume",
+                                                            "network_health", "latency", "previous_hash", "congestion_level"), 10)
+        for row in rows:
+            block = HealingBlock(row[0], row[1], {"volume": row[3], "type": row[2]}, {"status": row[4], "latency": row[5]},
+                                 row[6], row[7])
+            self.index_block(block)
+            self.cache.setdefault(row[1], []).append(block)
+            if len(self.cache[row[1]]) > 4:
+                self.cache[row[1]].pop(0)
+        # ever_up به همه خروجی قبلی وابسته است نه فقط ۱۰ بلاک اخیر
+        if rows:
+            conn = sqlite3.connect(output_db)
+            try:
+                self.ever_up.update(node_id for node_id, in conn.execute(
+                    "SELECT DISTINCT node_id FROM healing_network WHERE network_health = 'Up'"))
+            finally:
+                conn.close()
 
-    def load_from_db(self, limit):
+    def index_block(self, block):
+        self.latest_block[block.node_id] = block
+        if block.node_id not in self.recent_blocks:
+            self.recent_blocks[block.node_id] = deque(maxlen=10)
+        self.recent_blocks[block.node_id].append(block)
+        if block.health_layer["status"] == "Up":
+            self.ever_up.add(block.node_id)
+
+    def load_from_db(self, limit, rows=None):
         try:
-            conn = sqlite3.connect(input_db)
-            c = conn.cursor()
-            query = "SELECT * FROM smart_traffic"
-            if limit:
-                query += f" LIMIT {limit}"
-            c.execute(query)
-            rows = c.fetchall()
+            if rows is None:
+                conn = sqlite3.connect(input_db)
+                c = conn.cursor()
+                query = "SELECT * FROM smart_traffic"
+                if limit:
+                    query += f" LIMIT {limit}"
+                c.execute(query)
+                rows = c.fetchall()
+                conn.close()
+            else:
+                rows = list(islice(rows, limit)) if limit else list(rows)
             for row in tqdm(rows, desc="Loading blocks from DB", file=sys.stdout):
                 traffic_layer = {"volume": row[3], "type": row[2]}
                 health_layer = {"status": row[4], "latency": row[5]}
@@ -202,13 +254,13 @@ class TrafficBlockchain:
                                     row[9], row[10], "None", row[11])
                 block.hash = row[7]
                 self.chain.append(block)
+                self.index_block(block)
                 if row[1] not in self.cache:
                     self.cache[row[1]] = []
                 self.cache[row[1]].append(block)
                 if len(self.cache[row[1]]) > 4:
                     self.cache[row[1]].pop(0)
                 tqdm.write(f"Loaded block for Node {row[1]} at {row[0]}")
-            conn.close()
             print(f"Loaded {len(rows)} blocks from {input_db}")
         except sqlite3.Error as e:
             logging.error(f"Error loading blocks from DB: {e}")
@@ -238,21 +290,18 @@ class TrafficBlockchain:
                     redistribution = redistribute_traffic(node_id, excess_traffic)
                     node_status[node_id]["current_traffic"] = max_capacity
 
-        reroute_action, healing_action = self_heal(block, self.chain)
+        reroute_action, healing_action = self_heal(block, self)
         new_block = HealingBlock(block.timestamp, node_id, block.traffic_layer, block.health_layer,
                                 block.previous_hash, block.congestion_level, redistribution, 
                                 block.event_type, healing_action, predicted_congestion)
-        new_block.sign_block(node_keys[node_id])
-        if not new_block.verify_signature(node_public_keys[node_id]):
-            logging.error(f"Invalid signature for block {new_block.node_id}, block discarded")
-            return False
         self.chain.append(new_block)
+        self.index_block(new_block)
         if node_id not in self.cache:
             self.cache[node_id] = []
         self.cache[node_id].append(new_block)
         if len(self.cache[node_id]) > 4:
             self.cache[node_id].pop(0)
-        save_to_db(new_block)
+        self.pending.add(new_block)
         return new_block
 
     def generate_report(self):
@@ -268,19 +317,23 @@ class TrafficBlockchain:
         return report
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         init_db()
-        traffic_blockchain = TrafficBlockchain(limit)
+        after_rowid, last_rowid = 0, None
+        if upstream is None:
+            upstream, after_rowid, last_rowid = prepare_incremental(output_db, input_db, "smart_traffic", ["healing_network"], limit)
+        else:
+            after_rowid, last_rowid = fused_watermarks(output_db, input_db, "smart_traffic", "healing_network")
+        traffic_blockchain = TrafficBlockchain(limit, upstream)
+        pending_blocks = traffic_blockchain.chain[1:] if after_rowid == 0 else traffic_blockchain.chain[:]
         last_time = time.time()
 
-        for node in nodes:
-            node_status[node]["current_traffic"] = 0
-            node_status[node]["active"] = True
+        node_status.reset(current_traffic=0, active=True)
 
-        total_blocks = len(traffic_blockchain.chain[1:])
-        for idx, block in enumerate(tqdm(traffic_blockchain.chain[1:], desc="Processing Self-Heal Blocks", file=sys.stdout)):
+        total_blocks = len(pending_blocks)
+        for idx, block in enumerate(tqdm(pending_blocks, desc="Processing Self-Heal Blocks", file=sys.stdout)):
             traffic_blockchain.add_block(block)
             print(f"\nProcessed block {idx + 1}/{total_blocks} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:")
             print(f"Node: {block.node_id}, Traffic: {block.traffic_layer['volume']:.2f} MB/s, "
@@ -289,6 +342,9 @@ def main():
                   f"Event: {block.event_type}, Healing: {block.healing_action}")
             last_time = time.time()
 
+        discarded = traffic_blockchain.pending.seal()
+        commit_watermark(output_db, input_db, "smart_traffic", last_rowid, "healing_network", discarded)
+
         report = traffic_blockchain.generate_report()
         logging.info(f"Self-Healing Network Report: {report}")
 
@@ -306,6 +362,8 @@ def main():
             "summary": "Failed to process self-healing blocks",
             "error": str(e)
         }
+    finally:
+        close_writers(output_db)
 
 if __name__ == "__main__":
     result = main()
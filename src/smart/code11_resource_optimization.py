@@ -1,16 +1,14 @@
 import os
-import random
 import hashlib
 import time
 from datetime import datetime
 import sqlite3
+from itertools import islice
 import json
 import logging
 import sys
 from tqdm import tqdm
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 from pathlib import Path
 
 # غیرفعال کردن بافرینگ خروجی
@@ -22,21 +20,29 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "self_healing.db")
-output_db = os.path.join(RESULT_DIR, "optimized_resources.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, close_writers
+from src.blockchain.watermark import prepare_incremental, commit_watermark, fused_watermarks
+from src.blockchain.signing import PendingSeals, sign_message, verify_message
+from src.blockchain.signers import encode_signature, decode_signature
+from src.blockchain.encoding import hash_block, legacy_hashing
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes
+from src.blockchain.node_state import NodeStateTable
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+input_db = stage_db("self_healing.db")
+output_db = stage_db("optimized_resources.db")
 
 # گراف نودها
-nodes = [f"Node_{i}" for i in range(1, 11)] + ["Genesis"]
-graph = {node: {"neighbors": random.sample(nodes, random.randint(1, 3)), 
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]} 
-         for node in nodes}
+topology = load_topology()
+nodes = topology.node_ids() + ["Genesis"]
 
 # وضعیت نودها
-node_status = {node: {"max_capacity": 100, "current_traffic": 0, "active": True, "allocated_bandwidth": 50} for node in nodes}
-
-# تولید کلیدهای ECDSA
-node_keys = {node: ec.generate_private_key(ec.SECP256R1(), default_backend()) for node in nodes}
-node_public_keys = {node: key.public_key() for node, key in node_keys.items()}
+node_status = NodeStateTable(topology, max_capacity=100, current_traffic=0, active=True, allocated_bandwidth=50)
 
 # دیتابیس SQLite
 def init_db():
@@ -50,22 +56,20 @@ def init_db():
                  (timestamp TEXT, node_id TEXT, traffic_type TEXT, traffic_volume REAL, network_health TEXT,
                   latency REAL, previous_hash TEXT, block_hash TEXT, congestion_level TEXT, 
                   traffic_redistribution TEXT, event_type TEXT, healing_action TEXT, predicted_congestion TEXT,
-                  resource_allocation TEXT, signature TEXT)''')
+                  resource_allocation TEXT, signature TEXT, timestamp_us INTEGER)''')
     conn.commit()
+    ensure_stage_indexes(conn, "optimized_resources")
     conn.close()
     logging.info(f"Initialized output database at {output_db}")
 
 def save_to_db(block):
     try:
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("INSERT INTO optimized_resources VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        get_writer(output_db).write("optimized_resources",
                   (block.timestamp, block.node_id, block.traffic_layer["type"], block.traffic_layer["volume"],
                    block.health_layer["status"], block.health_layer["latency"], block.previous_hash, block.hash,
                    block.congestion_level, block.traffic_redistribution, block.event_type, block.healing_action,
-                   block.predicted_congestion, block.resource_allocation, block.signature.hex() if block.signature else None))
-        conn.commit()
-        conn.close()
+                   block.predicted_congestion, block.resource_allocation, encode_signature(block.signature, block.signature_scheme, block.merkle_proof) if block.signature else None,
+                   epoch_us(block.timestamp)))
     except sqlite3.Error as e:
         logging.error(f"Error saving block to database: {e}")
 
@@ -86,9 +90,16 @@ class OptimizedBlock:
         self.predicted_congestion = predicted_congestion
         self.resource_allocation = resource_allocation or "None"
         self.signature = signature
+        self.signature_scheme = None
+        self.merkle_proof = None
         self.hash = self.calculate_hash()
 
     def calculate_hash(self):
+        if not legacy_hashing():
+            return hash_block("optimized", (self.timestamp, self.node_id, self.traffic_layer["type"], self.traffic_layer["volume"],
+                                            self.health_layer["status"], self.health_layer["latency"], self.previous_hash,
+                                            self.congestion_level, self.traffic_redistribution, self.event_type, self.healing_action,
+                                            self.predicted_congestion, self.resource_allocation))
         block_string = json.dumps({
             "timestamp": self.timestamp, "node_id": self.node_id, "traffic_layer": self.traffic_layer,
             "health_layer": self.health_layer, "previous_hash": self.previous_hash,
@@ -100,8 +111,8 @@ class OptimizedBlock:
 
     def sign_block(self, private_key):
         try:
-            message = self.hash.encode()
-            self.signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+            self.signature, self.signature_scheme = sign_message(private_key, self.hash.encode())
+            self.merkle_proof = None
             return True
         except Exception as e:
             logging.error(f"Signing failed for {self.node_id}: {e}")
@@ -112,34 +123,26 @@ class OptimizedBlock:
             if not self.signature:
                 logging.error(f"No signature found for block {self.node_id}")
                 return False
-            public_key.verify(self.signature, self.hash.encode(), ec.ECDSA(hashes.SHA256()))
+            verify_message(public_key, self.node_id, self.signature, self.hash.encode(), self.signature_scheme, self.merkle_proof)
             return True
         except Exception as e:
             logging.error(f"Signature verification failed for {self.node_id}: {e}")
             return False
 
 # تخصیص منابع پویا
-def optimize_resources(block, chain):
+def optimize_resources(block, blockchain):
     node_id = block.node_id
     traffic_volume = block.traffic_layer["volume"]
     predicted_congestion = block.predicted_congestion
     health = block.health_layer["status"]
-    neighbors = graph[node_id]["neighbors"]
-
-    traffic_by_node = {}
-    for b in chain:
-        if b.node_id not in traffic_by_node:
-            traffic_by_node[b.node_id] = []
-        traffic_by_node[b.node_id].append(b.traffic_layer["volume"])
-    
-    avg_traffic = {node: sum(volumes) / len(volumes) if volumes else 0 for node, volumes in traffic_by_node.items()}
-    high_traffic_nodes = [node for node, avg in avg_traffic.items() if avg > 50]
+    neighbors = topology.neighbors(node_id)
+    high_traffic = blockchain.average_traffic(node_id) > 50
 
     if "Priority" in block.traffic_layer["type"]:
         extra_bandwidth = 30
         node_status[node_id]["allocated_bandwidth"] += extra_bandwidth
         return f"Allocated {extra_bandwidth} MB/s extra bandwidth due to Priority traffic"
-    elif predicted_congestion in ["High", "Medium"] and node_id in high_traffic_nodes:
+    elif predicted_congestion in ["High", "Medium"] and high_traffic:
         healthy_neighbors = [n for n in neighbors if node_status[n]["active"] and node_status[n]["current_traffic"] < node_status[n]["max_capacity"]]
         if healthy_neighbors:
             reduced_bandwidth = 20
@@ -161,35 +164,66 @@ def optimize_resources(block, chain):
 
 # کلاس بلاک‌چین
 class TrafficBlockchain:
-    def __init__(self, limit=None):
+    def __init__(self, limit=None, rows=None):
         self.chain = []
         self.cache = {}
-        self.load_from_db(limit)
+        self.pending = PendingSeals(save_to_db)
+        # مجموع و تعداد ترافیک هر نود که با اضافه شدن هر بلاک به‌روز می‌شود
+        self.traffic_sum = {}
+        self.traffic_count = {}
+        self.seed_from_output()
+        self.load_from_db(limit, rows)
 
-    def load_from_db(self, limit):
+    # میانگین ترافیک هر نود در اجرای افزایشی از مجموع خروجی قبلی ادامه پیدا می‌کند نه فقط از ردیف‌های جدید
+    def seed_from_output(self):
+        conn = sqlite3.connect(output_db)
         try:
-            conn = sqlite3.connect(input_db)
-            c = conn.cursor()
-            query = "SELECT * FROM healing_network"
-            if limit:
-                query += f" LIMIT {limit}"
-            c.execute(query)
-            rows = c.fetchall()
+            for node_id, total, count in conn.execute(
+                    "SELECT node_id, SUM(traffic_volume), COUNT(*) FROM optimized_resources GROUP BY node_id"):
+                self.traffic_sum[node_id] = total
+                self.traffic_count[node_id] = count
+        finally:
+            conn.close()
+
+    def index_block(self, block):
+        node_id = block.node_id
+        self.traffic_sum[node_id] = self.traffic_sum.get(node_id, 0) + block.traffic_layer["volume"]
+        self.traffic_count[node_id] = self.traffic_count.get(node_id, 0) + 1
+
+    def average_traffic(self, node_id):
+        count = self.traffic_count.get(node_id, 0)
+        return self.traffic_sum[node_id] / count if count else 0
+
+    def load_from_db(self, limit, rows=None):
+        try:
+            if rows is None:
+                conn = sqlite3.connect(input_db)
+                c = conn.cursor()
+                query = "SELECT * FROM healing_network"
+                if limit:
+                    query += f" LIMIT {limit}"
+                c.execute(query)
+                rows = c.fetchall()
+                conn.close()
+            else:
+                rows = list(islice(rows, limit)) if limit else list(rows)
             for row in tqdm(rows, desc="Loading blocks from DB", file=sys.stdout):
                 traffic_layer = {"volume": row[3], "type": row[2]}
                 health_layer = {"status": row[4], "latency": row[5]}
-                signature = bytes.fromhex(row[13]) if row[13] else None
+                signature, signature_scheme, merkle_proof = decode_signature(row[13])
                 block = OptimizedBlock(row[0], row[1], traffic_layer, health_layer, row[6], row[8], 
                                       row[9], row[10], row[11], row[12], None, signature)
                 block.hash = row[7]
+                block.signature_scheme = signature_scheme
+                block.merkle_proof = merkle_proof
                 self.chain.append(block)
+                self.index_block(block)
                 if row[1] not in self.cache:
                     self.cache[row[1]] = []
                 self.cache[row[1]].append(block)
                 if len(self.cache[row[1]]) > 4:
                     self.cache[row[1]].pop(0)
                 tqdm.write(f"Loaded block for Node {row[1]} at {row[0]}")
-            conn.close()
             print(f"Loaded {len(rows)} blocks from {input_db}")
         except sqlite3.Error as e:
             logging.error(f"Error loading blocks from DB: {e}")
@@ -205,21 +239,18 @@ class TrafficBlockchain:
         else:
             node_status[node_id]["current_traffic"] = 0
         
-        resource_allocation = optimize_resources(block, self.chain)
+        resource_allocation = optimize_resources(block, self)
         new_block = OptimizedBlock(block.timestamp, node_id, block.traffic_layer, block.health_layer,
                                   block.previous_hash, block.congestion_level, block.traffic_redistribution, 
                                   block.event_type, block.healing_action, predicted_congestion, resource_allocation)
-        new_block.sign_block(node_keys[node_id])
-        if not new_block.verify_signature(node_public_keys[node_id]):
-            logging.error(f"Invalid signature for block {new_block.node_id}, block discarded")
-            return False
         self.chain.append(new_block)
+        self.index_block(new_block)
         if node_id not in self.cache:
             self.cache[node_id] = []
         self.cache[node_id].append(new_block)
         if len(self.cache[node_id]) > 4:
             self.cache[node_id].pop(0)
-        save_to_db(new_block)
+        self.pending.add(new_block)
         return new_block
 
     def generate_report(self):
@@ -237,20 +268,23 @@ class TrafficBlockchain:
         return report
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         init_db()
-        traffic_blockchain = TrafficBlockchain(limit)
+        after_rowid, last_rowid = 0, None
+        if upstream is None:
+            upstream, after_rowid, last_rowid = prepare_incremental(output_db, input_db, "healing_network", ["optimized_resources"], limit)
+        else:
+            after_rowid, last_rowid = fused_watermarks(output_db, input_db, "healing_network", "optimized_resources")
+        traffic_blockchain = TrafficBlockchain(limit, upstream)
+        pending_blocks = traffic_blockchain.chain[1:] if after_rowid == 0 else traffic_blockchain.chain[:]
         last_time = time.time()
 
-        for node in nodes:
-            node_status[node]["current_traffic"] = 0
-            node_status[node]["active"] = True
-            node_status[node]["allocated_bandwidth"] = 50
+        node_status.reset(current_traffic=0, active=True, allocated_bandwidth=50)
 
-        total_blocks = len(traffic_blockchain.chain[1:])
-        for idx, block in enumerate(tqdm(traffic_blockchain.chain[1:], desc="Processing Optimized Resource Blocks", file=sys.stdout)):
+        total_blocks = len(pending_blocks)
+        for idx, block in enumerate(tqdm(pending_blocks, desc="Processing Optimized Resource Blocks", file=sys.stdout)):
             traffic_blockchain.add_block(block)
             print(f"\nProcessed block {idx + 1}/{total_blocks} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:")
             print(f"Node: {block.node_id}, Traffic: {block.traffic_layer['volume']:.2f} MB/s, "
@@ -259,6 +293,9 @@ def main():
                   f"Resource Allocation: {block.resource_allocation}")
             last_time = time.time()
 
+        discarded = traffic_blockchain.pending.seal()
+        commit_watermark(output_db, input_db, "healing_network", last_rowid, "optimized_resources", discarded)
+
         report = traffic_blockchain.generate_report()
         logging.info(f"Resource Optimization Report: {report}")
 
@@ -276,6 +313,8 @@ def main():
             "summary": "Failed to process resource optimization blocks",
             "error": str(e)
         }
+    finally:
+        close_writers(output_db)
 
 if __name__ == "__main__":
     result = main()
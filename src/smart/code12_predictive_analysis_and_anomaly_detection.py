@@ -1,10 +1,12 @@
 import sqlite3
+from itertools import islice
 import joblib
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import logging
 import os
+import sys
 from sklearn.preprocessing import LabelEncoder
 from sklearn.ensemble import IsolationForest
 from tqdm import tqdm
@@ -16,16 +18,27 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-output_db = os.path.join(RESULT_DIR, "new_orders.db")
-predictive_db = os.path.join(RESULT_DIR, "predictive_analysis.db")
 model_path = os.path.join(RESULT_DIR, "congestion_model.pkl")
 encoders_path = os.path.join(RESULT_DIR, "encoders.pkl")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.timestamps import EPOCH_COLUMN, epoch_us, ensure_stage_indexes
+from src.blockchain.compact_schema import insert_rows
+from src.smart.forest_engine import load_forest
+from src.smart.prediction_cache import cached_scores, model_version
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+output_db = stage_db("new_orders.db")
+predictive_db = stage_db("predictive_analysis.db")
 
 # کلاس بلاک
 class TrafficBlock:
     def __init__(self, timestamp, node_id, traffic_layer, health_layer, previous_hash, hash_value, 
-                 congestion_layer=None, traffic_suggestion=None, is_congestion_order=False, signature=None):
+                 congestion_layer=None, traffic_suggestion=None, is_congestion_order=False, signature=None, timestamp_us=None):
         self.timestamp = timestamp
+        self.timestamp_us = timestamp_us if timestamp_us is not None else epoch_us(timestamp)
         self.node_id = node_id
         self.traffic_layer = traffic_layer or {"type": "Data", "volume": 0.0}
         self.health_layer = health_layer or {"status": "Normal", "latency": 0.0}
@@ -37,21 +50,29 @@ class TrafficBlock:
         self.signature = signature
 
 # کلاس بلاک‌چین
+# با since_us فقط بلاک‌های از آن زمان به بعد از روی ایندکس timestamp_us خوانده می‌شوند
 class TrafficBlockchain:
-    def __init__(self, limit=None):
+    def __init__(self, limit=None, rows=None, since_us=None):
         self.chain = []
-        self.load_from_db(limit)
+        self.load_from_db(limit, rows, since_us)
 
-    def load_from_db(self, limit):
+    def load_from_db(self, limit, rows=None, since_us=None):
         try:
-            conn = sqlite3.connect(output_db)
-            c = conn.cursor()
-            query = "SELECT * FROM new_orders ORDER BY timestamp DESC"
-            if limit:
-                query += f" LIMIT {limit}"
-            c.execute(query)
-            rows = c.fetchall()
-            conn.close()
+            if rows is None:
+                # ستون و ایندکس timestamp_us جدول new_orders را init_db مرحله ۴ می‌سازد؛ مراحل خواننده آن را تغییر نمی‌دهند
+                conn = sqlite3.connect(output_db, timeout=30)
+                c = conn.cursor()
+                query = f"SELECT * FROM new_orders WHERE {EPOCH_COLUMN} >= ? ORDER BY {EPOCH_COLUMN} DESC"
+                if limit:
+                    query += f" LIMIT {limit}"
+                c.execute(query, (since_us if since_us is not None else -2 ** 63,))
+                rows = c.fetchall()
+                conn.close()
+            else:
+                rows = [row for row in rows if since_us is None or (self._row_epoch(row) or -2 ** 63) >= since_us]
+                # ترتیب مانند شاخه SQL بر اساس timestamp_us (مرتب‌سازی رشته زمان با قالب‌های مختلف درست نیست)
+                rows = sorted(rows, key=lambda row: self._row_epoch(row) or -2 ** 63, reverse=True)
+                rows = list(islice(rows, limit)) if limit else rows
 
             logging.info(f"Loading {len(rows)} blocks from DB")
             for row in tqdm(rows, desc="Loading blocks from DB"):
@@ -64,7 +85,9 @@ class TrafficBlockchain:
                     "level": row[8] or "Low"
                 }
                 try:
-                    signature = bytes.fromhex(row[13]) if row[13] and row[13] != '0' else None
+                    # امضا به صورت "scheme:hex[:proof]" یا hex قدیمی ذخیره شده است
+                    signature_hex = row[13].split(":")[1] if row[13] and ":" in row[13] else row[13]
+                    signature = bytes.fromhex(signature_hex) if signature_hex and signature_hex != '0' else None
                 except (ValueError, IndexError) as e:
                     logging.warning(f"Invalid signature format for block at timestamp {row[0]}: {e}")
                     signature = None
@@ -79,30 +102,31 @@ class TrafficBlockchain:
                     congestion_layer=congestion_layer,
                     traffic_suggestion=row[11] or "None",
                     is_congestion_order=bool(row[12] or 0),
-                    signature=signature
+                    signature=signature,
+                    timestamp_us=self._row_epoch(row)
                 )
                 self.chain.append(block)
         except sqlite3.Error as e:
             logging.error(f"Error loading blockchain from DB: {e}")
             self.chain = []
 
+    # ردیف‌های جدول جدید ستون timestamp_us را در انتها دارند؛ برای ردیف‌های قدیمی از رشته زمان محاسبه می‌شود
+    @staticmethod
+    def _row_epoch(row):
+        return row[14] if len(row) > 14 and row[14] is not None else epoch_us(row[0])
+
     def get_last_block(self):
         return self.chain[-1] if self.chain else None
 
     def get_blocks_in_time_range(self, start_time, end_time):
-        start = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
-        end = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
+        start = epoch_us(datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S'))
+        end = epoch_us(datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S'))
         filtered_blocks = []
         for block in self.chain:
-            try:
-                block_time = datetime.strptime(block.timestamp, '%Y-%m-%dT%H:%M:%S.%f')
-            except ValueError:
-                try:
-                    block_time = datetime.strptime(block.timestamp, '%Y-%m-%dT%H:%M:%S')
-                except ValueError as e:
-                    logging.warning(f"Invalid timestamp format for block: {block.timestamp}, error: {e}")
-                    continue
-            if start <= block_time <= end:
+            if block.timestamp_us is None:
+                logging.warning(f"Invalid timestamp format for block: {block.timestamp}")
+                continue
+            if start <= block.timestamp_us <= end:
                 filtered_blocks.append(block)
         return filtered_blocks
 
@@ -111,12 +135,15 @@ class PredictiveAnalysis:
     def __init__(self):
         self.model = None
         self.label_encoders = {}
+        # نسخه مدل برای کش پیش‌بینی؛ با مدل پیش‌فرض یا انکودر بازسازی‌شده کش استفاده نمی‌شود
+        self.cache_version = None
         self.load_model_and_encoders()
 
     def load_model_and_encoders(self):
         try:
-            self.model = joblib.load(model_path)
+            self.model = load_forest(model_path)
             self.label_encoders = joblib.load(encoders_path)
+            self.cache_version = model_version(model_path, encoders_path, "predictive")
             logging.info(f"Loaded model from {model_path} and encoders from {encoders_path}")
             for column in ['node_id', 'traffic_type', 'network_health']:
                 if column in self.label_encoders:
@@ -182,10 +209,12 @@ class PredictiveAnalysis:
                     df[column] = encoder.transform(df[column].astype(str))
                 except Exception as e:
                     logging.error(f"Error encoding {column}: {e}")
+                    self.cache_version = None
                     self.label_encoders[column] = LabelEncoder()
                     df[column] = self.label_encoders[column].fit_transform(df[column].astype(str))
             else:
                 logging.warning(f"No encoder for {column}. Fitting a new one.")
+                self.cache_version = None
                 self.label_encoders[column] = LabelEncoder()
                 df[column] = self.label_encoders[column].fit_transform(df[column].astype(str))
 
@@ -194,7 +223,7 @@ class PredictiveAnalysis:
 
         return df
 
-    def predict_congestion(self, data):
+    def predict_congestion(self, data, block_hashes=None):
         if data.empty:
             logging.warning("No data to predict.")
             return [], []
@@ -208,8 +237,12 @@ class PredictiveAnalysis:
             features = np.nan_to_num(features, 0.0)
 
         try:
-            congestion_scores = self.model.decision_function(features)
-            predictions = self.model.predict(features)
+            if block_hashes is None or self.cache_version is None:
+                congestion_scores = self.model.decision_function(features)
+            else:
+                congestion_scores = cached_scores(block_hashes, self.cache_version,
+                                                  lambda missing: self.model.decision_function(features[missing]))
+            predictions = np.where(congestion_scores < 0, -1, 1)
             logging.info(f"Predictions sample: {predictions[:5]}")
             logging.info(f"Congestion scores sample: {congestion_scores[:5]}")
         except Exception as e:
@@ -256,12 +289,13 @@ def save_predictions_to_db(congestion_predictions, congestion_scores, anomalies,
         c = conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS predictive_analysis (
                      timestamp TEXT, node_id TEXT, traffic_volume REAL, congestion_level TEXT, predicted_congestion TEXT,
-                     anomaly_detected INTEGER, congestion_score REAL)''')
+                     anomaly_detected INTEGER, congestion_score REAL, timestamp_us INTEGER)''')
+        ensure_stage_indexes(conn, "predictive_analysis")
 
-        for block, pred, score, anomaly in zip(blocks, congestion_predictions, congestion_scores, anomalies):
-            c.execute("INSERT INTO predictive_analysis VALUES (?, ?, ?, ?, ?, ?, ?)",
-                      (block.timestamp, block.node_id, block.traffic_layer["volume"], block.congestion_layer["level"],
-                       pred, 1 if anomaly == -1 else 0, score))
+        insert_rows(conn, "predictive_analysis",
+                    [(block.timestamp, block.node_id, block.traffic_layer["volume"], block.congestion_layer["level"],
+                      pred, 1 if anomaly == -1 else 0, score, block.timestamp_us)
+                     for block, pred, score, anomaly in zip(blocks, congestion_predictions, congestion_scores, anomalies)])
         conn.commit()
         conn.close()
         logging.info("Predictions saved to DB")
@@ -269,10 +303,14 @@ def save_predictions_to_db(congestion_predictions, congestion_scores, anomalies,
         logging.error(f"Error saving predictions to DB: {e}")
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         limit = 100 if os.getenv("DEMO_MODE") == "True" else None
-        traffic_blockchain = TrafficBlockchain(limit)
+        end_time = datetime.now()
+        start_time = end_time - timedelta(hours=1)
+        # فقط پنجره یک ساعت اخیر از دیتابیس خوانده و رمزگشایی می‌شود
+        window_start = start_time.strftime('%Y-%m-%d %H:%M:%S')
+        traffic_blockchain = TrafficBlockchain(limit, upstream, epoch_us(window_start))
         if not traffic_blockchain.chain:
             logging.warning("No blocks found in the blockchain")
             return {
@@ -283,10 +321,8 @@ def main():
             }
 
         analysis = PredictiveAnalysis()
-        end_time = datetime.now()
-        start_time = end_time - timedelta(hours=1)
         recent_blocks = traffic_blockchain.get_blocks_in_time_range(
-            start_time.strftime('%Y-%m-%d %H:%M:%S'),
+            window_start,
             end_time.strftime('%Y-%m-%d %H:%M:%S')
         )
 
@@ -300,7 +336,7 @@ def main():
             }
 
         data = analysis.preprocess_data(recent_blocks)
-        congestion_predictions, congestion_scores = analysis.predict_congestion(data)
+        congestion_predictions, congestion_scores = analysis.predict_congestion(data, [block.hash for block in recent_blocks])
         anomalies = analysis.detect_anomalies(data)
 
         save_predictions_to_db(congestion_predictions, congestion_scores, anomalies, recent_blocks)
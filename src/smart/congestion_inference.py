@@ -0,0 +1,64 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from src.smart.prediction_cache import cached_scores, levels_from_scores
+
+# ترتیب ستون‌های ورودی مدل (همان ترتیب آموزش در code07)
+FEATURE_COLUMNS = ["node_id", "traffic_volume", "latency", "network_health", "traffic_type"]
+CATEGORICAL_COLUMNS = ["node_id", "traffic_type", "network_health"]
+
+# استنتاج دسته‌ای تراکم: کدگذاری برداری با آرایه‌های جستجوی از پیش ساخته و یک فراخوانی decision_function
+class CongestionScorer:
+    def __init__(self, model, le_node_id, le_traffic_type, le_network_health):
+        self.model = model
+        encoders = {"node_id": le_node_id, "traffic_type": le_traffic_type, "network_health": le_network_health}
+        # classes_ در LabelEncoder مرتب است و کد هر مقدار اندیس آن در classes_ است
+        self.classes = {column: np.asarray(encoder.classes_).astype(str) for column, encoder in encoders.items()}
+
+    # مقادیر ناشناخته به اولین مقدار شناخته‌شده نگاشت می‌شوند
+    def encode_column(self, column, values):
+        classes = self.classes[column]
+        values = np.asarray(values).astype(str)
+        codes = np.searchsorted(classes, values)
+        codes[codes >= len(classes)] = 0
+        unknown = classes[codes] != values
+        if unknown.any():
+            logging.warning(f"Unknown values in {column}: {sorted(set(values[unknown].tolist()))}. Using default value.")
+            codes[unknown] = 0
+        return codes
+
+    def features(self, node_ids, volumes, latencies, healths, traffic_types):
+        return pd.DataFrame({
+            "node_id": self.encode_column("node_id", node_ids),
+            "traffic_volume": np.asarray(volumes, dtype=float),
+            "latency": np.asarray(latencies, dtype=float),
+            "network_health": self.encode_column("network_health", healths),
+            "traffic_type": self.encode_column("traffic_type", traffic_types)
+        }, columns=FEATURE_COLUMNS)
+
+    def block_features(self, blocks):
+        return self.features([b.node_id for b in blocks],
+                             [b.traffic_layer["volume"] for b in blocks],
+                             [b.health_layer["latency"] for b in blocks],
+                             [b.health_layer["status"] for b in blocks],
+                             [b.traffic_layer["type"] for b in blocks])
+
+    def score(self, features):
+        return self.model.decision_function(features)
+
+    # سطح پیش‌بینی‌شده برای همه بلاک‌ها؛ در صورت خطا سطح تراکم فعلی هر بلاک برگردانده می‌شود
+    # با cache_version امتیاز بلاک‌ها از کش مشترک (بر اساس هش بلاک) خوانده و فقط بلاک‌های جدید امتیازدهی می‌شوند
+    def predict_blocks(self, blocks, cache_version=None):
+        blocks = list(blocks)
+        if not blocks:
+            return []
+        try:
+            if cache_version is None:
+                return levels_from_scores(self.score(self.block_features(blocks)))
+            return levels_from_scores(cached_scores(
+                [block.hash for block in blocks], cache_version,
+                lambda missing: self.score(self.block_features([blocks[i] for i in missing]))))
+        except Exception as e:
+            logging.error(f"Batch prediction failed for {len(blocks)} blocks: {e}")
+            return [block.congestion_level for block in blocks]
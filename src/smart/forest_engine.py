@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from pathlib import Path
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+RESULT_DIR = ROOT_DIR / "result"
+model_file = os.path.join(RESULT_DIR, "congestion_model.pkl")
+
+_ARRAYS = ("feature", "threshold", "children", "leaf_depth", "roots")
+
+# تعداد سطرهای هر تکه پیمایش؛ تکه‌های کوچک آرایه‌های میانی را در کش نگه می‌دارند
+FOREST_CHUNK_ROWS = int(os.getenv("FOREST_CHUNK_ROWS", "256"))
+
+# طول مسیر میانگین جستجوی ناموفق در درخت با n نمونه (همان _average_path_length در sklearn)
+def average_path_length(n_samples):
+    n_samples = np.asarray(n_samples, dtype=float)
+    result = np.zeros(n_samples.shape)
+    result[n_samples == 2] = 1.0
+    rest = n_samples > 2
+    result[rest] = 2.0 * (np.log(n_samples[rest] - 1.0) + np.euler_gamma) - 2.0 * (n_samples[rest] - 1.0) / n_samples[rest]
+    return result
+
+def _node_depths(left, right):
+    depths = np.zeros(len(left), dtype=float)
+    depths[0] = 1.0
+    for node in range(len(left)):
+        if left[node] >= 0:
+            depths[left[node]] = depths[node] + 1.0
+            depths[right[node]] = depths[node] + 1.0
+    return depths
+
+# جنگل IsolationForest به صورت آرایه‌های مسطح NumPy؛ گره‌های همه درخت‌ها پشت سر هم و فرزندها با اندیس سراسری
+# برگ‌ها به خودشان اشاره می‌کنند (آستانه بی‌نهایت) تا پیمایش بدون شرط برگ به تعداد عمق درخت تکرار شود
+class FlatForest:
+    def __init__(self, feature, threshold, children, leaf_depth, roots, max_depth, denominator, offset, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.leaf_depth = leaf_depth
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.denominator = float(denominator)
+        self.offset_ = float(offset)
+        self.n_features_in_ = int(n_features)
+
+    @classmethod
+    def from_model(cls, model):
+        features, thresholds, children, leaf_depths, roots = [], [], [], [], []
+        start = 0
+        max_depth = 0
+        for tree, tree_features in zip(model.estimators_, model.estimators_features_):
+            t = tree.tree_
+            left = t.children_left.astype(np.int64)
+            right = t.children_right.astype(np.int64)
+            feature = t.feature.astype(np.int64)
+            # اگر درخت روی زیرمجموعه‌ای از ستون‌ها آموزش دیده باشد اندیس ستون به ستون اصلی برگردانده می‌شود
+            if len(tree_features) != model.n_features_in_:
+                feature = np.where(feature >= 0, np.asarray(tree_features)[np.maximum(feature, 0)], feature)
+            depths = _node_depths(left, right)
+            # سهم هر برگ در عمق کل، با همان ترتیب عملیات sklearn
+            leaf_depths.append(depths + average_path_length(t.n_node_samples) - 1.0)
+            is_split = left >= 0
+            own = np.arange(start, start + len(left))
+            children.append(np.stack([np.where(is_split, left + start, own), np.where(is_split, right + start, own)], axis=1))
+            features.append(np.where(is_split, feature, 0))
+            thresholds.append(np.where(is_split, t.threshold.astype(np.float64), np.inf))
+            roots.append(start)
+            max_depth = max(max_depth, int(depths.max()) - 1)
+            start += len(left)
+        denominator = len(model.estimators_) * average_path_length([model._max_samples])[0]
+        return cls(np.concatenate(features), np.concatenate(thresholds), np.concatenate(children).ravel(),
+                   np.concatenate(leaf_depths), np.asarray(roots, dtype=np.int64), max_depth,
+                   denominator, model.offset_, model.n_features_in_)
+
+    # نوشتن اتمیک تا مراحل موازی فایل نیمه‌کاره نخوانند
+    def save(self, path):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(str(path)) or ".", suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, max_depth=self.max_depth, denominator=self.denominator, offset=self.offset_,
+                     n_features=self.n_features_in_, **{name: getattr(self, name) for name in _ARRAYS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(*(data[name] for name in _ARRAYS), data["max_depth"], data["denominator"],
+                       data["offset"], data["n_features"])
+
+    # پیمایش دسته‌ای همه سطرها در همه درخت‌ها؛ ورودی مثل sklearn به float32 تبدیل می‌شود
+    def score_samples(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {X.shape[-1]} features, but FlatForest is expecting {self.n_features_in_} features as input.")
+        if len(X) > FOREST_CHUNK_ROWS:
+            return np.concatenate([self.score_samples(X[i:i + FOREST_CHUNK_ROWS])
+                                   for i in range(0, len(X), FOREST_CHUNK_ROWS)])
+        rows, trees = X.shape[0], len(self.roots)
+        values = X.ravel()
+        base = np.repeat(np.arange(rows) * self.n_features_in_, trees)
+        node = np.tile(self.roots, rows)
+        for _ in range(self.max_depth):
+            go_right = values[base + self.feature[node]] > self.threshold[node]
+            node = self.children[2 * node + go_right]
+        # cumsum جمع را درخت به درخت به همان ترتیب sklearn انجام می‌دهد تا نتیجه بیت به بیت یکسان باشد
+        depths = np.cumsum(self.leaf_depth[node].reshape(rows, trees), axis=1)[:, -1] if rows else np.zeros(0)
+        if self.denominator == 0:
+            return -np.ones(rows)
+        return -(2 ** (-(depths / self.denominator)))
+
+    def decision_function(self, X):
+        return self.score_samples(X) - self.offset_
+
+    def predict(self, X):
+        return np.where(self.decision_function(X) < 0, -1, 1)
+
+# بارگذاری مدل مسطح؛ نسخه تبدیل‌شده کنار فایل مدل نگه داشته و در صورت تغییر مدل دوباره ساخته می‌شود
+def load_forest(path=model_file):
+    flat_path = os.path.splitext(str(path))[0] + ".forest.npz"
+    if os.path.exists(flat_path) and os.path.getmtime(flat_path) >= os.path.getmtime(path):
+        return FlatForest.load(flat_path)
+    import joblib
+    forest = FlatForest.from_model(joblib.load(path))
+    forest.save(flat_path)
+    return forest
+
+# مقایسه خروجی با sklearn روی داده‌های نمونه
+def check_parity(model, forest, X):
+    expected = model.decision_function(X)
+    actual = forest.decision_function(X)
+    return {"rows": len(X), "exact": bool(np.array_equal(expected, actual)),
+            "max_abs_diff": float(np.max(np.abs(expected - actual))) if len(X) else 0.0,
+            "labels_match": bool(np.array_equal(model.predict(X), forest.predict(X)))}
+
+if __name__ == "__main__":
+    import joblib
+    import pandas as pd
+    if str(ROOT_DIR) not in sys.path:
+        sys.path.append(str(ROOT_DIR))
+    from src.smart.congestion_inference import FEATURE_COLUMNS
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    model = joblib.load(model_file)
+    forest = FlatForest.from_model(model)
+    rng = np.random.default_rng(0)
+    # همان ستون‌های آموزش مدل تا sklearn هشدار نام ویژگی‌ها ندهد
+    X = pd.DataFrame(np.column_stack([rng.integers(0, 11, rows), rng.uniform(0, 150, rows), rng.uniform(0, 50, rows),
+                                      rng.integers(0, 4, rows), rng.integers(0, 4, rows)]).astype(float),
+                     columns=FEATURE_COLUMNS)
+    parity = check_parity(model, forest, X)
+    print(parity)
+    # عدم تطابق با sklearn خطاست و با کد خروج غیرصفر گزارش می‌شود
+    if not (parity["exact"] and parity["labels_match"]):
+        print("FlatForest output does not match sklearn")
+        sys.exit(1)
+    for label, scorer in (("sklearn", model.decision_function), ("flat", forest.decision_function)):
+        start = time.perf_counter()
+        for i in range(200):
+            scorer(X[i:i + 1])
+        single = (time.perf_counter() - start) / 200
+        start = time.perf_counter()
+        scorer(X)
+        batch = (time.perf_counter() - start) / rows
+        print(f"{label:<8} single row {single * 1e6:10.1f} us   batch {batch * 1e6:8.2f} us/row")
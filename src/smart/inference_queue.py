@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from src.smart.prediction_cache import levels_from_scores
+
+# حداکثر اندازه هر دسته و حداکثر زمان انتظار برای پر شدن دسته
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", "256"))
+INFERENCE_MAX_DELAY_MS = float(os.getenv("INFERENCE_MAX_DELAY_MS", "5"))
+
+# صف استنتاج: بلاک‌ها تا N عدد یا M میلی‌ثانیه جمع و در یک فراخوانی برداری در ترد جدا امتیازدهی می‌شوند
+class InferenceQueue:
+    def __init__(self, scorer, max_batch=INFERENCE_BATCH_SIZE, max_delay_ms=INFERENCE_MAX_DELAY_MS):
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.queue = None
+        self.worker = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.batches = 0
+        self.blocks = 0
+        self.max_batch_size = 0
+        self.total_delay = 0.0
+        self.max_delay_seen = 0.0
+
+    async def start(self):
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown(wait=False)
+
+    # خروجی: (سطح تراکم، امتیاز)؛ در صورت خطای مدل سطح فعلی بلاک و امتیاز None
+    async def predict(self, block):
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((block, future, time.perf_counter()))
+        return await future
+
+    def _score(self, blocks):
+        scores = self.scorer.score(self.scorer.block_features(blocks))
+        return levels_from_scores(scores), scores.tolist()
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            started = time.perf_counter()
+            blocks = [block for block, _, _ in batch]
+            try:
+                levels, scores = await loop.run_in_executor(self.executor, self._score, blocks)
+            except Exception as e:
+                logging.error(f"Batch prediction failed for {len(blocks)} blocks: {e}")
+                levels, scores = [block.congestion_level for block in blocks], [None] * len(blocks)
+            self._record(batch, started)
+            for (_, future, _), level, score in zip(batch, levels, scores):
+                if not future.done():
+                    future.set_result((level, score))
+
+    def _record(self, batch, started):
+        self.batches += 1
+        self.blocks += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        for _, _, enqueued in batch:
+            delay = started - enqueued
+            self.total_delay += delay
+            self.max_delay_seen = max(self.max_delay_seen, delay)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "blocks": self.blocks,
+            "mean_batch_size": round(self.blocks / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "mean_queue_delay_ms": round(self.total_delay / self.blocks * 1000, 3) if self.blocks else 0.0,
+            "max_queue_delay_ms": round(self.max_delay_seen * 1000, 3)
+        }
@@ -0,0 +1,97 @@
+import os
+import sys
+import hashlib
+import logging
+import sqlite3
+import numpy as np
+from pathlib import Path
+
+# کش پیش‌بینی مدل بر اساس (block_hash, model_version) مشترک بین مراحل و اجراها
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+PREDICTION_CACHE_DB = os.getenv("PREDICTION_CACHE_DB", os.path.join(ROOT_DIR, "result", "prediction_cache.db"))
+PREDICTION_CACHE = "--no-prediction-cache" not in sys.argv and os.getenv("PREDICTION_CACHE", "True") != "False"
+
+# تبدیل امتیاز IsolationForest به سطح تراکم: امتیاز منفی ناهنجاری است و زیر -0.1 تراکم بالا
+def levels_from_scores(scores):
+    scores = np.asarray(scores)
+    return np.where(scores < 0, np.where(scores < -0.1, "High", "Medium"), "Low").tolist()
+
+# حداکثر پارامترهای هر کوئری IN
+_LOOKUP_CHUNK = 900
+_versions = {}
+
+# نسخه مدل: هش محتوای فایل مدل و انکودرها به همراه نام چیدمان ویژگی‌ها (ترتیب ستون‌های هر مرحله)
+def model_version(model_path, encoders_path, variant):
+    stamp = tuple((str(p), os.path.getmtime(p), os.path.getsize(p)) for p in (model_path, encoders_path))
+    if stamp not in _versions:
+        digest = hashlib.sha256()
+        for path in (model_path, encoders_path):
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        _versions[stamp] = digest.hexdigest()[:16]
+    return f"{_versions[stamp]}/{variant}"
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute('''CREATE TABLE IF NOT EXISTS predictions
+                    (block_hash TEXT, model_version TEXT, score REAL, label TEXT, anomaly INTEGER,
+                     PRIMARY KEY (block_hash, model_version)) WITHOUT ROWID''')
+    return conn
+
+# بلاک‌های بدون هش (مثل سفارش‌های ثبت‌شده از داشبورد با block_hash برابر NULL یا NaN در pandas) کلید کش ندارند
+def _cacheable(block_hash):
+    return isinstance(block_hash, str) and block_hash != ""
+
+def lookup(block_hashes, version, db_path=PREDICTION_CACHE_DB):
+    keys = sorted(set(block_hash for block_hash in block_hashes if _cacheable(block_hash)))
+    found = {}
+    if not keys:
+        return found
+    conn = _connect(db_path)
+    try:
+        for i in range(0, len(keys), _LOOKUP_CHUNK):
+            chunk = keys[i:i + _LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            for block_hash, score, label, anomaly in conn.execute(
+                    f"SELECT block_hash, score, label, anomaly FROM predictions "
+                    f"WHERE model_version = ? AND block_hash IN ({placeholders})", [version] + chunk):
+                found[block_hash] = (score, label, anomaly)
+    finally:
+        conn.close()
+    return found
+
+def store(block_hashes, version, scores, db_path=PREDICTION_CACHE_DB):
+    labels = levels_from_scores(scores)
+    rows = [(block_hash, version, float(score), label, 1 if score < 0 else 0)
+            for block_hash, score, label in zip(block_hashes, scores, labels) if _cacheable(block_hash)]
+    if not rows:
+        return
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+
+# امتیاز همه بلاک‌ها؛ فقط بلاک‌های نبود در کش با compute(اندیس‌ها) امتیازدهی و سپس ذخیره می‌شوند
+# هر خطای کش به امتیازدهی بدون کش برمی‌گردد تا هیچ پیش‌بینی‌ای از دست نرود
+def cached_scores(block_hashes, version, compute, db_path=PREDICTION_CACHE_DB):
+    block_hashes = list(block_hashes)
+    if not PREDICTION_CACHE or not block_hashes:
+        return np.asarray(compute(list(range(len(block_hashes)))), dtype=float)
+    try:
+        found = lookup(block_hashes, version, db_path)
+    except Exception as e:
+        logging.error(f"Prediction cache lookup failed, scoring without cache: {e}")
+        return np.asarray(compute(list(range(len(block_hashes)))), dtype=float)
+    scores = np.array([found[h][0] if h in found else np.nan for h in block_hashes], dtype=float)
+    missing = [i for i, h in enumerate(block_hashes) if h not in found]
+    if missing:
+        scores[missing] = compute(missing)
+        try:
+            store([block_hashes[i] for i in missing], version, scores[missing], db_path)
+        except Exception as e:
+            logging.error(f"Prediction cache update failed: {e}")
+    logging.info(f"Prediction cache: {len(block_hashes) - len(missing)} hits, {len(missing)} scored")
+    return scores
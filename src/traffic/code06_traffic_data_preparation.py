@@ -1,6 +1,7 @@
 import pandas as pd
 import os
 import sqlite3
+from itertools import islice
 from tqdm import tqdm
 import sys
 from pathlib import Path
@@ -11,7 +12,13 @@ sys.stdout.reconfigure(line_buffering=True)
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "new_orders.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس مرحله (در حالت یکپارچه chain.db)
+input_db = stage_db("new_orders.db")
 output_file = os.path.join(RESULT_DIR, "traffic_data.csv")
 
 # تابع بررسی وجود دیتابیس
@@ -22,19 +29,22 @@ def check_db_exists(db_path):
     return True
 
 # تابع بارگذاری داده‌ها از دیتابیس
-def load_from_db(db_path, limit=None):
-    if not check_db_exists(db_path):
+def load_from_db(db_path, limit=None, rows=None):
+    if rows is None and not check_db_exists(db_path):
         return []
 
     try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        query = "SELECT * FROM new_orders"
-        if limit:
-            query += f" LIMIT {limit}"
-        c.execute(query)
-        rows = c.fetchall()
-        conn.close()
+        if rows is None:
+            conn = sqlite3.connect(db_path)
+            c = conn.cursor()
+            query = "SELECT * FROM new_orders"
+            if limit:
+                query += f" LIMIT {limit}"
+            c.execute(query)
+            rows = c.fetchall()
+            conn.close()
+        else:
+            rows = list(islice(rows, limit)) if limit else list(rows)
 
         if not rows:
             print("Database is empty. No data to load.")
@@ -81,11 +91,11 @@ def prepare_and_save_data(data, output_path):
         return 0
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         print("Starting data preparation process...")
-        chain_data = load_from_db(input_db, limit)
+        chain_data = load_from_db(input_db, limit, upstream)
         row_count = prepare_and_save_data(chain_data, output_file)
         
         summary = {
@@ -13,7 +13,13 @@ sys.stdout.reconfigure(line_buffering=True)
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "new_orders.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس مرحله (در حالت یکپارچه chain.db)
+input_db = stage_db("new_orders.db")
 model_file = os.path.join(RESULT_DIR, "congestion_model.pkl")
 encoders_file = os.path.join(RESULT_DIR, "encoders.pkl")
 
@@ -25,16 +31,19 @@ def check_db_exists(db_path):
     return True
 
 # تابع بارگذاری داده‌ها
-def load_data_from_db(db_path):
-    if not check_db_exists(db_path):
+def load_data_from_db(db_path, rows=None):
+    if rows is None and not check_db_exists(db_path):
         return pd.DataFrame()
 
     try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("SELECT * FROM new_orders")
-        rows = c.fetchall()
-        conn.close()
+        if rows is None:
+            conn = sqlite3.connect(db_path)
+            c = conn.cursor()
+            c.execute("SELECT * FROM new_orders")
+            rows = c.fetchall()
+            conn.close()
+        else:
+            rows = list(rows)
 
         if not rows:
             print("Database is empty. No data to load.")
@@ -105,10 +114,10 @@ def train_and_save_model(X, model_path, row_count):
         return 0
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         print("Starting model training process...")
-        df = load_data_from_db(input_db)
+        df = load_data_from_db(input_db, upstream)
         X, encoders, row_count = prepare_data(df)
         trained_rows = train_and_save_model(X, model_file, row_count)
         
@@ -2,7 +2,7 @@ import os
 import logging
 from collections import defaultdict
 import sqlite3
-import random
+from itertools import islice
 from tqdm import tqdm
 import sys
 from pathlib import Path
@@ -16,14 +16,20 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 RESULT_DIR = ROOT_DIR / "result"
-input_db = os.path.join(RESULT_DIR, "managed_traffic.db")
-output_db = os.path.join(RESULT_DIR, "traffic_report.db")
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.blockchain.block_writer import get_writer, close_writers
+from src.blockchain.topology import load_topology
+from src.blockchain.chain_db import stage_db
+
+# دیتابیس‌های مرحله (در حالت یکپارچه همه در chain.db)
+input_db = stage_db("managed_traffic.db")
+output_db = stage_db("traffic_report.db")
 
 # گراف نودها
-nodes = [f"Node_{i}" for i in range(1, 11)]
-graph = {node: {"neighbors": random.sample(nodes, random.randint(1, 3)), 
-                "weights": [random.uniform(1, 5) for _ in range(random.randint(1, 3))]} 
-         for node in nodes}
+topology = load_topology()
+nodes = topology.node_ids()
 
 # دیتابیس گزارش
 def init_db():
@@ -35,36 +41,38 @@ def init_db():
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS traffic_report
                  (report_type TEXT, node_id TEXT, value REAL, details TEXT)''')
+    # گزارش هر بار از کل داده‌ها ساخته می‌شود، پس گزارش قبلی جایگزین می‌شود
+    c.execute("DELETE FROM traffic_report")
     conn.commit()
     conn.close()
     print(f"Output database initialized at {output_db}")
 
 def save_report_to_db(report_type, node_id, value, details):
     try:
-        conn = sqlite3.connect(output_db)
-        c = conn.cursor()
-        c.execute("INSERT INTO traffic_report VALUES (?, ?, ?, ?)", (report_type, node_id, value, details))
-        conn.commit()
-        conn.close()
+        get_writer(output_db).write("traffic_report", (report_type, node_id, value, details))
     except sqlite3.Error as e:
         logging.error(f"Error saving report to database: {e}")
 
 # کلاس تحلیل
 class AdvancedTrafficAnalyzer:
-    def __init__(self, limit=None):
+    def __init__(self, limit=None, rows=None):
         self.chain = []
         self.cache = {}
-        self.load_from_db(limit)
+        self.load_from_db(limit, rows)
 
-    def load_from_db(self, limit):
+    def load_from_db(self, limit, rows=None):
         try:
-            conn = sqlite3.connect(input_db)
-            c = conn.cursor()
-            query = "SELECT * FROM managed_blocks"
-            if limit:
-                query += f" LIMIT {limit}"
-            c.execute(query)
-            rows = c.fetchall()
+            if rows is None:
+                conn = sqlite3.connect(input_db)
+                c = conn.cursor()
+                query = "SELECT * FROM managed_blocks"
+                if limit:
+                    query += f" LIMIT {limit}"
+                c.execute(query)
+                rows = c.fetchall()
+                conn.close()
+            else:
+                rows = list(islice(rows, limit)) if limit else list(rows)
             total_rows = len(rows)
             for idx, row in enumerate(tqdm(rows, desc="Loading blocks from DB", file=sys.stdout)):
                 block = {
@@ -88,7 +96,6 @@ class AdvancedTrafficAnalyzer:
                 if len(self.cache[block["node_id"]]) > 10:
                     self.cache[block["node_id"]].pop(0)
                 tqdm.write(f"Processed {idx + 1}/{total_rows} blocks - Loaded block for Node {block['node_id']} at {block['timestamp']}")
-            conn.close()
             logging.info(f"Loaded {len(rows)} blocks from managed_traffic.db")
         except sqlite3.Error as e:
             logging.error(f"Database load error: {e}")
@@ -143,7 +150,7 @@ class AdvancedTrafficAnalyzer:
         total_blocks = len(self.chain[1:])
         for idx, block in enumerate(tqdm(self.chain[1:], desc="Identifying high traffic nodes", file=sys.stdout)):
             if block["traffic_volume"] > threshold:
-                neighbors = ",".join(graph[block["node_id"]]["neighbors"])
+                neighbors = ",".join(topology.neighbors(block["node_id"]))
                 details = f"Node {block['node_id']} at {block['timestamp']}: {block['traffic_volume']} MB/s, Health: {block['network_health']}, Neighbors: {neighbors}"
                 high_traffic_nodes.append(details)
                 save_report_to_db("high_traffic", block["node_id"], block["traffic_volume"], details)
@@ -182,11 +189,11 @@ class AdvancedTrafficAnalyzer:
         return report
 
 # تابع اصلی
-def main():
+def main(upstream=None):
     try:
         limit = 100 if os.getenv("DEMO_MODE") == "True" else None
         init_db()
-        analyzer = AdvancedTrafficAnalyzer(limit)
+        analyzer = AdvancedTrafficAnalyzer(limit, upstream)
         report = analyzer.generate_advanced_report()
         
         block_count = len(analyzer.chain[1:])  # تعداد بلاک‌های پردازش‌شده (بدون جنسیس)
@@ -212,6 +219,8 @@ def main():
             "summary": "Failed to generate report",
             "error": str(e)
         }
+    finally:
+        close_writers(output_db)
 
 if __name__ == "__main__":
     result = main()
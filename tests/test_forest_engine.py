@@ -0,0 +1,43 @@
+import sys
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from sklearn.ensemble import IsolationForest
+
+# مسیر ریشه پروژه
+ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+from src.smart.forest_engine import FOREST_CHUNK_ROWS, FlatForest
+from src.smart.congestion_inference import FEATURE_COLUMNS
+
+# داده‌ای با همان ستون‌ها و بازه‌های داده آموزش مرحله ۷؛ بیش از یک تکه پیمایش تا مسیر تکه‌تکه هم آزموده شود
+def sample_features(rows=FOREST_CHUNK_ROWS * 2 + 7, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(np.column_stack([rng.integers(0, 11, rows), rng.uniform(0, 150, rows), rng.uniform(0, 50, rows),
+                                         rng.integers(0, 4, rows), rng.integers(0, 4, rows)]).astype(float),
+                        columns=FEATURE_COLUMNS)
+
+def fit_model(**kwargs):
+    return IsolationForest(n_estimators=50, contamination=0.1, random_state=42, **kwargs).fit(sample_features(seed=1))
+
+def test_score_samples_matches_sklearn():
+    model = fit_model()
+    X = sample_features()
+    np.testing.assert_array_equal(FlatForest.from_model(model).score_samples(X), model.score_samples(X))
+
+# درخت‌های آموزش‌دیده روی زیرمجموعه ستون‌ها اندیس ستون را به ستون اصلی برمی‌گردانند
+def test_score_samples_matches_sklearn_with_feature_subsets():
+    model = fit_model(max_features=0.6)
+    X = sample_features()
+    np.testing.assert_array_equal(FlatForest.from_model(model).score_samples(X), model.score_samples(X))
+
+def test_saved_forest_predicts_like_sklearn(tmp_path):
+    model = fit_model()
+    X = sample_features()
+    path = tmp_path / "congestion_model.forest.npz"
+    FlatForest.from_model(model).save(path)
+    forest = FlatForest.load(path)
+    np.testing.assert_array_equal(forest.decision_function(X), model.decision_function(X))
+    np.testing.assert_array_equal(forest.predict(X), model.predict(X))
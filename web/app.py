@@ -35,11 +35,41 @@ logging.basicConfig(
 # مسیر ریشه پروژه
 ROOT_DIR = Path(__file__).resolve().parent.parent
 RESULT_DIR = ROOT_DIR / "result"
+sys.path.append(str(ROOT_DIR))
+
+from src.pipeline_dag import run_dag
+from src.blockchain.key_store import public_key_table
+from src.blockchain.topology import load_topology
+from src.blockchain.timestamps import epoch_us, ensure_stage_indexes, time_order_column
+from src.blockchain.chain_db import stage_db, trace_block
 
 # ایجاد دایرکتوری result اگر وجود ندارد
 if not RESULT_DIR.exists():
     RESULT_DIR.mkdir()
 
+# ساخت جدول new_orders و مهاجرت ستون timestamp_us و ایندکس‌های آن یک بار هنگام راه‌اندازی؛ مسیر درخواست فقط INSERT می‌کند
+def init_new_orders_db():
+    conn = sqlite3.connect(Path(stage_db("new_orders.db")))
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS new_orders (
+                node_id TEXT,
+                traffic_type TEXT,
+                traffic_volume REAL,
+                network_health TEXT,
+                latency REAL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                order_type TEXT DEFAULT 'Standard',
+                congestion_level TEXT DEFAULT 'Low'
+            )
+        """)
+        conn.commit()
+        ensure_stage_indexes(conn, "new_orders")
+    finally:
+        conn.close()
+
+init_new_orders_db()
+
 # لیست اسکریپت‌ها با نام ماژول‌ها
 SCRIPTS = {
     'code01': 'src.blockchain.code01_blockchain_initial_data',
@@ -139,31 +169,46 @@ def run_script(script_name, socketio):
 # تابع برای بررسی وجود جدول
 def table_exists(conn, table_name):
     c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+    c.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (table_name,))
     return c.fetchone() is not None
 
 # تابع برای گرفتن گزارش‌ها و داده‌های دقیق
+# در حالت دیتابیس یکپارچه همه مراحل به chain.db می‌رسند و یک اتصال برای همه گزارش‌ها کافی است
 def get_reports():
+    connections = {}
+
+    def connect(db_path):
+        key = str(db_path)
+        if key not in connections:
+            connections[key] = sqlite3.connect(db_path)
+        return connections[key]
+
+    try:
+        return collect_reports(connect)
+    finally:
+        for conn in connections.values():
+            conn.close()
+
+def collect_reports(connect):
     reports = {}
     detailed_data = {}
     detailed_columns = {}
 
     # Code01: traffic_data.db
     try:
-        db_path = RESULT_DIR / "traffic_data.db"
+        db_path = Path(stage_db("traffic_data.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'blocks'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, traffic_volume, network_health, latency, timestamp FROM blocks ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, traffic_volume, network_health, latency, timestamp FROM blocks ORDER BY {time_order_column(conn, 'blocks')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code01'] = rows
                 detailed_columns['code01'] = ['Node ID', 'Traffic Volume', 'Network Health', 'Latency', 'Timestamp']
                 reports['code01'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code01'] = {'error': 'Table "blocks" not found in traffic_data.db'}
-            conn.close()
         else:
             reports['code01'] = {'error': 'traffic_data.db not found'}
     except sqlite3.Error as e:
@@ -172,20 +217,19 @@ def get_reports():
 
     # Code02: congestion_data.db
     try:
-        db_path = RESULT_DIR / "congestion_data.db"
+        db_path = Path(stage_db("congestion_data.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'congestion_blocks'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, congestion_level, congestion_score, timestamp FROM congestion_blocks ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, congestion_level, congestion_score, timestamp FROM congestion_blocks ORDER BY {time_order_column(conn, 'congestion_blocks')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code02'] = rows
                 detailed_columns['code02'] = ['Node ID', 'Congestion Level', 'Congestion Score', 'Timestamp']
                 reports['code02'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code02'] = {'error': 'Table "congestion_blocks" not found in congestion_data.db'}
-            conn.close()
         else:
             reports['code02'] = {'error': 'congestion_data.db not found'}
     except sqlite3.Error as e:
@@ -194,20 +238,19 @@ def get_reports():
 
     # Code03: managed_traffic.db
     try:
-        db_path = RESULT_DIR / "managed_traffic.db"
+        db_path = Path(stage_db("managed_traffic.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'managed_blocks'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, congestion_level, traffic_volume, timestamp FROM managed_blocks ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, congestion_level, traffic_volume, timestamp FROM managed_blocks ORDER BY {time_order_column(conn, 'managed_blocks')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code03'] = rows 
                 detailed_columns['code03'] = ['Node ID', 'Congestion Level', 'Traffic Volume', 'Timestamp']
                 reports['code03'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code03'] = {'error': 'Table "managed_blocks" not found in managed_traffic.db'}
-            conn.close()
         else:
             reports['code03'] = {'error': 'managed_traffic.db not found'}
     except sqlite3.Error as e:
@@ -216,20 +259,19 @@ def get_reports():
 
     # Code04: new_orders.db
     try:
-        db_path = RESULT_DIR / "new_orders.db"
+        db_path = Path(stage_db("new_orders.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'new_orders'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, traffic_type, traffic_volume, network_health, latency, timestamp FROM new_orders ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, traffic_type, traffic_volume, network_health, latency, timestamp FROM new_orders ORDER BY {time_order_column(conn, 'new_orders')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code04'] = rows
                 detailed_columns['code04'] = ['Node ID', 'Traffic Type', 'Traffic Volume', 'Network Health', 'Latency', 'Timestamp']
                 reports['code04'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code04'] = {'error': 'Table "new_orders" not found in new_orders.db'}
-            conn.close()
         else:
             reports['code04'] = {'error': 'new_orders.db not found'}
     except sqlite3.Error as e:
@@ -238,20 +280,19 @@ def get_reports():
 
     # Code05: real_time_orders.db
     try:
-        db_path = RESULT_DIR / "real_time_orders.db"
+        db_path = Path(stage_db("real_time_orders.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'real_time_orders'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, traffic_type, traffic_volume, network_health, latency, timestamp FROM real_time_orders ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, traffic_type, traffic_volume, network_health, latency, timestamp FROM real_time_orders ORDER BY {time_order_column(conn, 'real_time_orders')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code05'] = rows
                 detailed_columns['code05'] = ['Node ID', 'Traffic Type', 'Traffic Volume', 'Network Health', 'Latency', 'Timestamp']
                 reports['code05'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code05'] = {'error': 'Table "real_time_orders" not found in real_time_orders.db'}
-            conn.close()
         else:
             reports['code05'] = {'error': 'real_time_orders.db not found'}
     except sqlite3.Error as e:
@@ -304,9 +345,9 @@ def get_reports():
 
     # Code08: traffic_report.db
     try:
-        db_path = RESULT_DIR / "traffic_report.db"
+        db_path = Path(stage_db("traffic_report.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'traffic_report'):
                 c = conn.cursor()
                 # گرفتن لیست ستون‌ها
@@ -326,7 +367,6 @@ def get_reports():
                 reports['code08'] = {'status': f'Data retrieved successfully (columns: {", ".join(select_columns)}) '}
             else:
                 reports['code08'] = {'error': 'Table "traffic_report" not found in traffic_report.db'}
-            conn.close()
         else:
             reports['code08'] = {'error': 'traffic_report.db not found'}
     except sqlite3.Error as e:
@@ -335,20 +375,19 @@ def get_reports():
 
     # Code09: smart_traffic.db
     try:
-        db_path = RESULT_DIR / "smart_traffic.db"
+        db_path = Path(stage_db("smart_traffic.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'smart_traffic'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, congestion_level, predicted_congestion, timestamp FROM smart_traffic ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, congestion_level, predicted_congestion, timestamp FROM smart_traffic ORDER BY {time_order_column(conn, 'smart_traffic')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code09'] = rows
                 detailed_columns['code09'] = ['Node ID', 'Congestion Level', 'Predicted Congestion', 'Timestamp']
                 reports['code09'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code09'] = {'error': 'Table "smart_traffic" not found in smart_traffic.db'}
-            conn.close()
         else:
             reports['code09'] = {'error': 'smart_traffic.db not found'}
     except sqlite3.Error as e:
@@ -357,20 +396,19 @@ def get_reports():
 
     # Code10: self_healing.db
     try:
-        db_path = RESULT_DIR / "self_healing.db"
+        db_path = Path(stage_db("self_healing.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'healing_network'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, congestion_level, healing_action, timestamp FROM healing_network ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, congestion_level, healing_action, timestamp FROM healing_network ORDER BY {time_order_column(conn, 'healing_network')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code10'] = rows
                 detailed_columns['code10'] = ['Node ID', 'Congestion Level', 'Healing Action', 'Timestamp']
                 reports['code10'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code10'] = {'error': 'Table "healing_network" not found in self_healing.db'}
-            conn.close()
         else:
             reports['code10'] = {'error': 'self_healing.db not found'}
     except sqlite3.Error as e:
@@ -379,20 +417,19 @@ def get_reports():
 
     # Code11: optimized_resources.db
     try:
-        db_path = RESULT_DIR / "optimized_resources.db"
+        db_path = Path(stage_db("optimized_resources.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'optimized_resources'):
                 c = conn.cursor()
                 # داده‌های دقیق
-                c.execute("SELECT node_id, congestion_level, resource_allocation, traffic_volume, timestamp FROM optimized_resources ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, congestion_level, resource_allocation, traffic_volume, timestamp FROM optimized_resources ORDER BY {time_order_column(conn, 'optimized_resources')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code11'] = rows
                 detailed_columns['code11'] = ['Node ID', 'Congestion Level', 'Resource Allocation', 'Traffic Volume', 'Timestamp']
                 reports['code11'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code11'] = {'error': 'Table "optimized_resources" not found in optimized_resources.db'}
-            conn.close()
         else:
             reports['code11'] = {'error': 'optimized_resources.db not found'}
     except sqlite3.Error as e:
@@ -401,20 +438,19 @@ def get_reports():
 
     # Code12: predictive_analysis.db
     try:
-        db_path = RESULT_DIR / "predictive_analysis.db"
+        db_path = Path(stage_db("predictive_analysis.db"))
         if db_path.exists():
-            conn = sqlite3.connect(db_path)
+            conn = connect(db_path)
             if table_exists(conn, 'predictive_analysis'):
                 c = conn.cursor()
                 # داده‌های دقیق - جایگزینی actual_congestion با congestion_level
-                c.execute("SELECT node_id, congestion_level, predicted_congestion, anomaly_detected, timestamp FROM predictive_analysis ORDER BY timestamp DESC LIMIT 50")
+                c.execute(f"SELECT node_id, congestion_level, predicted_congestion, anomaly_detected, timestamp FROM predictive_analysis ORDER BY {time_order_column(conn, 'predictive_analysis')} DESC LIMIT 50")
                 rows = c.fetchall()
                 detailed_data['code12'] = rows
                 detailed_columns['code12'] = ['Node ID', 'Congestion Level', 'Predicted Congestion', 'Anomaly Detected', 'Timestamp']
                 reports['code12'] = {'status': 'Data retrieved successfully'}
             else:
                 reports['code12'] = {'error': 'Table "predictive_analysis" not found in predictive_analysis.db'}
-            conn.close()
         else:
             reports['code12'] = {'error': 'predictive_analysis.db not found'}
     except sqlite3.Error as e:
@@ -463,7 +499,7 @@ def report_code(code):
 @app.route('/traffic_data', methods=['GET'])
 def traffic_data():
     try:
-        db_path = RESULT_DIR / "traffic_data.db"
+        db_path = Path(stage_db("traffic_data.db"))
         if not db_path.exists():
             return jsonify({'error': 'traffic_data.db not found'})
         
@@ -474,7 +510,7 @@ def traffic_data():
         
         c = conn.cursor()
         
-        c.execute("SELECT timestamp, traffic_volume, network_health, latency FROM blocks ORDER BY timestamp DESC LIMIT 100")
+        c.execute(f"SELECT timestamp, traffic_volume, network_health, latency FROM blocks ORDER BY {time_order_column(conn, 'blocks')} DESC LIMIT 100")
         rows = c.fetchall()
         
         timestamps = [row[0] for row in rows]
@@ -508,7 +544,7 @@ def traffic_data():
 @app.route('/predictions', methods=['GET'])
 def predictions():
     try:
-        db_path = RESULT_DIR / "predictive_analysis.db"
+        db_path = Path(stage_db("predictive_analysis.db"))
         if not db_path.exists():
             return jsonify({'error': 'predictive_analysis.db not found'})
         
@@ -519,7 +555,7 @@ def predictions():
         
         c = conn.cursor()
         
-        c.execute("SELECT node_id, congestion_level, predicted_congestion FROM predictive_analysis ORDER BY timestamp DESC LIMIT 50")
+        c.execute(f"SELECT node_id, congestion_level, predicted_congestion FROM predictive_analysis ORDER BY {time_order_column(conn, 'predictive_analysis')} DESC LIMIT 50")
         rows = c.fetchall()
         
         node_ids = [row[0] for row in rows]
@@ -537,10 +573,52 @@ def predictions():
         logging.error(f"Error reading predictive_analysis.db: {e}")
         return jsonify({'error': str(e)})
 
+# جدول کلیدهای عمومی نودها برای تأیید امضای بلاک‌ها
+@app.route('/node_keys', methods=['GET'])
+def node_keys():
+    try:
+        return jsonify(public_key_table())
+    except (OSError, ValueError) as e:
+        logging.error(f"Error loading node keys: {e}")
+        return jsonify({'error': str(e)})
+
+# خلاصه توپولوژی مشترک یا همسایه‌های یک نود (?node=Node_1)
+@app.route('/topology', methods=['GET'])
+def topology():
+    try:
+        graph = load_topology()
+        node_id = request.args.get('node')
+        if node_id:
+            if node_id not in graph:
+                return jsonify({'error': f'Unknown node: {node_id}'}), 404
+            return jsonify({'node': node_id, 'neighbors': graph.neighbors(node_id),
+                            'weights': graph.neighbor_weights(node_id)})
+        return jsonify(graph.summary())
+    except (OSError, ValueError) as e:
+        logging.error(f"Error loading topology: {e}")
+        return jsonify({'error': str(e)})
+
+# ردگیری یک بلاک در همه مراحل با view block_lineage (فقط در حالت دیتابیس یکپارچه)
+@app.route('/lineage/<block_hash>', methods=['GET'])
+def lineage(block_hash):
+    try:
+        db_path = Path(stage_db("traffic_data.db"))
+        if not db_path.exists():
+            return jsonify({'error': f'{db_path.name} not found'})
+        conn = sqlite3.connect(db_path)
+        rows = trace_block(conn, block_hash)
+        conn.close()
+        if not rows:
+            return jsonify({'error': f'No lineage found for block {block_hash}'}), 404
+        return jsonify({'block_hash': block_hash, 'lineage': rows})
+    except sqlite3.Error as e:
+        logging.error(f"Error tracing block {block_hash}: {e}")
+        return jsonify({'error': str(e)})
+
 @app.route('/traffic_report_data', methods=['GET'])
 def traffic_report_data():
     try:
-        db_path = RESULT_DIR / "traffic_report.db"
+        db_path = Path(stage_db("traffic_report.db"))
         if not db_path.exists():
             return jsonify({'error': 'traffic_report.db not found'})
         
@@ -589,27 +667,16 @@ def add_new_order():
         if not all([node_id, traffic_type, traffic_volume >= 0, network_health, latency >= 0]):
             return jsonify({'error': 'Invalid or missing data'})
         
-        db_path = RESULT_DIR / "new_orders.db"
+        db_path = Path(stage_db("new_orders.db"))
         conn = sqlite3.connect(db_path)
         c = conn.cursor()
         
+        # زمان به همان قالب مراحل پایپ‌لاین (زمان محلی ISO) به همراه ستون عددی آن ذخیره می‌شود
+        timestamp = datetime.now().isoformat()
         c.execute("""
-            CREATE TABLE IF NOT EXISTS new_orders (
-                node_id TEXT,
-                traffic_type TEXT,
-                traffic_volume REAL,
-                network_health TEXT,
-                latency REAL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                order_type TEXT DEFAULT 'Standard',
-                congestion_level TEXT DEFAULT 'Low'
-            )
-        """)
-        
-        c.execute("""
-            INSERT INTO new_orders (node_id, traffic_type, traffic_volume, network_health, latency)
-            VALUES (?, ?, ?, ?, ?)
-        """, (node_id, traffic_type, traffic_volume, network_health, latency))
+            INSERT INTO new_orders (node_id, traffic_type, traffic_volume, network_health, latency, timestamp, timestamp_us)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (node_id, traffic_type, traffic_volume, network_health, latency, timestamp, epoch_us(timestamp)))
         
         conn.commit()
         conn.close()
@@ -713,29 +780,31 @@ def run_project():
         logging.warning("A project run is already in progress")
         return jsonify({'status': 'error', 'message': "A project run is already in progress"})
     
+    # اجرای مراحل مستقل به صورت موازی بر اساس گراف وابستگی
     def run_all_scripts():
-        for code in sorted(SCRIPTS.keys()):
-            if code in running_scripts:
-                logging.warning(f"Module {code} is already running, skipping...")
-                socketio.emit('output', f"Module {code} is already running, skipping...")
-                continue
-            if not script_locks[code].acquire(blocking=False):
-                logging.warning(f"Module {code} is locked, skipping...")
-                socketio.emit('output', f"Module {code} is locked, skipping...")
-                continue
-            running_scripts.add(code)
-            try:
-                socketio.emit('output', f"Starting {code}...")
-                run_script(code, socketio)
-            except Exception as e:
-                error_msg = f"Stopped project execution at {code} due to error: {str(e)}"
-                logging.error(error_msg)
-                socketio.emit('output', error_msg)
-            finally:
+        codes = [code for code in sorted(SCRIPTS.keys()) if script_locks[code].acquire(blocking=False)]
+        if len(codes) < len(SCRIPTS):
+            busy = sorted(set(SCRIPTS) - set(codes))
+            logging.warning(f"Modules {', '.join(busy)} are locked, aborting project run")
+            socketio.emit('output', f"Modules {', '.join(busy)} are locked, aborting project run")
+            for code in codes:
+                script_locks[code].release()
+            return
+        running_scripts.update(codes)
+        try:
+            results, timing = run_dag(on_event=lambda message: socketio.emit('output', message))
+            socketio.emit('output', f"Critical path: {' -> '.join(timing['critical_path'])} "
+                                    f"({timing['critical_path_time']}s of {timing['wall_time']}s wall time)")
+        except Exception as e:
+            error_msg = f"Stopped project execution due to error: {str(e)}"
+            logging.error(error_msg)
+            socketio.emit('output', error_msg)
+        finally:
+            for code in codes:
                 running_scripts.discard(code)
                 if script_locks[code].locked():
                     script_locks[code].release()
-                    logging.info(f"Lock for {code} released in run_project")
+            logging.info("Locks released in run_project")
     
     threading.Thread(target=run_all_scripts, daemon=True).start()
     return jsonify({'status': 'started'})